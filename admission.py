@@ -0,0 +1,129 @@
+import time
+import logging
+from collections import OrderedDict
+from config import (
+    SAMPLER_COST, USER_BUDGET_CREDITS, USER_BUDGET_REFILL_PER_MINUTE, GPU_BUDGET_CREDITS,
+    GPU_SATURATION, EXPENSIVE_JOB_CREDITS, SESSION_MAX_ENTRIES
+)
+from metrics import ADMISSIONS
+from token_bucket import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+CREDIT_PIXEL_STEPS = 512 * 512 * 20
+
+class BudgetExceededError(RuntimeError):
+    pass
+
+def job_cost(params):
+    images = params.get("batch_size", 1) * params.get("n_iter", 1)
+    pixel_steps = params["width"] * params["height"] * params["steps"] * images
+    hires = params.get("hires")
+    if hires:
+        # The second pass only runs the denoised fraction of its steps
+        pixel_steps += hires["width"] * hires["height"] * hires["steps"] * hires["denoising_strength"] * images
+    source = params.get("img2img")
+    if source:
+        # img2img skips the first (1 - denoising_strength) of the steps
+        pixel_steps *= max(0.1, source["denoising_strength"])
+    return pixel_steps / CREDIT_PIXEL_STEPS * SAMPLER_COST.get(params["sampler"], 1.0)
+
+class Ticket:
+    __slots__ = ("user_id", "cost", "deferred", "released")
+
+    def __init__(self, user_id, cost, deferred):
+        self.user_id = user_id
+        self.cost = cost
+        self.deferred = deferred
+        self.released = False
+
+class AdmissionController:
+    # Per-user token buckets bound how fast one user can spend GPU time; the
+    # global budget bounds how much work is queued or running at once
+    def __init__(self, user_capacity=USER_BUDGET_CREDITS, user_refill_per_minute=USER_BUDGET_REFILL_PER_MINUTE,
+                 gpu_budget=GPU_BUDGET_CREDITS, saturation=GPU_SATURATION,
+                 expensive=EXPENSIVE_JOB_CREDITS, max_users=SESSION_MAX_ENTRIES):
+        self.user_capacity = user_capacity
+        self.user_rate = user_refill_per_minute / 60
+        self.gpu_budget = gpu_budget
+        self.saturation = saturation
+        self.expensive = expensive
+        self.max_users = max_users
+        self._buckets = OrderedDict()
+        self.load = 0.0
+
+    def _bucket(self, user_id, now):
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.user_capacity, self.user_rate, now)
+            # The oldest buckets have had the longest to refill, so dropping them loses little
+            while len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+        return bucket
+
+    def remaining(self, user_id):
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            return self.user_capacity
+        return bucket.available(time.monotonic())
+
+    @property
+    def saturated(self):
+        return self.load >= self.gpu_budget * self.saturation
+
+    def admit(self, user_id, params):
+        cost = job_cost(params)
+        now = time.monotonic()
+
+        if cost > self.user_capacity:
+            ADMISSIONS.inc("too_expensive")
+            raise BudgetExceededError(
+                f"This job costs {cost:.1f} credits, but at most {self.user_capacity:.0f} can be spent at once. "
+                "Lower the steps, size or batch size."
+            )
+
+        expensive = cost >= self.expensive
+        # An idle GPU always takes the job, however large
+        if expensive and self.load > 0 and self.load + cost > self.gpu_budget:
+            ADMISSIONS.inc("saturated")
+            raise BudgetExceededError(
+                f"The GPU is saturated and this job costs {cost:.1f} credits. "
+                "Try again in a minute or lower the steps or size."
+            )
+
+        bucket = self._bucket(user_id, now)
+        if not bucket.take(cost, now):
+            ADMISSIONS.inc("over_budget")
+            wait = bucket.wait_time(cost, now)
+            # Budgets without a refill only come back through refunds
+            retry = f"Try again in ~{int(wait) + 1}s." if wait != float("inf") else "Try again later."
+            raise BudgetExceededError(
+                f"Not enough credits: this job costs {cost:.1f}, you have "
+                f"{bucket.available(now):.1f}/{self.user_capacity:.0f}. {retry}"
+            )
+
+        deferred = expensive and self.saturated
+        self.load += cost
+        ADMISSIONS.inc("deferred" if deferred else "admitted")
+        if deferred:
+            logger.info(f"Deferring {cost:.1f} credit job for user {user_id} (GPU load {self.load:.1f})")
+        return Ticket(user_id, cost, deferred)
+
+    def release(self, ticket, refund=False):
+        # Failed jobs give the credits back; the GPU budget is freed either way
+        if ticket.released:
+            return
+        ticket.released = True
+        self.load = max(0.0, self.load - ticket.cost)
+        if refund:
+            self._bucket(ticket.user_id, time.monotonic()).give(ticket.cost, time.monotonic())
+
+    def stats(self):
+        return {
+            "gpu_load": round(self.load, 2),
+            "gpu_budget": self.gpu_budget,
+            "saturated": self.saturated,
+            "tracked_users": len(self._buckets),
+        }
@@ -0,0 +1,206 @@
+import asyncio
+import time
+import logging
+from token_bucket import TokenBucket
+from config import (
+    BACKEND_HEALTH_INTERVAL, BACKEND_HEALTH_TIMEOUT, BACKEND_MAX_FAILURES, BREAKER_COOLDOWN,
+    BREAKER_MAX_COOLDOWN, RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_PER_SECOND
+)
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+def parse_backend_urls(value):
+    # "https://a.example|2,https://b.example" -> [("https://a.example", 2.0), ("https://b.example", 1.0)]
+    backends = []
+    for entry in (value or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        url, _, weight = entry.partition("|")
+        backends.append((url.strip().rstrip("/"), float(weight) if weight else 1.0))
+    return backends
+
+class Backend:
+    def __init__(self, url, weight=1.0):
+        self.url = url
+        self.weight = weight
+        # Circuit breaker: closed takes traffic, open takes none until the
+        # cooldown ends, half-open lets a single trial call through
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.cooldown = BREAKER_COOLDOWN
+        self.trial_in_flight = False
+        self.outstanding = 0
+        self.failures = 0
+        self.total_requests = 0
+        self.total_failures = 0
+        self.last_probe = None
+
+    @property
+    def healthy(self):
+        return self.state == CLOSED
+
+    def available(self, now):
+        if self.state == OPEN and now - self.opened_at >= self.cooldown:
+            self.state = HALF_OPEN
+            self.trial_in_flight = False
+        if self.state == HALF_OPEN:
+            return not self.trial_in_flight
+        return self.state == CLOSED
+
+    def retry_in(self, now):
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.cooldown - now)
+
+    def stats(self):
+        return {
+            "url": self.url,
+            "weight": self.weight,
+            "state": self.state,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "consecutive_failures": self.failures,
+            "requests": self.total_requests,
+            "failures": self.total_failures,
+        }
+
+class RetryBudget:
+    # Token bucket shared by all calls: every first attempt deposits `ratio`
+    # tokens and every retry spends one, so retries cannot multiply load on a
+    # struggling backend. A small time-based floor keeps low traffic retryable.
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, min_per_second=RETRY_BUDGET_MIN_PER_SECOND, capacity=10.0):
+        self.ratio = ratio
+        self._bucket = TokenBucket(capacity, min_per_second)
+        self.retries = 0
+        self.denied = 0
+
+    @property
+    def tokens(self):
+        return self._bucket.available(time.monotonic())
+
+    def deposit(self):
+        self._bucket.give(self.ratio, time.monotonic())
+
+    def withdraw(self):
+        if not self._bucket.take(1, time.monotonic()):
+            self.denied += 1
+            return False
+        self.retries += 1
+        return True
+
+    def stats(self):
+        return {"tokens": round(self.tokens, 2), "retries": self.retries, "denied": self.denied}
+
+class BackendPool:
+    def __init__(self, urls, health_interval=BACKEND_HEALTH_INTERVAL,
+                 health_timeout=BACKEND_HEALTH_TIMEOUT, max_failures=BACKEND_MAX_FAILURES,
+                 max_cooldown=BREAKER_MAX_COOLDOWN):
+        self.backends = [Backend(url, weight) for url, weight in urls]
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.max_failures = max_failures
+        self.max_cooldown = max_cooldown
+        self.retry_budget = RetryBudget()
+        self._health_task = None
+
+    def __len__(self):
+        return len(self.backends)
+
+    def acquire(self, exclude=(), idle_only=False):
+        # Returns None when every eligible circuit is open, so callers fail fast
+        now = time.monotonic()
+        pool = [b for b in self.backends if b not in exclude and b.weight > 0 and b.available(now)]
+        if idle_only:
+            pool = [b for b in pool if b.outstanding == 0]
+        if not pool:
+            return None
+        backend = min(pool, key=lambda b: (b.outstanding + 1) / b.weight)
+        if backend.state == HALF_OPEN:
+            backend.trial_in_flight = True
+        backend.outstanding += 1
+        backend.total_requests += 1
+        return backend
+
+    def retry_in(self):
+        # Seconds until the next open circuit lets a trial call through
+        now = time.monotonic()
+        waits = [b.retry_in(now) for b in self.backends if b.weight > 0]
+        return min(waits) if waits else 0.0
+
+    def _record_success(self, backend):
+        if backend.state != CLOSED:
+            logger.info(f"Backend {backend.url} circuit closed")
+        backend.state = CLOSED
+        backend.failures = 0
+        backend.cooldown = BREAKER_COOLDOWN
+        backend.trial_in_flight = False
+
+    def _record_failure(self, backend):
+        backend.failures += 1
+        backend.total_failures += 1
+        if backend.state == HALF_OPEN:
+            backend.cooldown = min(backend.cooldown * 2, self.max_cooldown)
+            self._open(backend, "half-open trial failed")
+        elif backend.state == CLOSED and backend.failures >= self.max_failures:
+            self._open(backend, f"{backend.failures} consecutive failures")
+
+    def _open(self, backend, reason):
+        backend.state = OPEN
+        backend.opened_at = time.monotonic()
+        backend.trial_in_flight = False
+        logger.warning(f"Backend {backend.url} circuit opened for {backend.cooldown:.0f}s: {reason}")
+
+    def release(self, backend, ok):
+        # ok=None means the call was abandoned (e.g. a hedge loser) and proves nothing
+        backend.outstanding -= 1
+        if ok is None:
+            if backend.state == HALF_OPEN:
+                backend.trial_in_flight = False
+        elif ok:
+            self._record_success(backend)
+        else:
+            self._record_failure(backend)
+
+    async def probe(self, client, backend):
+        # Open circuits are only probed once their cooldown is over, as the half-open trial
+        backend.available(time.monotonic())
+        if backend.state == OPEN:
+            return False
+        try:
+            response = await client.get(
+                f"{backend.url}/sdapi/v1/progress",
+                params={"skip_current_image": "true"},
+                timeout=self.health_timeout
+            )
+            ok = response.status_code == 200
+        except Exception as e:
+            logger.debug(f"Health probe for {backend.url} failed: {e}")
+            ok = False
+
+        backend.last_probe = time.time()
+        if ok:
+            self._record_success(backend)
+        else:
+            self._record_failure(backend)
+        return ok
+
+    async def _health_loop(self, client):
+        while True:
+            await asyncio.gather(*(self.probe(client, b) for b in self.backends))
+            await asyncio.sleep(self.health_interval)
+
+    def start(self, client):
+        if self._health_task is None and self.backends and self.health_interval > 0:
+            self._health_task = asyncio.create_task(self._health_loop(client))
+
+    async def stop(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+            self._health_task = None
+
+    def stats(self):
+        return [b.stats() for b in self.backends]
@@ -0,0 +1,716 @@
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import BytesIO
+from config import SD_DEFAULTS
+from fake_a1111 import create_app, serve, spawn
+from gradio_connector import GradioConnector
+from scheduler import GenerationScheduler
+
+# Offline benchmarks against fake_a1111. Run e.g.:
+#   python benchmark.py batching --requests 64
+#   python benchmark.py e2e --users 32 --rounds 5 --set GENERATION_MAX_BATCH=8
+#   python benchmark.py e2e --taps 5 --telegram-chat-limit 1 --set TELEGRAM_RATE_LIMIT=false
+
+def default_params(**overrides):
+    params = {
+        "prompt": "sunset over mountains, 4k, detailed",
+        "negative_prompt": SD_DEFAULTS["negative_prompt"],
+        "steps": SD_DEFAULTS["steps"],
+        "cfg_scale": SD_DEFAULTS["cfg_scale"],
+        "width": SD_DEFAULTS["width"],
+        "height": SD_DEFAULTS["height"],
+        "sampler": SD_DEFAULTS["sampler"],
+        "scheduler": "Automatic",
+        "seed": -1,
+        "subseed": -1,
+        "subseed_strength": 0,
+        "restore_faces": False,
+        "tiling": False,
+        "batch_size": 1,
+    }
+    params.update(overrides)
+    return params
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+async def run_batching(args):
+    app = create_app(call_overhead=args.call_overhead, per_image=args.per_image)
+    server, server_task, url = await serve(app)
+    connector = GradioConnector(api_urls=url)
+    try:
+        for max_batch in (1, args.max_batch):
+            app.state.calls = 0
+            scheduler = GenerationScheduler(
+                lambda params_list, on_progress: connector.generate_batch(params_list, prompt_lists=True),
+                workers=args.workers,
+                max_queue=args.requests,
+                batch_key=lambda params: GradioConnector.batch_key(params, prompt_lists=True),
+                batch_window=args.window,
+                max_batch=max_batch
+            )
+            scheduler.start()
+            started = time.perf_counter()
+            latencies = []
+            jobs = []
+            for i in range(args.requests):
+                job = scheduler.submit(i % args.users, default_params(prompt=f"prompt {i}"))
+                job.future.add_done_callback(
+                    lambda _, submitted=job.submitted_at: latencies.append(time.monotonic() - submitted)
+                )
+                jobs.append(job)
+            await asyncio.gather(*(job.future for job in jobs))
+            elapsed = time.perf_counter() - started
+            await scheduler.stop()
+            print(
+                f"max_batch={max_batch:<3} requests={args.requests} backend_calls={app.state.calls:<4} "
+                f"elapsed={elapsed:7.2f}s throughput={args.requests / elapsed:6.2f} img/s "
+                f"p50={percentile(latencies, 50):6.2f}s p99={percentile(latencies, 99):6.2f}s"
+            )
+    finally:
+        await connector.close()
+        server.should_exit = True
+        await server_task
+
+async def legacy_generate(client, url, params):
+    # The pre-streaming path: whole JSON body, parsed copy, decoded bytes,
+    # BytesIO and python-telegram-bot's read() of it for the upload
+    payload = GradioConnector(api_urls=url).build_payload(**params)
+    response = await client.post(f"{url}/sdapi/v1/txt2img", json=payload)
+    result = response.json()
+    image_io = BytesIO(base64.b64decode(result['images'][0]))
+    return image_io.read()
+
+def drain(reader, chunk_size=65536):
+    # Stands in for httpx reading the multipart upload
+    total = 0
+    while True:
+        chunk = reader.read(chunk_size)
+        if not chunk:
+            return total
+        total += len(chunk)
+
+async def run_memory_mode(args):
+    process, url = await spawn(call_overhead=0.0, per_image=0.0)
+    connector = GradioConnector(api_urls=url)
+    params = default_params(width=args.size, height=args.size)
+    try:
+        # Warm up the connection pool and the backend's canned image
+        await legacy_generate(connector.client, url, params)
+        tracemalloc.start()
+        started = time.perf_counter()
+        if args.mode == "legacy":
+            results = await asyncio.gather(*(
+                legacy_generate(connector.client, url, params) for _ in range(args.concurrency)
+            ))
+            sizes = [len(data) for data in results]
+        else:
+            images = await asyncio.gather(*(
+                connector.generate_image(**params) for _ in range(args.concurrency)
+            ))
+            sizes = [drain(image.open()) for image in images]
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(json.dumps({
+            "mode": args.mode,
+            "elapsed": elapsed,
+            "image_bytes": sizes[0],
+            "traced_peak": peak,
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }))
+    finally:
+        await connector.close()
+        process.terminate()
+        await process.wait()
+
+async def run_memory(args):
+    if args.mode:
+        await run_memory_mode(args)
+        return
+    # Each mode runs in a fresh interpreter so peak RSS is comparable
+    for mode in ("legacy", "streaming"):
+        output = subprocess.run(
+            [sys.executable, __file__, "memory", "--mode", mode,
+             "--concurrency", str(args.concurrency), "--size", str(args.size)],
+            check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(
+            f"{mode:<10} concurrency={args.concurrency} image={result['image_bytes'] / 1e6:.1f}MB "
+            f"elapsed={result['elapsed']:6.2f}s traced_peak={result['traced_peak'] / 1e6:8.1f}MB "
+            f"max_rss={result['max_rss_kb'] / 1e3:8.1f}MB"
+        )
+
+def synthetic_update(update_id, user_id):
+    chat = {"id": user_id, "type": "private", "first_name": "Bench"}
+    sender = {"id": user_id, "is_bot": False, "first_name": "Bench"}
+    if update_id % 2:
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": sender,
+                "chat_instance": str(user_id),
+                "data": "menu:quality",
+                "message": {"message_id": 1, "date": 0, "chat": chat, "text": "menu"},
+            },
+        }
+    return {
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": 0, "chat": chat, "from": sender, "text": f"prompt {update_id}"},
+    }
+
+async def run_webhook(args):
+    import httpx
+    import bot
+
+    async def simulated_handler(data):
+        await asyncio.sleep(args.handler_time)
+
+    bot.bot_ready = True
+    bot.application = object()
+    bot.update_ingestor.process = simulated_handler
+    bot.update_ingestor.start()
+
+    transport = httpx.ASGITransport(app=bot.app)
+    latencies = []
+    statuses = {}
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def send(client, data):
+        async with limit:
+            started = time.perf_counter()
+            response = await client.post("/webhook", json=data)
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    updates = [synthetic_update(i, 1000 + i % args.users) for i in range(args.updates)]
+    # Telegram redelivers when it does not see a timely 200; replay a share of updates
+    updates += updates[:int(len(updates) * args.duplicates)]
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bot") as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(send(client, data) for data in updates))
+        acked = time.perf_counter() - started
+        await bot.update_ingestor.stop(timeout=300)
+        drained = time.perf_counter() - started
+
+    stats = bot.update_ingestor.stats()
+    print(
+        f"updates={len(updates)} statuses={statuses} ack_p50={percentile(latencies, 50) * 1000:.2f}ms "
+        f"ack_p99={percentile(latencies, 99) * 1000:.2f}ms acked_in={acked:.2f}s drained_in={drained:.2f}s"
+    )
+    print(
+        f"accepted={stats['accepted']} duplicates={stats['duplicates']} rejected={stats['rejected']} "
+        f"processed={stats['processed']} avg_queue={stats['avg_queue_seconds'] * 1000:.1f}ms"
+    )
+
+def user_update(update_id, user_id, text=None, callback_data=None):
+    chat = {"id": user_id, "type": "private", "first_name": "Bench"}
+    sender = {"id": user_id, "is_bot": False, "first_name": "Bench"}
+    if callback_data is not None:
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": sender,
+                "chat_instance": str(user_id),
+                "data": callback_data,
+                "message": {"message_id": update_id, "date": 0, "chat": chat, "text": "menu"},
+            },
+        }
+    return {
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": 0, "chat": chat, "from": sender, "text": text},
+    }
+
+DELIVERY_METHODS = ("sendPhoto", "sendMediaGroup")
+FAILURE_PREFIXES = ("❌", "⛔", "⏳ Generation queue", "⏳ The generation queue")
+OFFER_PREFIX = "♻️"
+
+async def run_e2e_child(args):
+    # Runs the real bot (PTB application, ingestor, scheduler, connector) in
+    # this process; Telegram and the GPU are the fakes named in the environment
+    import httpx
+    from keyboards import callback
+    import bot
+
+    telegram_url = os.environ["TELEGRAM_BASE_URL"].rsplit("/bot", 1)[0]
+    await bot.setup_application()
+    waiting = {}
+    transport = httpx.ASGITransport(app=bot.app)
+    update_ids = iter(range(1, 10 ** 9))
+
+    async def watch_deliveries(client):
+        # Matches what the fake Telegram saw to the user waiting for it
+        since = time.time()
+        while True:
+            response = await client.get(f"{telegram_url}/fake/events", params={"since": since})
+            for event in response.json()["events"]:
+                since = max(since, event["t"])
+                future = waiting.get(event["chat_id"])
+                if future is None or future.done():
+                    continue
+                if event["method"] in DELIVERY_METHODS:
+                    future.set_result((event["t"], True))
+                elif event["method"] == "editMessageText" and event["text"].startswith(FAILURE_PREFIXES):
+                    future.set_result((event["t"], False))
+                elif event["method"] == "editMessageText" and event["text"].startswith(OFFER_PREFIX):
+                    future.set_result((event["t"], None))
+            await asyncio.sleep(args.poll_interval)
+
+    latencies = []
+    failures = 0
+    offered = 0
+    reused = 0
+
+    async def press(client, user_id, data):
+        future = waiting[user_id] = asyncio.get_running_loop().create_future()
+        await client.post("/webhook", json=user_update(next(update_ids), user_id, callback_data=data))
+        try:
+            return await asyncio.wait_for(future, args.timeout)
+        except asyncio.TimeoutError:
+            return time.time(), False
+
+    async def user(client, user_id):
+        nonlocal failures, offered, reused
+        for round_number in range(args.rounds):
+            prompt = f"bench prompt {user_id} {round_number}" if args.distinct_prompts else "bench prompt"
+            await client.post("/webhook", json=user_update(next(update_ids), user_id, text=prompt))
+            for _ in range(args.taps):
+                # Rapid settings taps, each answered with an edit of the settings message
+                await client.post("/webhook", json=user_update(next(update_ids), user_id, callback_data=callback("steps", "inc")))
+            # The prompt and the button press are separate updates, as in a real chat
+            await asyncio.sleep(args.think_time)
+            started = time.time()
+            finished, ok = await press(client, user_id, callback("generate"))
+            if ok is None:
+                # A matching recent image was offered. Reuses never reach the GPU,
+                # so they are counted apart from generations and their latency
+                offered += 1
+                if args.accept_reuse:
+                    finished, ok = await press(client, user_id, callback("recent", "use"))
+                    reused += ok is True
+                    failures += ok is not True
+                    continue
+                started = time.time()
+                finished, ok = await press(client, user_id, callback("recent", "new"))
+            if ok:
+                latencies.append(finished - started)
+            else:
+                failures += 1
+            # Let the bot finish its status edits before the next round's button press
+            while user_id in bot.pending_generations:
+                await asyncio.sleep(0.01)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bot") as client, httpx.AsyncClient() as events:
+        watcher = asyncio.create_task(watch_deliveries(events))
+        started = time.perf_counter()
+        await asyncio.gather(*(user(client, 10000 + i) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+        watcher.cancel()
+        fake = (await events.get(f"{telegram_url}/fake/events", params={"since": time.time()})).json()
+    await bot.shutdown()
+
+    print(json.dumps({
+        "generations": len(latencies),
+        "failures": failures,
+        "offered": offered,
+        "reused": reused,
+        "elapsed": elapsed,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "telegram_calls": fake["calls"],
+        "flooded": fake["flooded"],
+        "outbound": bot.telegram_sender.stats(),
+        "journal": bot.job_journal.stats(),
+    }))
+
+async def run_e2e(args):
+    if args.child:
+        await run_e2e_child(args)
+        return
+    import fake_telegram
+    gpu, gpu_url = await spawn(
+        call_overhead=args.call_overhead, per_image=args.per_image,
+        per_megapixel_step=args.per_megapixel_step, jitter=args.jitter, failure_rate=args.failure_rate
+    )
+    telegram, telegram_url = await fake_telegram.spawn(latency=args.telegram_latency, chat_limit=args.telegram_chat_limit)
+    # The job journal stays on, in a scratch directory, so its cost is measured
+    journal_dir = tempfile.mkdtemp(prefix="bench-journal-")
+    env = dict(
+        os.environ, TELEGRAM_BOT_TOKEN="123456:bench", TELEGRAM_BASE_URL=f"{telegram_url}/bot",
+        GRADIO_API_URLS=",".join([gpu_url] * args.backends), RECENT_RESULTS_PATH="",
+        JOB_JOURNAL_PATH=os.path.join(journal_dir, "jobs.db")
+    )
+    env.update(setting.split("=", 1) for setting in args.set)
+    command = [
+        sys.executable, __file__, "e2e", "--child", "--users", str(args.users), "--rounds", str(args.rounds),
+        "--think-time", str(args.think_time), "--timeout", str(args.timeout),
+        "--poll-interval", str(args.poll_interval), "--taps", str(args.taps),
+    ] + (["--distinct-prompts"] if args.distinct_prompts else []) + (["--accept-reuse"] if args.accept_reuse else [])
+    try:
+        # A fresh interpreter reads the bot config from env and keeps peak RSS comparable
+        process = await asyncio.create_subprocess_exec(*command, env=env, stdout=subprocess.PIPE)
+        output, _ = await process.communicate()
+    finally:
+        for fake in (gpu, telegram):
+            fake.terminate()
+            await fake.wait()
+        shutil.rmtree(journal_dir, ignore_errors=True)
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    print(
+        f"users={args.users} rounds={args.rounds} generations={result['generations']} "
+        f"failures={result['failures']} elapsed={result['elapsed']:.2f}s "
+        f"throughput={result['generations'] / result['elapsed']:.2f} gen/s"
+    )
+    print(f"recent results: offered={result['offered']} reused={result['reused']} (not counted as generations)")
+    print(
+        f"latency p50={result['p50']:.2f}s p95={result['p95']:.2f}s p99={result['p99']:.2f}s "
+        f"peak_rss={result['max_rss_kb'] / 1e3:.1f}MB"
+    )
+    print(f"telegram calls: {result['telegram_calls']}")
+    outbound = result["outbound"]
+    print(
+        f"outbound: 429s={result['flooded']} coalesced={outbound['coalesced']} "
+        f"avg_queue={outbound['avg_queue_time'] * 1000:.0f}ms flood_failures={outbound['flood_failures']}"
+    )
+    journal = result["journal"]
+    print(f"journal: {journal['writes']} row writes in {journal['flushes']} flushes, sync={journal['sync']}")
+
+def import_seconds(module, env):
+    code = f"import time; started = time.perf_counter(); import {module}; print(time.perf_counter() - started)"
+    output = subprocess.run([sys.executable, "-c", code], env=env, check=True, capture_output=True, text=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+async def time_boot(entry, env, telegram_url, chat_id):
+    # Seconds from spawning the process until the socket accepts, the first
+    # webhook is acknowledged and the reply to it reaches Telegram
+    import httpx
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    update = user_update(chat_id, chat_id, text="/start")
+    update["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": 6}]
+    started = time.time()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, entry, env=dict(env, PORT=str(port)),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    listening = acked = handled = None
+    try:
+        while listening is None:
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.close()
+                listening = time.time()
+            except OSError:
+                await asyncio.sleep(0.002)
+        async with httpx.AsyncClient(timeout=30) as client:
+            while acked is None:
+                # Held by the bot until it is initialized, then answered
+                response = await client.post(f"http://127.0.0.1:{port}/webhook", json=update)
+                if response.status_code == 200:
+                    acked = time.time()
+                else:
+                    await asyncio.sleep(0.005)
+            while handled is None:
+                events = (await client.get(f"{telegram_url}/fake/events", params={"since": started})).json()["events"]
+                replies = [event["t"] for event in events if event["method"] == "sendMessage" and event["chat_id"] == chat_id]
+                if replies:
+                    handled = replies[0]
+                await asyncio.sleep(0.005)
+    finally:
+        process.terminate()
+        await process.wait()
+    return listening - started, acked - started, handled - started
+
+async def run_startup(args):
+    import httpx
+    import fake_telegram
+    telegram, telegram_url = await fake_telegram.spawn(latency=args.telegram_latency)
+    env = dict(
+        os.environ, TELEGRAM_BOT_TOKEN="123456:bench", TELEGRAM_BASE_URL=f"{telegram_url}/bot",
+        WEBHOOK_URL="https://bench.invalid", GRADIO_API_URLS="http://127.0.0.1:9", RECENT_RESULTS_PATH="",
+        JOB_JOURNAL_PATH=""
+    )
+    try:
+        for module in ("boot", "bot"):
+            samples = [import_seconds(module, env) for _ in range(args.repeats)]
+            print(f"import {module:<5} median={percentile(samples, 50) * 1000:7.1f}ms")
+        chat_ids = iter(range(1, 10 ** 6))
+        for entry in ("bot.py", "boot.py"):
+            # The first run of each sets the webhook; later ones find it already set
+            for run in range(args.repeats):
+                listening, acked, handled = await time_boot(entry, env, telegram_url, next(chat_ids))
+                print(
+                    f"{entry:<8} run={run} listening={listening * 1000:7.1f}ms "
+                    f"first_ack={acked * 1000:7.1f}ms first_handled={handled * 1000:7.1f}ms"
+                )
+        async with httpx.AsyncClient() as client:
+            calls = (await client.get(f"{telegram_url}/fake/events", params={"since": time.time()})).json()["calls"]
+        print(f"getWebhookInfo={calls.get('getWebhookInfo', 0)} setWebhook={calls.get('setWebhook', 0)}")
+    finally:
+        telegram.terminate()
+        await telegram.wait()
+
+LEGACY_ROUTES = [
+    ("generate", None), ("variations", None), ("draft:refine", None), ("draft:discard", "main"),
+    ("variation:", None), ("menu:quality", "quality"), ("menu:size", "size"), ("menu:advanced", "advanced"),
+    ("menu:sampler", "sampler"), ("menu:scheduler", "scheduler"), ("menu:delivery", "delivery"),
+    ("view_settings", "main"), ("quality:", "main"), ("size:", "main"), ("sampler:", "advanced"),
+    ("scheduler:", "advanced"), ("delivery:", "delivery"), ("steps:inc", "advanced"), ("steps:dec", "advanced"),
+    ("cfg:inc", "advanced"), ("cfg:dec", "advanced"), ("back:main", "main"), ("back:advanced", "advanced"),
+    ("custom:steps", None), ("custom:cfg", None), ("custom:width", None), ("custom:height", None),
+    ("custom:seed", None), ("custom:negative", None), ("toggle:restore_faces", "advanced"),
+    ("toggle:draft_mode", "advanced"), ("toggle:tiling", "advanced"),
+]
+
+def legacy_keyboard(kind):
+    # Builds markups from scratch on every call, as keyboards.py did before caching
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    from config import QUALITY_PRESETS, PRESET_SIZES, SAMPLERS, SCHEDULERS
+    from transcode import DELIVERY_FORMATS
+
+    def choices(prefix, values, back):
+        rows = []
+        for i in range(0, len(values), 2):
+            rows.append([InlineKeyboardButton(v, callback_data=f"{prefix}:{v}") for v in values[i:i + 2]])
+        rows.append([InlineKeyboardButton("« Back", callback_data=back)])
+        return InlineKeyboardMarkup(rows)
+
+    if kind == "sampler":
+        return choices("sampler", SAMPLERS, "back:advanced")
+    if kind == "scheduler":
+        return choices("scheduler", SCHEDULERS, "back:advanced")
+    if kind == "quality":
+        return choices("quality", list(QUALITY_PRESETS), "back:main")
+    if kind == "size":
+        return choices("size", list(PRESET_SIZES), "back:main")
+    if kind == "delivery":
+        return choices("delivery", list(DELIVERY_FORMATS) + ["original"], "back:main")
+    labels = ["Generate", "Variations", "Quality", "Size", "Advanced", "Settings", "Delivery"]
+    if kind == "advanced":
+        labels = ["Sampler", "Scheduler", "-5", "+5", "Custom", "-0.5", "+0.5", "Custom", "Seed", "Negative",
+                  "Faces", "Tiling", "Draft", "Back"]
+    return InlineKeyboardMarkup([[InlineKeyboardButton(label, callback_data=label)] for label in labels])
+
+def legacy_route(data):
+    for pattern, kind in LEGACY_ROUTES:
+        if pattern.endswith(":") and data.startswith(pattern):
+            data.replace(pattern, "")
+            return legacy_keyboard(kind) if kind else None
+        if data == pattern:
+            return legacy_keyboard(kind) if kind else None
+    return None
+
+def compact_route(data, routes, keyboards):
+    action, arg = keyboards.decode_callback(data)
+    routes[action]
+    if action == "menu" and arg in ("sampler", "scheduler"):
+        return keyboards.get_sampler_keyboard("Euler a") if arg == "sampler" else keyboards.get_scheduler_keyboard("Automatic")
+    if action == "menu" and arg == "delivery" or action == "delivery":
+        return keyboards.get_delivery_keyboard("png", False)
+    if action in ("sampler", "scheduler", "steps", "cfg", "toggle") or (action, arg) == ("back", "advanced"):
+        return keyboards.get_advanced_keyboard()
+    return keyboards.get_main_menu_keyboard()
+
+class BenchQuery:
+    def __init__(self, data):
+        self.data = data
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def edit_message_text(self, text, reply_markup=None):
+        pass
+
+async def run_callbacks(args):
+    import types
+    import bot
+    import keyboards
+
+    # Settings and navigation presses; generation buttons are left out because they start jobs
+    legacy_data = [p + ("Euler a" if p == "sampler:" else "Karras" if p == "scheduler:" else
+                        "Fast (10 steps)" if p == "quality:" else "Square 512x512" if p == "size:" else
+                        "webp" if p == "delivery:" else "")
+                   for p, _ in LEGACY_ROUTES if not p.startswith(("generate", "variation", "draft:refine"))]
+    compact_data = [button.callback_data
+                    for markup in (keyboards.MAIN_MENU_KEYBOARD, keyboards.ADVANCED_KEYBOARD,
+                                   keyboards.QUALITY_KEYBOARD, keyboards.SIZE_KEYBOARD,
+                                   keyboards.get_sampler_keyboard(), keyboards.get_scheduler_keyboard(),
+                                   keyboards.get_delivery_keyboard("png", False))
+                    for row in markup.inline_keyboard for button in row
+                    if keyboards.decode_callback(button.callback_data)[0] not in ("generate", "variations")]
+    from config import SAMPLERS
+    longest_legacy = max(len(f"sampler:{sampler}".encode()) for sampler in SAMPLERS)
+    print(f"longest callback_data: legacy={longest_legacy}B "
+          f"compact={max(len(d.encode()) for d in compact_data)}B")
+
+    routes = (
+        ("legacy", lambda data: legacy_route(data), legacy_data),
+        ("compact", lambda data: compact_route(data, bot.CALLBACK_ROUTES, keyboards), compact_data),
+    )
+    for name, route, data in routes:
+        started = time.perf_counter()
+        for i in range(args.presses):
+            route(data[i % len(data)])
+        elapsed = time.perf_counter() - started
+        print(f"{name:<8} routing+keyboard: {args.presses / elapsed:10.0f} presses/s "
+              f"({elapsed / args.presses * 1e6:6.2f}us each)")
+
+    # The whole handler with the session lookup, minus the Telegram round trip
+    user = types.SimpleNamespace(id=1)
+    updates = [types.SimpleNamespace(callback_query=BenchQuery(d), effective_user=user) for d in compact_data]
+    started = time.perf_counter()
+    for i in range(args.presses):
+        await bot.button_callback(updates[i % len(updates)], None)
+    elapsed = time.perf_counter() - started
+    print(f"button_callback end to end: {args.presses / elapsed:10.0f} presses/s "
+          f"({elapsed / args.presses * 1e6:6.2f}us each)")
+
+async def run_conversations(args):
+    import random
+    from conversation_store import LocalConversationStore, SharedConversations
+
+    # Several instances share custom-input state through the local stand-in
+    # store. Each user's updates land on a random instance, as on Cloud Run.
+    for cache_ttl in (0.0, args.cache_ttl):
+        store = LocalConversationStore(latency=args.store_latency)
+        instances = [SharedConversations(store, cache_ttl=cache_ttl) for _ in range(args.instances)]
+        for instance in instances:
+            await instance.start()
+        rng = random.Random(1)
+        waits = []
+        wrong = 0
+
+        async def lookup(key):
+            # What process_update and the ConversationHandler do for one update
+            instance = rng.choice(instances)
+            started = time.perf_counter()
+            await instance.prefetch(key)
+            waits.append(time.perf_counter() - started)
+            return instance, instance.get(key)
+
+        async def user(user_id):
+            nonlocal wrong
+            key = (user_id, user_id)
+            for _ in range(args.rounds):
+                _, state = await lookup(key)
+                wrong += state is not None
+                if rng.random() < args.custom_share:
+                    # Custom steps: the button press enters the state, the typed reply ends it
+                    instance, _ = await lookup(key)
+                    instance[key] = 0
+                    await asyncio.sleep(args.think_time)
+                    instance, state = await lookup(key)
+                    wrong += state != 0
+                    instance.pop(key, None)
+                await asyncio.sleep(args.think_time)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user(10000 + i) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+        for instance in instances:
+            await instance.close()
+        loads = sum(instance.metrics["loads"] for instance in instances)
+        print(
+            f"cache_ttl={cache_ttl:>4}s lookups={len(waits)} store_loads={loads} "
+            f"({loads / len(waits):.0%}) wrong_state={wrong} "
+            f"prefetch p50={percentile(waits, 50) * 1000:.2f}ms p99={percentile(waits, 99) * 1000:.2f}ms "
+            f"elapsed={elapsed:.2f}s"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks against a fake Automatic1111 backend")
+    sub = parser.add_subparsers(dest="scenario", required=True)
+
+    batching = sub.add_parser("batching", help="throughput with and without micro-batching")
+    batching.add_argument("--requests", type=int, default=32)
+    batching.add_argument("--users", type=int, default=8)
+    batching.add_argument("--workers", type=int, default=1)
+    batching.add_argument("--max-batch", type=int, default=4)
+    batching.add_argument("--window", type=float, default=0.05)
+    batching.add_argument("--call-overhead", type=float, default=0.2)
+    batching.add_argument("--per-image", type=float, default=0.05)
+    batching.set_defaults(func=run_batching)
+
+    memory = sub.add_parser("memory", help="peak memory of many concurrent large images")
+    memory.add_argument("--concurrency", type=int, default=16)
+    memory.add_argument("--size", type=int, default=1024)
+    memory.add_argument("--mode", choices=["legacy", "streaming"])
+    memory.set_defaults(func=run_memory)
+
+    webhook = sub.add_parser("webhook", help="ack latency of the /webhook route under a burst of updates")
+    webhook.add_argument("--updates", type=int, default=5000)
+    webhook.add_argument("--users", type=int, default=500)
+    webhook.add_argument("--concurrency", type=int, default=200)
+    webhook.add_argument("--duplicates", type=float, default=0.05)
+    webhook.add_argument("--handler-time", type=float, default=0.02)
+    webhook.set_defaults(func=run_webhook)
+
+    e2e = sub.add_parser("e2e", help="generations through /webhook with fake Telegram and GPU backends")
+    e2e.add_argument("--users", type=int, default=16)
+    e2e.add_argument("--rounds", type=int, default=3)
+    e2e.add_argument("--backends", type=int, default=1, help="connections to the fake GPU (it still renders one at a time)")
+    e2e.add_argument("--think-time", type=float, default=0.05)
+    e2e.add_argument("--timeout", type=float, default=300)
+    e2e.add_argument("--poll-interval", type=float, default=0.02)
+    e2e.add_argument("--distinct-prompts", action="store_true")
+    e2e.add_argument("--accept-reuse", action="store_true", help="take offered recent images instead of regenerating")
+    e2e.add_argument("--call-overhead", type=float, default=0.1)
+    e2e.add_argument("--per-image", type=float, default=0.0)
+    e2e.add_argument("--per-megapixel-step", type=float, default=0.01)
+    e2e.add_argument("--jitter", type=float, default=0.1)
+    e2e.add_argument("--failure-rate", type=float, default=0.0)
+    e2e.add_argument("--telegram-latency", type=float, default=0.0)
+    e2e.add_argument("--telegram-chat-limit", type=int, default=0, help="calls per chat per second the fake allows before 429s")
+    e2e.add_argument("--taps", type=int, default=0, help="steps:inc presses sent before each generation")
+    e2e.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="bot setting for this run")
+    e2e.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    e2e.set_defaults(func=run_e2e)
+
+    startup = sub.add_parser("startup", help="import time and time to the first handled update on a cold start")
+    startup.add_argument("--repeats", type=int, default=3)
+    startup.add_argument("--telegram-latency", type=float, default=0.05, help="simulated Bot API round trip")
+    startup.set_defaults(func=run_startup)
+
+    callbacks = sub.add_parser("callbacks", help="callback query routing and keyboard throughput")
+    callbacks.add_argument("--presses", type=int, default=100000)
+    callbacks.set_defaults(func=run_callbacks)
+
+    conversations = sub.add_parser("conversations", help="custom-input state shared between instances")
+    conversations.add_argument("--instances", type=int, default=3)
+    conversations.add_argument("--users", type=int, default=200)
+    conversations.add_argument("--rounds", type=int, default=10)
+    conversations.add_argument("--custom-share", type=float, default=0.2, help="rounds that go through a custom-input prompt")
+    conversations.add_argument("--think-time", type=float, default=0.05)
+    conversations.add_argument("--store-latency", type=float, default=0.002, help="simulated round trip to the shared store")
+    conversations.add_argument("--cache-ttl", type=float, default=30)
+    conversations.set_defaults(func=run_conversations)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(args.func(args))
+
+if __name__ == "__main__":
+    main()
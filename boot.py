@@ -0,0 +1,120 @@
+import asyncio
+import importlib
+import json
+import logging
+import os
+import time
+import uvicorn
+from config import BOOT_BUFFER_MAX
+
+# Cold-start entry point. Importing bot.py pulls in FastAPI and
+# python-telegram-bot, which takes most of a second before uvicorn could even
+# bind. This raw ASGI app only needs uvicorn, so the socket is up (and the
+# platform's startup probe passes) right away. That is all it speeds up: the
+# import and initialization still take as long, so the first update is handled
+# no sooner than with bot.py. Webhooks that arrive meanwhile are held
+# unanswered and passed on to bot.app once it is imported; bot.app holds them
+# until initialization ends and answers 503 if it failed, so Telegram
+# redelivers instead of an update being acknowledged and lost.
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+async def _respond(send, status, body):
+    data = json.dumps(body).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(data)).encode())],
+    })
+    await send({"type": "http.response.body", "body": data})
+
+class BootApp:
+    def __init__(self, module="bot", buffer_max=BOOT_BUFFER_MAX):
+        self.module_name = module
+        self.buffer_max = buffer_max
+        self.bot = None
+        self.app = None
+        self.error = None
+        self.held = 0
+        self._imported = None
+        self._boot_task = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif self.app is not None:
+            await self.app(scope, receive, send)
+        elif scope["type"] == "http":
+            await self._booting(scope, receive, send)
+
+    async def _booting(self, scope, receive, send):
+        if scope["method"] != "POST" or scope["path"] != "/webhook" or self.error is not None:
+            status = "failed" if self.error is not None else "initializing"
+            await _respond(send, 503, {"status": status, "held": self.held})
+            return
+        if self.held >= self.buffer_max:
+            # Telegram redelivers on a 503
+            await _respond(send, 503, {"ok": False, "error": "Busy"})
+            return
+        # The body stays unread, so the request passes on to bot.app as it came
+        self.held += 1
+        try:
+            await self._imported.wait()
+        finally:
+            self.held -= 1
+        if self.app is None:
+            await _respond(send, 503, {"ok": False, "error": "Bot not ready"})
+            return
+        await self.app(scope, receive, send)
+
+    async def _boot(self):
+        started = time.perf_counter()
+        try:
+            # The import runs on a thread so the loop keeps accepting connections
+            self.bot = await asyncio.to_thread(importlib.import_module, self.module_name)
+        except BaseException as e:
+            self.error = e
+            raise
+        finally:
+            self._imported.set()
+        imported = time.perf_counter()
+        self.app = self.bot.app
+        await self.bot.initialize()
+        self.error = self.bot.setup_error
+        if self.error is None:
+            logger.info(
+                f"Boot: import {(imported - started) * 1000:.0f}ms, "
+                f"init {(time.perf_counter() - imported) * 1000:.0f}ms"
+            )
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self._imported = asyncio.Event()
+                self._boot_task = asyncio.create_task(self._boot())
+                self._boot_task.add_done_callback(self._boot_done)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self._boot_task is not None and not self._boot_task.done():
+                    self._boot_task.cancel()
+                    await asyncio.gather(self._boot_task, return_exceptions=True)
+                if self.bot is not None:
+                    await self.bot.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _boot_done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Importing {self.module_name} failed: {task.exception()}")
+
+app = BootApp()
+
+if __name__ == "__main__":
+    port = int(os.getenv("PORT", "8080"))
+    logger.info(f"Booting on port {port}")
+    uvicorn.run(app, host="0.0.0.0", port=port)
@@ -1,15 +1,43 @@
+import asyncio
+import json
 import logging
+import math
 import os
-from telegram import Update
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+from telegram import Update, InputMediaPhoto, InputFile
+from telegram.error import BadRequest
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes, ConversationHandler
-from config import TELEGRAM_BOT_TOKEN, QUALITY_PRESETS, PRESET_SIZES
-from user_sessions import get_or_create_session
+from conversation_store import SharedConversationHandler, create_conversations, conversation_key
+from config import (
+    TELEGRAM_BOT_TOKEN, TELEGRAM_BASE_URL, TELEGRAM_RATE_LIMIT, QUALITY_PRESETS, PRESET_SIZES, GENERATION_BATCH_PROMPT_LISTS,
+    PROGRESS_EDIT_INTERVAL, VARIATIONS_COUNT, VARIATIONS_BATCH_SIZE, VARIATIONS_DELIVERY,
+    SESSION_MAX_ENTRIES, SESSION_REDIS_URL, CONVERSATION_STORE, DRAFT_STEPS, DRAFT_MAX_SIDE, DRAFT_REFINE, DRAFT_HR_UPSCALER,
+    DRAFT_DENOISING_STRENGTH, MAX_IMAGE_SIDE, MAX_STEPS, WEBHOOK_STATE_PATH, WEBHOOK_RECHECK_INTERVAL
+)
+from user_sessions import get_or_create_session, session_manager
 from keyboards import (
     get_main_menu_keyboard, get_quality_keyboard, get_size_keyboard,
-    get_advanced_keyboard, get_sampler_keyboard, get_scheduler_keyboard
+    get_advanced_keyboard, get_sampler_keyboard, get_scheduler_keyboard,
+    get_delivery_keyboard, get_variations_keyboard, get_draft_keyboard, get_img2img_keyboard,
+    get_recent_keyboard, decode_callback
 )
 from gradio_connector import GradioConnector
+from scheduler import GenerationScheduler, QueueFullError
+from result_cache import ResultCache
+from transcode import Transcoder, DELIVERY_FORMATS
+from singleflight import SingleFlight
+from source_images import SourceImageCache
+from recent_results import RecentResults
+from job_journal import JobJournal, DELIVERED, FAILED
+from ingest import UpdateIngestor
+from outbound import SendScheduler
+from admission import AdmissionController, BudgetExceededError, job_cost
+import metrics
+from metrics import WEBHOOK_SECONDS, SEND_PHOTO_SECONDS, ERRORS
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 import uvicorn
 
 logging.basicConfig(
@@ -20,7 +48,387 @@ logger = logging.getLogger(__name__)
 
 gradio_client = GradioConnector()
 
-WAITING_STEPS, WAITING_CFG, WAITING_WIDTH, WAITING_HEIGHT, WAITING_SEED, WAITING_NEGATIVE = range(6)
+async def run_generation(params_list, on_progress=None):
+    return await gradio_client.generate_batch(
+        params_list, prompt_lists=GENERATION_BATCH_PROMPT_LISTS, on_progress=on_progress
+    )
+
+def generation_batch_key(params):
+    return GradioConnector.batch_key(params, prompt_lists=GENERATION_BATCH_PROMPT_LISTS)
+
+generation_scheduler = GenerationScheduler(run_generation, batch_key=generation_batch_key)
+result_cache = ResultCache()
+generation_flights = SingleFlight()
+admission = AdmissionController()
+transcoder = Transcoder()
+source_images = SourceImageCache(transcoder)
+# Keyed by the loaded checkpoint, so an image from one model is never offered for another
+recent_results = RecentResults(model=lambda: gradio_client.capabilities.model())
+job_journal = JobJournal()
+pending_generations = set()
+generation_tasks = set()
+progress_last_edit = {}
+# user_id -> (params, seeds) of the last variations, for re-rendering one of them
+variation_runs = OrderedDict()
+# user_id -> (full params, draft params, seed) of the last draft awaiting refine/discard
+draft_runs = OrderedDict()
+# user_id -> (params, file_id) of a recent result offered instead of a new render
+recent_offers = OrderedDict()
+
+def queue_status_text(position, eta):
+    if position == 0:
+        return "🎨 Generating your image... This may take a moment."
+    return (
+        f"⏳ You are #{position} in the queue.\n"
+        f"Estimated wait: ~{int(eta)}s"
+    )
+
+def budget_text(user_id):
+    return f"Credits left: {admission.remaining(user_id):.1f}/{admission.user_capacity:.0f}"
+
+def progress_text(progress, eta):
+    percent = max(0, min(100, int(progress * 100)))
+    filled = percent // 10
+    return (
+        f"🎨 Generating your image... {percent}%\n"
+        f"{'▓' * filled}{'░' * (10 - filled)}\n"
+        f"ETA: ~{int(eta)}s"
+    )
+
+def generation_caption(params):
+    # Refined drafts report the size and steps of the upscaling pass
+    final = params.get("hires") or params
+    return (
+        f"Prompt: {params['prompt']}\n"
+        f"Steps: {final['steps']}, CFG: {params['cfg_scale']}, "
+        f"Size: {final['width']}x{final['height']}"
+    )
+
+def image_file(image, attach=False):
+    # Streams the shared buffer to Telegram instead of reading it into a new bytes object
+    return InputFile(image.open(), filename=image.name, attach=attach, read_file_handle=False)
+
+def variations_params(params):
+    batch_size = max(1, min(VARIATIONS_BATCH_SIZE, VARIATIONS_COUNT))
+    return {**params, "batch_size": batch_size, "n_iter": math.ceil(VARIATIONS_COUNT / batch_size)}
+
+async def deliver_image(context, user_id, session, params, image, cache_key=None):
+    # Returns the Telegram file_id of the delivered photo, when there is one
+    upload = await transcoder.transcode(image, session.delivery_format)
+    with SEND_PHOTO_SECONDS.time():
+        message = await context.bot.send_photo(
+            chat_id=user_id,
+            photo=image_file(upload),
+            caption=generation_caption(params)
+        )
+    if cache_key is not None and message.photo:
+        result_cache.set_file_id(cache_key, message.photo[-1].file_id, len(image))
+    if session.attach_original:
+        await context.bot.send_document(chat_id=user_id, document=image_file(image), caption="Lossless original")
+    return message.photo[-1].file_id if message.photo else None
+
+async def deliver_variations(context, user_id, session, params, images):
+    caption = generation_caption(params)
+    if VARIATIONS_DELIVERY == "grid":
+        sheet = await transcoder.contact_sheet(images)
+        if sheet is not None:
+            with SEND_PHOTO_SECONDS.time():
+                await context.bot.send_photo(chat_id=user_id, photo=image_file(sheet), caption=caption)
+            return
+    uploads = await asyncio.gather(*(transcoder.transcode(image, session.delivery_format) for image in images))
+    media = [
+        InputMediaPhoto(image_file(upload, attach=True), caption=caption if i == 0 else None)
+        for i, upload in enumerate(uploads)
+    ]
+    with SEND_PHOTO_SECONDS.time():
+        await context.bot.send_media_group(chat_id=user_id, media=media)
+
+def remember_run(runs, user_id, run):
+    runs[user_id] = run
+    runs.move_to_end(user_id)
+    while len(runs) > SESSION_MAX_ENTRIES:
+        runs.popitem(last=False)
+
+def draft_params(params):
+    # Same prompt, sampler and aspect ratio at a fraction of the steps and pixels
+    scale = min(1.0, DRAFT_MAX_SIDE / max(params["width"], params["height"]))
+    return {
+        **params,
+        "steps": min(params["steps"], DRAFT_STEPS),
+        "width": max(64, int(params["width"] * scale) // 64 * 64),
+        "height": max(64, int(params["height"] * scale) // 64 * 64),
+    }
+
+def refine_params(params, draft, seed):
+    if seed is None:
+        return params
+    if DRAFT_REFINE != "hires" or (draft["width"], draft["height"]) == (params["width"], params["height"]):
+        return {**params, "seed": seed}
+    # Rerun the draft exactly, then upscale it with a full-step second pass
+    return {
+        **draft,
+        "seed": seed,
+        "hires": {
+            "width": params["width"],
+            "height": params["height"],
+            "steps": params["steps"],
+            "upscaler": DRAFT_HR_UPSCALER,
+            "denoising_strength": DRAFT_DENOISING_STRENGTH,
+        },
+    }
+
+def photo_ref(message):
+    # Photos arrive in several sizes, largest last; uncompressed images come as documents
+    if message.photo:
+        photo = message.photo[-1]
+    elif message.document and (message.document.mime_type or "").startswith("image/"):
+        photo = message.document
+    else:
+        return None
+    return {"file_id": photo.file_id, "file_unique_id": photo.file_unique_id}
+
+async def img2img_params(context, session, params):
+    # Source and mask are fitted to the session size, so the backend renders
+    # exactly what was asked for and never receives a full-resolution upload
+    width, height = params["width"], params["height"]
+    source = {
+        "denoising_strength": session.denoising_strength,
+        "image": await source_images.fitted(context.bot, session.init_image, width, height),
+        "mask": None,
+    }
+    if session.mask_image:
+        source["mask"] = await source_images.fitted(context.bot, session.mask_image, width, height, mask=True)
+    return {**params, "img2img": source}
+
+def img2img_text(session):
+    return (
+        f"🖼 Photo ready for editing.\n\n"
+        f"Prompt: {session.prompt or '(none, send one as text)'}\n"
+        f"Denoising strength: {session.denoising_strength:.2f} (higher changes more)\n"
+        f"Inpaint mask: {'set, only the white area is repainted' if session.mask_image else 'none'}\n"
+        f"Output size: {session.width}x{session.height}"
+    )
+
+async def offer_refine(query, context, user_id, params, draft, seed):
+    remember_run(draft_runs, user_id, (params, draft, seed))
+    await query.edit_message_text(f"✅ Draft ready!\n\n{budget_text(user_id)}")
+    await context.bot.send_message(
+        chat_id=user_id,
+        text=(
+            f"Draft: {draft['steps']} steps at {draft['width']}x{draft['height']}, seed {seed if seed is not None else 'unknown'}.\n"
+            f"Refine renders it at {params['steps']} steps and {params['width']}x{params['height']}."
+        ),
+        reply_markup=get_draft_keyboard()
+    )
+
+async def send_cached_result(context, user_id, session, params, cache_key):
+    file_id, cached = await result_cache.lookup(cache_key)
+    if file_id is not None:
+        try:
+            await context.bot.send_photo(chat_id=user_id, photo=file_id, caption=generation_caption(params))
+            if session.attach_original:
+                original = await result_cache.peek(cache_key)
+                if original is not None:
+                    await context.bot.send_document(chat_id=user_id, document=image_file(original), caption="Lossless original")
+            return True
+        except BadRequest as e:
+            logger.warning(f"Cached file_id rejected, falling back to bytes: {e}")
+            result_cache.forget_file_id(cache_key)
+            file_id, cached = await result_cache.lookup(cache_key)
+    if cached is None:
+        return False
+    await deliver_image(context, user_id, session, params, cached, cache_key)
+    return True
+
+async def deliver_result(query, context, user_id, session, mode, full_params, params, image, cache_key=None):
+    if mode == "variations":
+        await deliver_variations(context, user_id, session, params, image)
+        remember_run(variation_runs, user_id, (params, [variation.seed for variation in image]))
+        seeds = ", ".join(f"#{i + 1}: {seed}" for i, seed in enumerate(variation_runs[user_id][1]))
+        await query.edit_message_text(f"✅ {len(image)} variations generated!\n\n{budget_text(user_id)}")
+        await context.bot.send_message(
+            chat_id=user_id,
+            text=f"Seeds: {seeds}\n\nPick one to render it on its own at full quality.",
+            reply_markup=get_variations_keyboard(len(image))
+        )
+        return
+    
+    file_id = await deliver_image(context, user_id, session, params, image, cache_key)
+    if mode == "image" and file_id and not params.get("hires"):
+        recent_results.record(params, file_id, image.seed)
+    
+    if mode == "draft":
+        seed = params["seed"] if params["seed"] != -1 else image.seed
+        await offer_refine(query, context, user_id, full_params, params, seed)
+        return
+    
+    await query.edit_message_text(
+        "✅ Image generated successfully!\n\n"
+        f"{budget_text(user_id)}\n"
+        "Send another prompt to generate more images.",
+        reply_markup=None
+    )
+
+def status_message_id(query):
+    message = getattr(query, "message", None)
+    return message.message_id if message is not None else None
+
+async def handle_generate(query, context, user_id, session, mode="image", params=None):
+    if not gradio_client.is_available:
+        await query.edit_message_text(
+            "❌ Image generation is not configured yet.\n\n"
+            "To enable image generation:\n"
+            "1. Set up your Stable Diffusion API (e.g., Google Colab)\n"
+            "2. Add GRADIO_API_URL to Cloud Run environment variables\n"
+            "3. Redeploy your bot\n\n"
+            "The bot works for everything else!",
+            reply_markup=get_main_menu_keyboard()
+        )
+        return
+    
+    variations = mode == "variations"
+    full_params = params or session.get_params()
+    params = full_params
+    if variations:
+        params = variations_params(params)
+    elif mode == "draft":
+        params = draft_params(params)
+    elif mode == "img2img" and not session.init_image:
+        await query.edit_message_text("Send me a photo first to edit it.", reply_markup=get_main_menu_keyboard())
+        return
+    
+    # Settings the backend would reject are caught here instead of after a round trip
+    problems = gradio_client.capabilities.validate(params)
+    if problems:
+        await query.edit_message_text(
+            "⚠️ These settings can't be rendered:\n• " + "\n• ".join(problems) +
+            "\n\nAdjust them and try again.",
+            reply_markup=get_main_menu_keyboard()
+        )
+        return
+    
+    # A fixed seed makes the payload fully determine the image; edits also
+    # depend on the photo, so they are never served from the cache
+    cache_key = None
+    if params["seed"] != -1 and not variations and mode != "img2img":
+        cache_key = result_cache.key_for(gradio_client.build_payload(**params))
+        if await send_cached_result(context, user_id, session, params, cache_key):
+            logger.info(f"Served generation from cache for user {user_id}")
+            if mode == "draft":
+                await offer_refine(query, context, user_id, full_params, params, params["seed"])
+                return
+            await query.edit_message_text(
+                "✅ Image generated successfully!\n\n"
+                "Send another prompt to generate more images.",
+                reply_markup=None
+            )
+            return
+    
+    async def on_position(position, eta):
+        await query.edit_message_text(queue_status_text(position, eta))
+    
+    preview_message = None
+    last_progress_text = None
+    
+    async def on_progress(progress, eta, preview):
+        nonlocal preview_message, last_progress_text
+        # Telegram throttles edits per chat, so drop updates that come too fast
+        now = time.monotonic()
+        if now - progress_last_edit.get(user_id, 0) < PROGRESS_EDIT_INTERVAL:
+            return
+        progress_last_edit[user_id] = now
+        text = progress_text(progress, eta)
+        if text != last_progress_text:
+            last_progress_text = text
+            await query.edit_message_text(text)
+        if preview is not None:
+            if preview_message is None:
+                preview_message = await context.bot.send_photo(chat_id=user_id, photo=preview, caption="Preview")
+            else:
+                await preview_message.edit_media(InputMediaPhoto(preview, caption="Preview"))
+    
+    async def run_job():
+        nonlocal params
+        # Only the job that actually reaches the GPU is charged; cache hits and
+        # coalesced duplicates are free
+        if mode == "img2img":
+            await query.edit_message_text("📥 Preparing your photo...")
+            params = await img2img_params(context, session, params)
+        ticket = admission.admit(user_id, params)
+        try:
+            job = generation_scheduler.submit(
+                user_id, params, on_position=on_position, on_progress=on_progress,
+                low_priority=ticket.deferred
+            )
+            if job.queued:
+                text = queue_status_text(job.last_position, generation_scheduler.eta(job.last_position))
+                if ticket.deferred:
+                    text += "\nThe GPU is busy, so this large job will run after smaller ones."
+                await query.edit_message_text(text)
+            else:
+                await query.edit_message_text(queue_status_text(0, 0))
+            image = await job.future
+        except BaseException:
+            admission.release(ticket, refund=True)
+            raise
+        admission.release(ticket)
+        if cache_key is not None:
+            await result_cache.put(cache_key, image)
+        return image
+    
+    # The journal keeps the settings, not the photo buffers img2img adds later
+    job_id = job_journal.begin(user_id, user_id, status_message_id(query), mode, full_params)
+    try:
+        if cache_key is None:
+            image = await run_job()
+        else:
+            if generation_flights.in_flight(cache_key):
+                await query.edit_message_text(
+                    "🎨 The same image is already being generated, you'll get it as soon as it's ready."
+                )
+            image = await generation_flights.do(cache_key, run_job)
+        
+        await job_journal.rendered(job_id, image if variations else [image])
+        await deliver_result(query, context, user_id, session, mode, full_params, params, image, cache_key)
+        job_journal.finish(job_id, DELIVERED)
+    
+    except BudgetExceededError as e:
+        job_journal.finish(job_id, FAILED)
+        await query.edit_message_text(
+            f"⛔ {e}",
+            reply_markup=get_main_menu_keyboard()
+        )
+    
+    except QueueFullError as e:
+        job_journal.finish(job_id, FAILED)
+        await query.edit_message_text(
+            f"⏳ {e}",
+            reply_markup=get_main_menu_keyboard()
+        )
+    
+    except Exception as e:
+        logger.error(f"Generation error: {e}")
+        ERRORS.inc("generate", type(e).__name__)
+        job_journal.finish(job_id, FAILED)
+        error_msg = str(e)
+        if len(error_msg) > 200:
+            error_msg = error_msg[:200] + "..."
+        
+        await query.edit_message_text(
+            f"❌ Generation failed: {error_msg}\n\n"
+            "Make sure your Colab is running and try again.",
+            reply_markup=get_main_menu_keyboard()
+        )
+    
+    finally:
+        progress_last_edit.pop(user_id, None)
+        if preview_message is not None:
+            try:
+                await preview_message.delete()
+            except Exception as e:
+                logger.debug(f"Could not delete preview message: {e}")
+
+WAITING_STEPS, WAITING_CFG, WAITING_WIDTH, WAITING_HEIGHT, WAITING_SEED, WAITING_NEGATIVE, WAITING_MASK = range(7)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message:
@@ -38,7 +446,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_id = update.effective_user.id
     prompt = update.message.text.strip()
     
-    session = get_or_create_session(user_id)
+    session = await get_or_create_session(user_id)
     session.prompt = prompt
     
     await update.message.reply_text(
@@ -51,257 +459,366 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         reply_markup=get_main_menu_keyboard()
     )
 
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    if not query or not update.effective_user or not query.data:
+async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_user or not update.message:
         return
-    await query.answer()
+    ref = photo_ref(update.message)
+    if ref is None:
+        return
+    session = await get_or_create_session(update.effective_user.id)
+    session.init_image = ref
+    session.mask_image = None
+    if update.message.caption:
+        session.prompt = update.message.caption.strip()
+    await update.message.reply_text(img2img_text(session), reply_markup=get_img2img_keyboard(False))
+
+def start_generation(query, context, user_id, session, mode="image", params=None):
+    # Generation runs detached from update processing so this user's later
+    # updates are not held behind it in the per-chat ingestion order
+    pending_generations.add(user_id)
     
-    user_id = update.effective_user.id
-    session = get_or_create_session(user_id)
-    data = query.data
+    async def run():
+        try:
+            await handle_generate(query, context, user_id, session, mode, params)
+        finally:
+            pending_generations.discard(user_id)
     
-    if data == "generate":
-        if not gradio_client.is_available:
-            await query.edit_message_text(
-                "❌ Image generation is not configured yet.\n\n"
-                "To enable image generation:\n"
-                "1. Set up your Stable Diffusion API (e.g., Google Colab)\n"
-                "2. Add GRADIO_API_URL to Cloud Run environment variables\n"
-                "3. Redeploy your bot\n\n"
-                "The bot works for everything else!",
-                reply_markup=get_main_menu_keyboard()
-            )
-            return
-        
-        await query.edit_message_text("🎨 Generating your image... This may take a moment.")
-        
+    task = asyncio.create_task(run())
+    generation_tasks.add(task)
+    task.add_done_callback(generation_tasks.discard)
+
+def advanced_text(session):
+    return (
+        f"Advanced Settings:\n\n"
+        f"Steps: {session.steps}\n"
+        f"CFG Scale: {session.cfg_scale}\n"
+        f"Sampler: {session.sampler}"
+    )
+
+def age_text(seconds):
+    if seconds < 90:
+        return "just now"
+    if seconds < 5400:
+        return f"{int(seconds // 60)} min ago"
+    return f"{int(seconds // 3600)} h ago"
+
+async def on_generate(query, context, user_id, session, arg):
+    params = session.get_params()
+    # Fixed seeds are served exactly by the result cache; this offers what a
+    # random seed already produced for the same prompt and settings
+    recent = recent_results.lookup(params) if params["seed"] == -1 else None
+    if recent is not None:
+        file_id, age, seed = recent
+        remember_run(recent_offers, user_id, (params, file_id))
+        await query.edit_message_text(
+            f"♻️ A matching image was generated {age_text(age)}"
+            f"{f' (seed {seed})' if seed is not None else ''}.\n\n"
+            "Use it right away, or regenerate a new one?",
+            reply_markup=get_recent_keyboard()
+        )
+        return
+    start_generation(query, context, user_id, session, "draft" if session.draft_mode else "image")
+
+async def on_variations(query, context, user_id, session, arg):
+    start_generation(query, context, user_id, session, "variations")
+
+async def on_recent(query, context, user_id, session, arg):
+    offer = recent_offers.pop(user_id, None)
+    if arg == "use" and offer is not None:
+        params, file_id = offer
         try:
-            params = session.get_params()
-            result = gradio_client.generate_image(
-                prompt=params["prompt"],
-                negative_prompt=params["negative_prompt"],
-                steps=params["steps"],
-                cfg_scale=params["cfg_scale"],
-                width=params["width"],
-                height=params["height"],
-                sampler=params["sampler"],
-                scheduler=params["scheduler"],
-                seed=params["seed"],
-                subseed=params["subseed"],
-                subseed_strength=params["subseed_strength"],
-                restore_faces=params["restore_faces"],
-                tiling=params["tiling"],
-                batch_size=params["batch_size"]
-            )
-            
-            await context.bot.send_photo(
-                chat_id=user_id,
-                photo=result,
-                caption=f"Prompt: {params['prompt']}\n"
-                        f"Steps: {params['steps']}, CFG: {params['cfg_scale']}, "
-                        f"Size: {params['width']}x{params['height']}"
-            )
-            
+            await context.bot.send_photo(chat_id=user_id, photo=file_id, caption=generation_caption(params))
+            recent_results.reuse(params)
             await query.edit_message_text(
-                "✅ Image generated successfully!\n\n"
-                "Send another prompt to generate more images.",
+                "✅ Here it is!\n\nSend another prompt to generate more images.",
                 reply_markup=None
             )
-            
-        except Exception as e:
-            logger.error(f"Generation error: {e}")
-            error_msg = str(e)
-            if len(error_msg) > 200:
-                error_msg = error_msg[:200] + "..."
-            
+            return
+        except BadRequest as e:
+            logger.warning(f"Recent file_id rejected, regenerating: {e}")
+            recent_results.forget(params)
+    start_generation(query, context, user_id, session, "draft" if session.draft_mode else "image")
+
+async def on_draft(query, context, user_id, session, arg):
+    if arg == "refine":
+        run = draft_runs.pop(user_id, None)
+        if run is None:
             await query.edit_message_text(
-                f"❌ Generation failed: {error_msg}\n\n"
-                "Make sure your Colab is running and try again.",
+                "This draft has expired, generate a new one to refine.",
                 reply_markup=get_main_menu_keyboard()
             )
-    
-    elif data == "menu:quality":
+            return
+        start_generation(query, context, user_id, session, params=refine_params(*run))
+    elif arg == "discard":
+        draft_runs.pop(user_id, None)
         await query.edit_message_text(
-            "Select a quality preset:",
-            reply_markup=get_quality_keyboard()
+            "🗑 Draft discarded. Adjust your settings or send a new prompt.",
+            reply_markup=get_main_menu_keyboard()
         )
-    
-    elif data == "menu:size":
+
+async def on_variation(query, context, user_id, session, arg):
+    run = variation_runs.get(user_id)
+    index = int(arg) if arg and arg.isdigit() else -1
+    if run is None or not 0 <= index < len(run[1]) or run[1][index] is None:
         await query.edit_message_text(
-            "Select image size:",
-            reply_markup=get_size_keyboard()
+            "These variations have expired, generate new ones to pick from.",
+            reply_markup=get_main_menu_keyboard()
         )
-    
-    elif data == "menu:advanced":
+        return
+    params, seeds = run
+    # A one-off render of the picked seed; the session keeps its own settings
+    # so later generations stay random
+    start_generation(
+        query, context, user_id, session, params={**params, "seed": seeds[index], "batch_size": 1, "n_iter": 1}
+    )
+
+async def on_img2img(query, context, user_id, session, arg):
+    if arg == "run":
+        if not session.prompt:
+            await query.edit_message_text(
+                "Send me a text prompt describing the result first.",
+                reply_markup=get_img2img_keyboard(bool(session.mask_image))
+            )
+            return
+        start_generation(query, context, user_id, session, "img2img")
+        return
+    if arg == "mask":
         await query.edit_message_text(
-            f"Advanced Settings:\n\n"
-            f"Steps: {session.steps}\n"
-            f"CFG Scale: {session.cfg_scale}\n"
-            f"Sampler: {session.sampler}",
-            reply_markup=get_advanced_keyboard()
+            "Send me a mask the same shape as your photo: white where the image should be "
+            "repainted, black where it should stay. /cancel to keep editing without one."
         )
-    
-    elif data == "menu:sampler":
+        return WAITING_MASK
+    if arg == "clear":
+        session.init_image = None
+        session.mask_image = None
+        await query.edit_message_text("🗑 Photo forgotten.", reply_markup=get_main_menu_keyboard())
+        return
+    if arg == "nomask":
+        session.mask_image = None
+    elif arg == "dn+":
+        session.denoising_strength = round(min(session.denoising_strength + 0.1, 1.0), 2)
+    elif arg == "dn-":
+        session.denoising_strength = round(max(session.denoising_strength - 0.1, 0.1), 2)
+    if not session.init_image:
+        await query.edit_message_text("Send me a photo first to edit it.", reply_markup=get_main_menu_keyboard())
+        return
+    await query.edit_message_text(img2img_text(session), reply_markup=get_img2img_keyboard(bool(session.mask_image)))
+
+async def on_menu(query, context, user_id, session, arg):
+    if arg == "quality":
+        await query.edit_message_text("Select a quality preset:", reply_markup=get_quality_keyboard())
+    elif arg == "size":
+        await query.edit_message_text("Select image size:", reply_markup=get_size_keyboard())
+    elif arg == "advanced":
+        await query.edit_message_text(advanced_text(session), reply_markup=get_advanced_keyboard())
+    elif arg == "sampler":
         await query.edit_message_text(
             "Select sampler:",
-            reply_markup=get_sampler_keyboard()
+            reply_markup=get_sampler_keyboard(session.sampler, gradio_client.capabilities.samplers())
         )
-    
-    elif data == "menu:scheduler":
+    elif arg == "scheduler":
         await query.edit_message_text(
             f"Select scheduler (current: {session.scheduler}):",
-            reply_markup=get_scheduler_keyboard()
-        )
-    
-    elif data == "view_settings":
-        params = session.get_params()
-        seed_text = "random" if params['seed'] == -1 else str(params['seed'])
-        await query.edit_message_text(
-            f"📊 Current Settings:\n\n"
-            f"Prompt: {params['prompt'][:50]}{'...' if len(params['prompt']) > 50 else ''}\n"
-            f"Negative: {params['negative_prompt'][:50]}{'...' if len(params['negative_prompt']) > 50 else ''}\n"
-            f"Steps: {params['steps']}\n"
-            f"CFG Scale: {params['cfg_scale']}\n"
-            f"Size: {params['width']}x{params['height']}\n"
-            f"Sampler: {params['sampler']}\n"
-            f"Scheduler: {params['scheduler']}\n"
-            f"Seed: {seed_text}\n"
-            f"Restore Faces: {'ON' if params['restore_faces'] else 'OFF'}\n"
-            f"Tiling: {'ON' if params['tiling'] else 'OFF'}",
-            reply_markup=get_main_menu_keyboard()
-        )
-    
-    elif data.startswith("quality:"):
-        preset_name = data.replace("quality:", "")
-        preset = QUALITY_PRESETS[preset_name]
-        session.update_params(**preset)
-        
-        await query.edit_message_text(
-            f"✓ Quality preset applied: {preset_name}\n"
-            f"Steps: {session.steps}, CFG: {session.cfg_scale}",
-            reply_markup=get_main_menu_keyboard()
-        )
-    
-    elif data.startswith("size:"):
-        size_name = data.replace("size:", "")
-        width, height = PRESET_SIZES[size_name]
-        session.update_params(width=width, height=height)
-        
-        await query.edit_message_text(
-            f"✓ Size set to: {size_name} ({width}x{height})",
-            reply_markup=get_main_menu_keyboard()
+            reply_markup=get_scheduler_keyboard(session.scheduler, gradio_client.capabilities.schedulers())
         )
-    
-    elif data.startswith("sampler:"):
-        sampler = data.replace("sampler:", "")
-        session.update_params(sampler=sampler)
-        
+    elif arg == "delivery":
         await query.edit_message_text(
-            f"✓ Sampler changed to: {sampler}",
-            reply_markup=get_advanced_keyboard()
+            f"Delivery format (current: {DELIVERY_FORMATS[session.delivery_format][0]}):\n\n"
+            "JPEG and WebP upload much faster than the original PNG.",
+            reply_markup=get_delivery_keyboard(session.delivery_format, session.attach_original)
         )
-    
-    elif data.startswith("scheduler:"):
-        scheduler = data.replace("scheduler:", "")
-        session.update_params(scheduler=scheduler)
-        
+
+async def on_back(query, context, user_id, session, arg):
+    if arg == "advanced":
+        await query.edit_message_text(advanced_text(session), reply_markup=get_advanced_keyboard())
+    else:
+        await query.edit_message_text("What would you like to do?", reply_markup=get_main_menu_keyboard())
+
+async def on_view_settings(query, context, user_id, session, arg):
+    params = session.get_params()
+    seed_text = "random" if params['seed'] == -1 else str(params['seed'])
+    await query.edit_message_text(
+        f"📊 Current Settings:\n\n"
+        f"Prompt: {params['prompt'][:50]}{'...' if len(params['prompt']) > 50 else ''}\n"
+        f"Negative: {params['negative_prompt'][:50]}{'...' if len(params['negative_prompt']) > 50 else ''}\n"
+        f"Steps: {params['steps']}\n"
+        f"CFG Scale: {params['cfg_scale']}\n"
+        f"Size: {params['width']}x{params['height']}\n"
+        f"Sampler: {params['sampler']}\n"
+        f"Scheduler: {params['scheduler']}\n"
+        f"Model: {gradio_client.capabilities.model() or 'unknown'}\n"
+        f"Seed: {seed_text}\n"
+        f"Restore Faces: {'ON' if params['restore_faces'] else 'OFF'}\n"
+        f"Tiling: {'ON' if params['tiling'] else 'OFF'}\n"
+        f"Draft First: {'ON' if session.draft_mode else 'OFF'}\n"
+        f"Photo to edit: {'yes' if session.init_image else 'none'}"
+        f"{', with mask' if session.mask_image else ''} (denoise {session.denoising_strength:.2f})\n"
+        f"Delivery: {DELIVERY_FORMATS[session.delivery_format][0]}"
+        f"{' + original' if session.attach_original else ''}\n"
+        f"Cost: {job_cost(params):.1f} credits\n"
+        f"{budget_text(user_id)}",
+        reply_markup=get_main_menu_keyboard()
+    )
+
+async def on_quality(query, context, user_id, session, preset_name):
+    if preset_name not in QUALITY_PRESETS:
+        return
+    session.update_params(**QUALITY_PRESETS[preset_name])
+    await query.edit_message_text(
+        f"✓ Quality preset applied: {preset_name}\n"
+        f"Steps: {session.steps}, CFG: {session.cfg_scale}",
+        reply_markup=get_main_menu_keyboard()
+    )
+
+async def on_size(query, context, user_id, session, size_name):
+    if size_name not in PRESET_SIZES:
+        return
+    width, height = PRESET_SIZES[size_name]
+    session.update_params(width=width, height=height)
+    await query.edit_message_text(
+        f"✓ Size set to: {size_name} ({width}x{height})",
+        reply_markup=get_main_menu_keyboard()
+    )
+
+async def on_sampler(query, context, user_id, session, sampler):
+    if sampler is None:
+        return
+    samplers = gradio_client.capabilities.samplers()
+    if sampler not in samplers:
+        # Sent by a keyboard from before the backend changed
         await query.edit_message_text(
-            f"✓ Scheduler changed to: {scheduler}",
-            reply_markup=get_advanced_keyboard()
+            f"Sampler {sampler} is no longer available. Select sampler:",
+            reply_markup=get_sampler_keyboard(session.sampler, samplers)
         )
-    
-    elif data == "steps:inc":
-        session.steps = min(session.steps + 5, 150)
+        return
+    session.update_params(sampler=sampler)
+    await query.edit_message_text(f"✓ Sampler changed to: {sampler}", reply_markup=get_advanced_keyboard())
+
+async def on_scheduler(query, context, user_id, session, scheduler):
+    if scheduler is None:
+        return
+    schedulers = gradio_client.capabilities.schedulers()
+    if scheduler not in schedulers:
         await query.edit_message_text(
-            f"Steps: {session.steps}",
-            reply_markup=get_advanced_keyboard()
+            f"Scheduler {scheduler} is no longer available. Select scheduler:",
+            reply_markup=get_scheduler_keyboard(session.scheduler, schedulers)
         )
-    
-    elif data == "steps:dec":
+        return
+    session.update_params(scheduler=scheduler)
+    await query.edit_message_text(f"✓ Scheduler changed to: {scheduler}", reply_markup=get_advanced_keyboard())
+
+async def on_delivery(query, context, user_id, session, option):
+    if option == "original":
+        session.attach_original = not session.attach_original
+    elif option in DELIVERY_FORMATS:
+        session.update_params(delivery_format=option)
+    await query.edit_message_text(
+        f"✓ Delivery format: {DELIVERY_FORMATS[session.delivery_format][0]}\n"
+        f"Lossless original: {'ON' if session.attach_original else 'OFF'}",
+        reply_markup=get_delivery_keyboard(session.delivery_format, session.attach_original)
+    )
+
+async def on_steps(query, context, user_id, session, arg):
+    if arg == "inc":
+        session.steps = min(session.steps + 5, MAX_STEPS)
+    elif arg == "dec":
         session.steps = max(session.steps - 5, 5)
-        await query.edit_message_text(
-            f"Steps: {session.steps}",
-            reply_markup=get_advanced_keyboard()
-        )
-    
-    elif data == "cfg:inc":
+    await query.edit_message_text(f"Steps: {session.steps}", reply_markup=get_advanced_keyboard())
+
+async def on_cfg(query, context, user_id, session, arg):
+    if arg == "inc":
         session.cfg_scale = min(session.cfg_scale + 0.5, 20.0)
-        await query.edit_message_text(
-            f"CFG Scale: {session.cfg_scale}",
-            reply_markup=get_advanced_keyboard()
-        )
-    
-    elif data == "cfg:dec":
+    elif arg == "dec":
         session.cfg_scale = max(session.cfg_scale - 0.5, 1.0)
-        await query.edit_message_text(
-            f"CFG Scale: {session.cfg_scale}",
-            reply_markup=get_advanced_keyboard()
-        )
-    
-    elif data == "back:main":
-        await query.edit_message_text(
-            "What would you like to do?",
-            reply_markup=get_main_menu_keyboard()
-        )
-    
-    elif data == "back:advanced":
-        await query.edit_message_text(
-            f"Advanced Settings:\n\n"
-            f"Steps: {session.steps}\n"
-            f"CFG Scale: {session.cfg_scale}\n"
-            f"Sampler: {session.sampler}",
-            reply_markup=get_advanced_keyboard()
-        )
-    
-    elif data == "custom:steps":
-        await query.edit_message_text("Send me the number of steps (5-150):")
-        return WAITING_STEPS
-    
-    elif data == "custom:cfg":
-        await query.edit_message_text("Send me the CFG scale (1.0-20.0):")
-        return WAITING_CFG
-    
-    elif data == "custom:width":
-        await query.edit_message_text("Send me the width in pixels (64-2048):")
-        return WAITING_WIDTH
-    
-    elif data == "custom:height":
-        await query.edit_message_text("Send me the height in pixels (64-2048):")
-        return WAITING_HEIGHT
-    
-    elif data == "custom:seed":
-        await query.edit_message_text("Send me a seed number (-1 for random, or any positive number):")
-        return WAITING_SEED
-    
-    elif data == "custom:negative":
+    await query.edit_message_text(f"CFG Scale: {session.cfg_scale}", reply_markup=get_advanced_keyboard())
+
+CUSTOM_PROMPTS = {
+    "steps": ("Send me the number of steps (5-150):", WAITING_STEPS),
+    "cfg": ("Send me the CFG scale (1.0-20.0):", WAITING_CFG),
+    "width": ("Send me the width in pixels (64-2048):", WAITING_WIDTH),
+    "height": ("Send me the height in pixels (64-2048):", WAITING_HEIGHT),
+    "seed": ("Send me a seed number (-1 for random, or any positive number):", WAITING_SEED),
+}
+
+async def on_custom(query, context, user_id, session, arg):
+    if arg == "negative":
         await query.edit_message_text(f"Current negative prompt:\n{session.negative_prompt}\n\nSend me the new negative prompt:")
         return WAITING_NEGATIVE
+    if arg in CUSTOM_PROMPTS:
+        text, state = CUSTOM_PROMPTS[arg]
+        await query.edit_message_text(text)
+        return state
+
+TOGGLES = {
+    "restore_faces": lambda session: f"✓ Restore faces: {'ON' if session.restore_faces else 'OFF'}",
+    "tiling": lambda session: f"✓ Tiling: {'ON' if session.tiling else 'OFF'}",
+    "draft_mode": lambda session: (
+        f"✓ Draft first: {'ON' if session.draft_mode else 'OFF'}\n"
+        "Generate shows a quick preview you can refine or discard."
+    ),
+}
+
+async def on_toggle(query, context, user_id, session, field):
+    if field not in TOGGLES:
+        return
+    setattr(session, field, not getattr(session, field))
+    await query.edit_message_text(TOGGLES[field](session), reply_markup=get_advanced_keyboard())
+
+# action -> handler(query, context, user_id, session, arg); a returned value is
+# the ConversationHandler state to enter
+CALLBACK_ROUTES = {
+    "generate": on_generate,
+    "variations": on_variations,
+    "variation": on_variation,
+    "draft": on_draft,
+    "menu": on_menu,
+    "back": on_back,
+    "view_settings": on_view_settings,
+    "quality": on_quality,
+    "size": on_size,
+    "sampler": on_sampler,
+    "scheduler": on_scheduler,
+    "delivery": on_delivery,
+    "steps": on_steps,
+    "cfg": on_cfg,
+    "custom": on_custom,
+    "toggle": on_toggle,
+    "img2img": on_img2img,
+    "recent": on_recent,
+}
+
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if not query or not update.effective_user or not query.data:
+        return
+    action, arg = decode_callback(query.data)
+    handler = CALLBACK_ROUTES.get(action)
+    if handler is None:
+        await query.answer()
+        return
+    generating = (
+        action in ("generate", "variations", "variation", "recent")
+        or (action == "draft" and arg == "refine") or (action == "img2img" and arg == "run")
+    )
+    if generating and update.effective_user.id in pending_generations:
+        await query.answer("⏳ Your previous image is still generating.")
+        return
+    await query.answer()
     
-    elif data == "toggle:restore_faces":
-        session.restore_faces = not session.restore_faces
-        await query.edit_message_text(
-            f"✓ Restore faces: {'ON' if session.restore_faces else 'OFF'}",
-            reply_markup=get_advanced_keyboard()
-        )
-    
-    elif data == "toggle:tiling":
-        session.tiling = not session.tiling
-        await query.edit_message_text(
-            f"✓ Tiling: {'ON' if session.tiling else 'OFF'}",
-            reply_markup=get_advanced_keyboard()
-        )
+    user_id = update.effective_user.id
+    session = await get_or_create_session(user_id)
+    return await handler(query, context, user_id, session, arg)
 
 async def receive_steps(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.effective_user or not update.message or not update.message.text:
         return ConversationHandler.END
     
     user_id = update.effective_user.id
-    session = get_or_create_session(user_id)
+    session = await get_or_create_session(user_id)
     
     try:
         steps = int(update.message.text)
-        if 5 <= steps <= 150:
+        if 5 <= steps <= MAX_STEPS:
             session.steps = steps
             await update.message.reply_text(
                 f"✓ Steps set to {steps}",
@@ -309,7 +826,7 @@ async def receive_steps(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         else:
             await update.message.reply_text(
-                "Steps must be between 5 and 150. Try again:",
+                f"Steps must be between 5 and {MAX_STEPS}. Try again:",
             )
             return WAITING_STEPS
     except ValueError:
@@ -323,7 +840,7 @@ async def receive_cfg(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
     
     user_id = update.effective_user.id
-    session = get_or_create_session(user_id)
+    session = await get_or_create_session(user_id)
     
     try:
         cfg = float(update.message.text)
@@ -349,11 +866,11 @@ async def receive_width(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
     
     user_id = update.effective_user.id
-    session = get_or_create_session(user_id)
+    session = await get_or_create_session(user_id)
     
     try:
         width = int(update.message.text)
-        if 64 <= width <= 2048:
+        if 64 <= width <= MAX_IMAGE_SIDE:
             session.width = width
             await update.message.reply_text(
                 f"✓ Width set to {width}px",
@@ -361,7 +878,7 @@ async def receive_width(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         else:
             await update.message.reply_text(
-                "Width must be between 64 and 2048. Try again:",
+                f"Width must be between 64 and {MAX_IMAGE_SIDE}. Try again:",
             )
             return WAITING_WIDTH
     except ValueError:
@@ -375,11 +892,11 @@ async def receive_height(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
     
     user_id = update.effective_user.id
-    session = get_or_create_session(user_id)
+    session = await get_or_create_session(user_id)
     
     try:
         height = int(update.message.text)
-        if 64 <= height <= 2048:
+        if 64 <= height <= MAX_IMAGE_SIDE:
             session.height = height
             await update.message.reply_text(
                 f"✓ Height set to {height}px",
@@ -387,7 +904,7 @@ async def receive_height(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         else:
             await update.message.reply_text(
-                "Height must be between 64 and 2048. Try again:",
+                f"Height must be between 64 and {MAX_IMAGE_SIDE}. Try again:",
             )
             return WAITING_HEIGHT
     except ValueError:
@@ -401,7 +918,7 @@ async def receive_seed(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
     
     user_id = update.effective_user.id
-    session = get_or_create_session(user_id)
+    session = await get_or_create_session(user_id)
     
     try:
         seed = int(update.message.text)
@@ -422,7 +939,7 @@ async def receive_negative(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
     
     user_id = update.effective_user.id
-    session = get_or_create_session(user_id)
+    session = await get_or_create_session(user_id)
     
     session.negative_prompt = update.message.text
     await update.message.reply_text(
@@ -432,6 +949,20 @@ async def receive_negative(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return ConversationHandler.END
 
+async def receive_mask(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_user or not update.message:
+        return ConversationHandler.END
+    
+    ref = photo_ref(update.message)
+    if ref is None:
+        await update.message.reply_text("Please send the mask as a photo or image file:")
+        return WAITING_MASK
+    
+    session = await get_or_create_session(update.effective_user.id)
+    session.mask_image = ref
+    await update.message.reply_text(img2img_text(session), reply_markup=get_img2img_keyboard(True))
+    return ConversationHandler.END
+
 async def cancel_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "Cancelled.",
@@ -442,15 +973,58 @@ async def cancel_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
 app = FastAPI()
 application = None
 bot_ready = False
+# Set when initialization has ended, with setup_error holding why it failed
+setup_done = asyncio.Event()
+setup_error = None
+background_tasks = set()
+
+# None keeps custom-input state in the ConversationHandler's own dict
+conversations = create_conversations(CONVERSATION_STORE, SESSION_REDIS_URL)
+
+async def process_update(data):
+    update = Update.de_json(data, application.bot)
+    if conversations is not None:
+        # The handler reads its state synchronously, so load it first
+        key = conversation_key(update)
+        if key is not None:
+            await conversations.prefetch(key)
+    await application.process_update(update)
+
+update_ingestor = UpdateIngestor(process_update)
+telegram_sender = SendScheduler()
+
+metrics.Gauge("bot_active_sessions", "User sessions held in memory", lambda: len(session_manager))
+metrics.Gauge("bot_generation_queue_depth", "Generation jobs waiting for a worker", lambda: generation_scheduler.stats()["queue_depth"])
+metrics.Gauge("bot_generation_running", "Generation jobs currently running", lambda: generation_scheduler.stats()["running"])
+metrics.Gauge("bot_gpu_load_credits", "Credits of admitted work queued or running", lambda: admission.load)
+metrics.Gauge("bot_update_queue_depth", "Telegram updates waiting for a worker", lambda: update_ingestor.depth)
+metrics.Gauge("bot_telegram_queue_depth", "Bot API calls waiting in the outbound scheduler", lambda: telegram_sender.depth)
+metrics.Gauge("bot_telegram_coalesced_total", "Message edits merged into a newer queued edit", lambda: telegram_sender.metrics["coalesced"], kind="counter")
+metrics.Gauge("bot_result_cache_hits_total", "Result cache hits", lambda: result_cache.hits, kind="counter")
+metrics.Gauge("bot_result_cache_misses_total", "Result cache misses", lambda: result_cache.misses, kind="counter")
+metrics.Gauge("bot_recent_results_offered_total", "Generations answered with a recent matching image", lambda: recent_results.hits, kind="counter")
+metrics.Gauge("bot_recent_results_reused_total", "Recent matching images users chose to reuse", lambda: recent_results.reused, kind="counter")
+metrics.Gauge(
+    "bot_healthy_backends", "Backends currently in rotation",
+    lambda: sum(1 for backend in gradio_client.pool.backends if backend.healthy)
+)
+metrics.Gauge(
+    "bot_retry_budget_tokens", "Retries currently allowed by the shared retry budget",
+    lambda: gradio_client.pool.retry_budget.tokens
+)
 
 async def setup_application():
     global application, bot_ready
     if not TELEGRAM_BOT_TOKEN:
         raise ValueError("TELEGRAM_BOT_TOKEN not set")
     
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    builder = Application.builder().token(TELEGRAM_BOT_TOKEN).base_url(TELEGRAM_BASE_URL)
+    if TELEGRAM_RATE_LIMIT:
+        # Paces every Bot API call, so 429s are waited out instead of raised in handlers
+        builder = builder.rate_limiter(telegram_sender)
+    application = builder.build()
     
-    conv_handler = ConversationHandler(
+    conv_handler = SharedConversationHandler(
         entry_points=[CallbackQueryHandler(button_callback)],
         states={
             WAITING_STEPS: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_steps)],
@@ -459,58 +1033,240 @@ async def setup_application():
             WAITING_HEIGHT: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_height)],
             WAITING_SEED: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_seed)],
             WAITING_NEGATIVE: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_negative)],
+            WAITING_MASK: [MessageHandler((filters.PHOTO | filters.Document.IMAGE | filters.TEXT) & ~filters.COMMAND, receive_mask)],
         },
         fallbacks=[CommandHandler("cancel", cancel_input)],
-        per_message=False
+        per_message=False,
+        conversations=conversations
     )
     
     application.add_handler(CommandHandler("start", start))
     application.add_handler(conv_handler)
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
+    application.add_handler(MessageHandler(filters.PHOTO | filters.Document.IMAGE, handle_photo))
     
     await application.initialize()
     await application.start()
+    if conversations is not None:
+        await conversations.start()
+    update_ingestor.start()
+    generation_scheduler.start()
+    gradio_client.start()
+    session_manager.start()
+    # Also recovers jobs the previous instance left unfinished
+    job_journal.start(resume_job, redeliver_job, abandon_job)
     
+    bot_ready = True
+    setup_done.set()
+    logger.info("Bot initialized and ready")
+    run_in_background(warm_up())
+
+async def initialize():
+    # setup_application for entry points that keep serving when it fails:
+    # webhooks are then refused with 503 so Telegram redelivers them to a
+    # working instance, and the health check reports the failure
+    global setup_error
+    try:
+        await setup_application()
+    except Exception as e:
+        setup_error = e
+        setup_done.set()
+        logger.error(f"Bot initialization failed: {e}")
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def read_webhook_state():
+    try:
+        with open(WEBHOOK_STATE_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_webhook_state(state):
+    tmp_path = f"{WEBHOOK_STATE_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, WEBHOOK_STATE_PATH)
+
+async def ensure_webhook(url):
+    # set_webhook resets Telegram's pending-update state, so it is only
+    # called when the registered URL differs. The bot id is part of the
+    # record, so a new token is checked again.
+    bot_id = (TELEGRAM_BOT_TOKEN or "").partition(":")[0]
+    if WEBHOOK_STATE_PATH:
+        state = await asyncio.to_thread(read_webhook_state)
+        if (
+            state and state.get("bot_id") == bot_id and state.get("url") == url
+            and time.time() - state.get("checked_at", 0) < WEBHOOK_RECHECK_INTERVAL
+        ):
+            logger.info(f"Webhook known to be set to {url}")
+            return
+    info = await application.bot.get_webhook_info()
+    if info.url != url:
+        await application.bot.set_webhook(url=url)
+        logger.info(f"Webhook set to {url}")
+    else:
+        logger.info(f"Webhook already set to {url}")
+    if WEBHOOK_STATE_PATH:
+        try:
+            await asyncio.to_thread(write_webhook_state, {"bot_id": bot_id, "url": url, "checked_at": time.time()})
+        except OSError as e:
+            logger.warning(f"Recording the webhook state failed: {e}")
+
+async def warm_up():
+    # Nothing here is needed to answer the first update
+    started = time.perf_counter()
     webhook_url = os.getenv("WEBHOOK_URL")
+    steps = [recent_results.load(), transcoder.warm_up()]
     if webhook_url:
-        await application.bot.set_webhook(url=f"{webhook_url}/webhook")
-        logger.info(f"Webhook set to {webhook_url}/webhook")
+        steps.append(ensure_webhook(f"{webhook_url}/webhook"))
+    results = await asyncio.gather(*steps, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Warm-up step failed: {result}")
+    recent_results.start()
+    logger.info(f"Warm-up finished in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+class StatusMessage:
+    # Stands in for the callback query of a job recovered after a restart:
+    # status edits go to the message the job was started from
+    def __init__(self, chat_id, message_id):
+        self.chat_id = chat_id
+        self.message = SimpleNamespace(message_id=message_id) if message_id is not None else None
     
-    bot_ready = True
-    logger.info("Bot initialized and ready")
+    async def edit_message_text(self, text, reply_markup=None):
+        if self.message is None:
+            await application.bot.send_message(chat_id=self.chat_id, text=text, reply_markup=reply_markup)
+            return
+        try:
+            await application.bot.edit_message_text(
+                text, chat_id=self.chat_id, message_id=self.message.message_id, reply_markup=reply_markup
+            )
+        except BadRequest as e:
+            if "not modified" not in str(e):
+                raise
+
+def recovered_job(row):
+    return StatusMessage(row["chat_id"], row["message_id"]), SimpleNamespace(bot=application.bot)
+
+def mode_params(mode, params):
+    if mode == "variations":
+        return variations_params(params)
+    if mode == "draft":
+        return draft_params(params)
+    return params
+
+async def resume_job(row, params, seeds):
+    # Pinning the seed the lost render used gives the user the same image
+    if params["seed"] == -1 and seeds and seeds[0] is not None:
+        params = {**params, "seed": seeds[0]}
+    query, context = recovered_job(row)
+    session = await get_or_create_session(row["user_id"])
+    await query.edit_message_text("🔄 The bot restarted, resuming your generation...")
+    start_generation(query, context, row["user_id"], session, row["mode"], params)
+
+async def redeliver_job(row, params, images):
+    query, context = recovered_job(row)
+    session = await get_or_create_session(row["user_id"])
+    mode = row["mode"]
+    image = images if mode == "variations" else images[0]
+    await deliver_result(query, context, row["user_id"], session, mode, params, mode_params(mode, params), image)
+
+async def abandon_job(row, params):
+    query, _ = recovered_job(row)
+    await query.edit_message_text(
+        "⚠️ This generation was interrupted by a restart. Please try again.",
+        reply_markup=get_main_menu_keyboard()
+    )
 
 @app.on_event("startup")
 async def startup():
-    await setup_application()
+    # Not awaited, so uvicorn opens the socket right away; webhooks that arrive
+    # meanwhile are held by handle_webhook
+    run_in_background(initialize())
 
 @app.on_event("shutdown")
 async def shutdown():
+    for task in list(background_tasks):
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await update_ingestor.stop()
+    if conversations is not None:
+        await conversations.close()
+    for task in list(generation_tasks):
+        task.cancel()
+    await asyncio.gather(*generation_tasks, return_exceptions=True)
+    await generation_scheduler.stop()
+    transcoder.shutdown()
     if application:
         await application.stop()
         await application.shutdown()
+    await session_manager.close()
+    await recent_results.close()
+    # Cancelled generations stay pending, so the next instance resumes them
+    await job_journal.close()
+    await gradio_client.close()
+    await source_images.close()
 
 @app.post("/webhook")
 async def webhook(request: Request):
-    if not bot_ready or application is None:
-        logger.warning("Webhook called before bot initialization complete")
-        return {"ok": False, "error": "Bot not ready"}, 503
-    
+    with WEBHOOK_SECONDS.time():
+        return await handle_webhook(request)
+
+async def handle_webhook(request: Request):
     try:
         data = await request.json()
-        update = Update.de_json(data, application.bot)
-        await application.update_queue.put(update)
-        return {"ok": True}
     except Exception as e:
         logger.error(f"Webhook error: {e}")
-        return {"ok": False, "error": str(e)}, 500
+        ERRORS.inc("webhook", type(e).__name__)
+        return JSONResponse({"ok": False, "error": "Invalid JSON"}, status_code=400)
+    
+    if not bot_ready:
+        # Held unanswered until initialization ends: an update acknowledged
+        # by an instance that then fails to start would be lost
+        await setup_done.wait()
+        if not bot_ready:
+            return JSONResponse({"ok": False, "error": "Bot not ready"}, status_code=503)
+    
+    # Acknowledge right away; a 503 makes Telegram redeliver later
+    status = update_ingestor.submit(data)
+    if status == "full":
+        logger.warning("Update queue full, asking Telegram to retry")
+        return JSONResponse({"ok": False, "error": "Busy"}, status_code=503)
+    return {"ok": True}
 
 @app.get("/")
 async def health():
+    if setup_error is not None:
+        return JSONResponse({"status": "failed", "error": str(setup_error)}, status_code=503)
     return {
         "status": "healthy" if bot_ready else "initializing",
-        "bot": "ready" if bot_ready else "starting"
+        "bot": "ready" if bot_ready else "starting",
+        "updates": update_ingestor.stats(),
+        "outbound": telegram_sender.stats(),
+        "queue": generation_scheduler.stats(),
+        "cache": result_cache.stats(),
+        "coalescing": generation_flights.stats(),
+        "admission": admission.stats(),
+        "transcode": transcoder.stats(),
+        "sources": source_images.stats(),
+        "recent_results": recent_results.stats(),
+        "journal": job_journal.stats(),
+        "sessions": session_manager.stats(),
+        "conversations": conversations.stats() if conversations is not None else None,
+        "backends": gradio_client.pool.stats() if gradio_client.pool else [],
+        "retry_budget": gradio_client.pool.retry_budget.stats() if gradio_client.pool else None,
+        "capabilities": gradio_client.capabilities.stats()
     }
 
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "8080"))
     uvicorn.run(app, host="0.0.0.0", port=port)
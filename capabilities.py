@@ -0,0 +1,186 @@
+import asyncio
+import time
+import logging
+from backends import OPEN
+from config import (
+    SAMPLERS, SCHEDULERS, CAPABILITY_REFRESH_INTERVAL, CAPABILITY_TTL, BACKEND_HEALTH_TIMEOUT,
+    MAX_IMAGE_SIDE, MAX_IMAGE_PIXELS, MAX_STEPS
+)
+
+logger = logging.getLogger(__name__)
+
+MIN_IMAGE_SIDE = 64
+# Older sampler names carry the scheduler: "DPM++ 2M Karras" is "DPM++ 2M"
+# with the Karras scheduler, and A1111 still accepts them that way
+SCHEDULER_SUFFIXES = (" Karras", " Exponential")
+
+class Capabilities:
+    # What one backend reported. schedulers is None for backends without a
+    # scheduler endpoint, which predate scheduler selection.
+    __slots__ = ("samplers", "sampler_aliases", "schedulers", "scheduler_aliases", "models", "model", "fetched_at")
+
+    def __init__(self, samplers, schedulers, models, model):
+        self.samplers = tuple(entry["name"] for entry in samplers)
+        self.sampler_aliases = {
+            alias.lower() for entry in samplers for alias in [entry["name"]] + list(entry.get("aliases") or [])
+        }
+        if schedulers is None:
+            self.schedulers = None
+            self.scheduler_aliases = None
+        else:
+            self.schedulers = tuple(entry.get("label") or entry["name"] for entry in schedulers)
+            self.scheduler_aliases = {
+                name.lower() for entry in schedulers for name in (entry["name"], entry.get("label")) if name
+            }
+        self.models = tuple(entry["title"] for entry in models)
+        self.model = model
+        self.fetched_at = time.monotonic()
+
+    def has_sampler(self, name):
+        if name.lower() in self.sampler_aliases:
+            return True
+        for suffix in SCHEDULER_SUFFIXES:
+            if name.endswith(suffix) and name[:-len(suffix)].lower() in self.sampler_aliases:
+                return True
+        return False
+
+    def has_scheduler(self, name):
+        if self.scheduler_aliases is None:
+            return name == "Automatic"
+        return name.lower() in self.scheduler_aliases
+
+class CapabilityRegistry:
+    # Samplers, schedulers and models per backend, fetched once and refreshed
+    # in the background so lookups never wait on a backend. What is offered
+    # and accepted is what every backend in rotation supports, since a job may
+    # land on any of them. Until a backend has answered, or once its data is
+    # older than ttl, the static lists in config stand in.
+
+    def __init__(self, pool, refresh_interval=CAPABILITY_REFRESH_INTERVAL, ttl=CAPABILITY_TTL,
+                 timeout=BACKEND_HEALTH_TIMEOUT):
+        self.pool = pool
+        self.refresh_interval = refresh_interval
+        self.ttl = ttl
+        self.timeout = timeout
+        # backend url -> Capabilities
+        self._capabilities = {}
+        self._task = None
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.rejected = 0
+
+    async def _get(self, client, backend, path, optional=False):
+        response = await client.get(f"{backend.url}{path}", timeout=self.timeout)
+        if optional and response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    async def refresh(self, client, backend):
+        try:
+            samplers, schedulers, models, options = await asyncio.gather(
+                self._get(client, backend, "/sdapi/v1/samplers"),
+                self._get(client, backend, "/sdapi/v1/schedulers", optional=True),
+                self._get(client, backend, "/sdapi/v1/sd-models"),
+                self._get(client, backend, "/sdapi/v1/options"),
+            )
+            capabilities = Capabilities(samplers, schedulers, models, options.get("sd_model_checkpoint"))
+        except Exception as e:
+            self.refresh_failures += 1
+            logger.warning(f"Capability refresh for {backend.url} failed: {e}")
+            return False
+        previous = self._capabilities.get(backend.url)
+        if previous is None or previous.samplers != capabilities.samplers or previous.schedulers != capabilities.schedulers:
+            logger.info(
+                f"Backend {backend.url}: {len(capabilities.samplers)} samplers, "
+                f"{len(capabilities.schedulers or ())} schedulers, model {capabilities.model}"
+            )
+        self._capabilities[backend.url] = capabilities
+        self.refreshes += 1
+        return True
+
+    async def _refresh_loop(self, client):
+        while True:
+            backends = [backend for backend in self.pool.backends if backend.state != OPEN]
+            await asyncio.gather(*(self.refresh(client, backend) for backend in backends))
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self, client):
+        if self._task is None and self.pool is not None and self.pool.backends:
+            self._task = asyncio.create_task(self._refresh_loop(client))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _current(self):
+        if self.pool is None:
+            return []
+        now = time.monotonic()
+        current = []
+        for backend in self.pool.backends:
+            capabilities = self._capabilities.get(backend.url)
+            if backend.healthy and capabilities is not None and now - capabilities.fetched_at < self.ttl:
+                current.append(capabilities)
+        return current
+
+    def samplers(self):
+        current = self._current()
+        if not current:
+            return tuple(SAMPLERS)
+        return tuple(name for name in current[0].samplers if all(c.has_sampler(name) for c in current[1:]))
+
+    def schedulers(self):
+        current = self._current()
+        if not current:
+            return tuple(SCHEDULERS)
+        names = next((c.schedulers for c in current if c.schedulers is not None), ("Automatic",))
+        return tuple(name for name in names if all(c.has_scheduler(name) for c in current))
+
+    def model(self):
+        current = self._current()
+        return current[0].model if current else None
+
+    def validate(self, params):
+        # Returns what is wrong with params for the backends in rotation, as
+        # lines for the user; empty when the job can be submitted
+        problems = []
+        for stage in (params, params.get("hires")):
+            if not stage:
+                continue
+            if not 1 <= stage["steps"] <= MAX_STEPS:
+                problems.append(f"Steps must be between 1 and {MAX_STEPS} (got {stage['steps']})")
+            width, height = stage["width"], stage["height"]
+            if not (MIN_IMAGE_SIDE <= width <= MAX_IMAGE_SIDE and MIN_IMAGE_SIDE <= height <= MAX_IMAGE_SIDE):
+                problems.append(f"Width and height must be between {MIN_IMAGE_SIDE} and {MAX_IMAGE_SIDE}px (got {width}x{height})")
+            elif width * height > MAX_IMAGE_PIXELS:
+                problems.append(f"{width}x{height} is more than the backend renders ({MAX_IMAGE_PIXELS / 1e6:.1f} megapixels)")
+        current = self._current()
+        if current:
+            if not all(c.has_sampler(params["sampler"]) for c in current):
+                problems.append(f"Sampler {params['sampler']} is not available on the backend")
+            if not all(c.has_scheduler(params["scheduler"]) for c in current):
+                problems.append(f"Scheduler {params['scheduler']} is not available on the backend")
+        if problems:
+            self.rejected += 1
+        return problems
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "backends": {
+                url: {
+                    "samplers": len(c.samplers),
+                    "schedulers": len(c.schedulers) if c.schedulers is not None else None,
+                    "models": len(c.models),
+                    "model": c.model,
+                    "age": round(now - c.fetched_at, 1),
+                }
+                for url, c in self._capabilities.items()
+            },
+            "refreshes": self.refreshes,
+            "refresh_failures": self.refresh_failures,
+            "rejected": self.rejected,
+        }
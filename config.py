@@ -1,7 +1,172 @@
 import os
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Bot API endpoint, for a local Bot API server or the benchmark's fake
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "https://api.telegram.org/bot")
+# Outbound Bot API calls are paced below Telegram's flood limits: about 30
+# messages a second overall, one a second per private chat with short bursts
+# tolerated, and 20 a minute per group
+TELEGRAM_RATE_LIMIT = os.getenv("TELEGRAM_RATE_LIMIT", "true").lower() == "true"
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", str(20 / 60)))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+# A call answered with 429 waits out retry_after and is retried this many times
+TELEGRAM_FLOOD_RETRIES = int(os.getenv("TELEGRAM_FLOOD_RETRIES", "3"))
+
 GRADIO_API_URL = os.getenv("GRADIO_API_URL")
+# Comma-separated list of backends, each optionally suffixed with "|weight"
+GRADIO_API_URLS = os.getenv("GRADIO_API_URLS") or GRADIO_API_URL
+
+BACKEND_HEALTH_INTERVAL = float(os.getenv("BACKEND_HEALTH_INTERVAL", "15"))
+BACKEND_HEALTH_TIMEOUT = float(os.getenv("BACKEND_HEALTH_TIMEOUT", "5"))
+BACKEND_MAX_FAILURES = int(os.getenv("BACKEND_MAX_FAILURES", "3"))
+# An open circuit stays closed to traffic for BREAKER_COOLDOWN seconds, doubling
+# up to BREAKER_MAX_COOLDOWN each time its half-open trial fails
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+BREAKER_MAX_COOLDOWN = float(os.getenv("BREAKER_MAX_COOLDOWN", "300"))
+# Samplers, schedulers and models are read from each backend and refreshed in
+# the background; data older than CAPABILITY_TTL is ignored in favour of the
+# static lists below
+CAPABILITY_REFRESH_INTERVAL = float(os.getenv("CAPABILITY_REFRESH_INTERVAL", "300"))
+CAPABILITY_TTL = float(os.getenv("CAPABILITY_TTL", "1800"))
+# A1111 reports no limits, so they are configured; jobs beyond them are
+# refused before submission
+MAX_IMAGE_SIDE = int(os.getenv("MAX_IMAGE_SIDE", "2048"))
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(2048 * 2048)))
+MAX_STEPS = int(os.getenv("MAX_STEPS", "150"))
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BACKOFF_BASE = float(os.getenv("RETRY_BACKOFF_BASE", "0.5"))
+RETRY_BACKOFF_MAX = float(os.getenv("RETRY_BACKOFF_MAX", "8"))
+# Retries may add at most this fraction of extra calls on top of first attempts
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("RETRY_BUDGET_MIN_PER_SECOND", "0.1"))
+# Send a second copy of a call still running after this many seconds to an idle backend; 0 disables
+HEDGE_AFTER = float(os.getenv("HEDGE_AFTER", "0"))
+
+# Decoded images larger than this are spooled to a temp file instead of RAM
+IMAGE_SPOOL_BYTES = int(os.getenv("IMAGE_SPOOL_BYTES", str(8 * 1024 * 1024)))
+
+DELIVERY_DEFAULT_FORMAT = os.getenv("DELIVERY_DEFAULT_FORMAT", "png").lower()
+DELIVERY_QUALITY = int(os.getenv("DELIVERY_QUALITY", "85"))
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", "2"))
+
+# memory | sqlite | redis | local. redis shares sessions between instances;
+# local is an in-process stand-in for it
+SESSION_STORE = os.getenv("SESSION_STORE", "memory").lower()
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", "sessions.db")
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://localhost:6379/0")
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "10000"))
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(7 * 24 * 3600)))
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "1"))
+SESSION_REFRESH_INTERVAL = float(os.getenv("SESSION_REFRESH_INTERVAL", "30"))
+
+# Which custom-input prompt a user is answering. memory keeps it in this
+# process; redis (at SESSION_REDIS_URL) shares it between instances and local
+# is an in-process stand-in for it
+CONVERSATION_STORE = os.getenv("CONVERSATION_STORE", "memory").lower()
+CONVERSATION_STATE_TTL = float(os.getenv("CONVERSATION_STATE_TTL", "3600"))
+# Local copies are trusted this long unless another instance announces a change
+CONVERSATION_CACHE_TTL = float(os.getenv("CONVERSATION_CACHE_TTL", "30"))
+CONVERSATION_CACHE_MAX = int(os.getenv("CONVERSATION_CACHE_MAX", "10000"))
+
+PROGRESS_POLL_INTERVAL = float(os.getenv("PROGRESS_POLL_INTERVAL", "2"))
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", "3"))
+PROGRESS_PREVIEWS = os.getenv("PROGRESS_PREVIEWS", "false").lower() == "true"
+# Fraction of txt2img payloads logged at DEBUG level
+PAYLOAD_LOG_SAMPLE_RATE = float(os.getenv("PAYLOAD_LOG_SAMPLE_RATE", "0.1"))
+
+GRADIO_CONNECT_TIMEOUT = float(os.getenv("GRADIO_CONNECT_TIMEOUT", "10"))
+GRADIO_READ_TIMEOUT = float(os.getenv("GRADIO_READ_TIMEOUT", "300"))
+GRADIO_MAX_CONNECTIONS = int(os.getenv("GRADIO_MAX_CONNECTIONS", "20"))
+GRADIO_KEEPALIVE_CONNECTIONS = int(os.getenv("GRADIO_KEEPALIVE_CONNECTIONS", "10"))
+
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16"))
+WEBHOOK_QUEUE_MAX = int(os.getenv("WEBHOOK_QUEUE_MAX", "2000"))
+WEBHOOK_DEDUP_SIZE = int(os.getenv("WEBHOOK_DEDUP_SIZE", "10000"))
+# Webhook requests boot.py holds unanswered while bot.py is still importing
+BOOT_BUFFER_MAX = int(os.getenv("BOOT_BUFFER_MAX", "1000"))
+# The webhook URL last set successfully is recorded here; a boot with the same
+# bot and URL within WEBHOOK_RECHECK_INTERVAL seconds skips getWebhookInfo.
+# Without a disk that outlives the instance (or with an empty path) every boot
+# checks, as before.
+WEBHOOK_STATE_PATH = os.getenv("WEBHOOK_STATE_PATH", "webhook_state.json")
+WEBHOOK_RECHECK_INTERVAL = float(os.getenv("WEBHOOK_RECHECK_INTERVAL", str(24 * 3600)))
+
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", str(max(1, len((GRADIO_API_URLS or "").split(","))))))
+GENERATION_QUEUE_MAX = int(os.getenv("GENERATION_QUEUE_MAX", "50"))
+GENERATION_BATCH_WINDOW = float(os.getenv("GENERATION_BATCH_WINDOW", "0.05"))
+GENERATION_MAX_BATCH = int(os.getenv("GENERATION_MAX_BATCH", "4"))
+GENERATION_BATCH_PROMPT_LISTS = os.getenv("GENERATION_BATCH_PROMPT_LISTS", "false").lower() == "true"
+
+# Costs are in credits: one credit is a 512x512, 20-step image with a first-order sampler
+USER_BUDGET_CREDITS = float(os.getenv("USER_BUDGET_CREDITS", "30"))
+USER_BUDGET_REFILL_PER_MINUTE = float(os.getenv("USER_BUDGET_REFILL_PER_MINUTE", "10"))
+GPU_BUDGET_CREDITS = float(os.getenv("GPU_BUDGET_CREDITS", "60"))
+# Above GPU_SATURATION of the budget, jobs costing EXPENSIVE_JOB_CREDITS or more are
+# deferred behind cheaper ones; once the budget is spent they are rejected
+GPU_SATURATION = float(os.getenv("GPU_SATURATION", "0.75"))
+EXPENSIVE_JOB_CREDITS = float(os.getenv("EXPENSIVE_JOB_CREDITS", "4"))
+LOW_PRIORITY_MAX_WAIT = float(os.getenv("LOW_PRIORITY_MAX_WAIT", "120"))
+
+# At least two, or there is nothing to pick from; at most ten, Telegram's album limit
+VARIATIONS_COUNT = max(2, min(10, int(os.getenv("VARIATIONS_COUNT", "4"))))
+# Images rendered side by side in one pass; the rest of VARIATIONS_COUNT is rendered with n_iter
+VARIATIONS_BATCH_SIZE = int(os.getenv("VARIATIONS_BATCH_SIZE", "4"))
+# album sends a media group, grid sends one composited contact sheet
+VARIATIONS_DELIVERY = os.getenv("VARIATIONS_DELIVERY", "album").lower()
+VARIATIONS_GRID_MAX_SIDE = int(os.getenv("VARIATIONS_GRID_MAX_SIDE", "1280"))
+
+# Draft mode renders a quick low-step, low-resolution preview first and only
+# spends the full render when the user asks to refine it
+DRAFT_STEPS = int(os.getenv("DRAFT_STEPS", "8"))
+DRAFT_MAX_SIDE = int(os.getenv("DRAFT_MAX_SIDE", "512"))
+# hires upscales the draft itself with A1111's hires fix; full re-renders it at full size on the same seed
+DRAFT_REFINE = os.getenv("DRAFT_REFINE", "hires").lower()
+DRAFT_HR_UPSCALER = os.getenv("DRAFT_HR_UPSCALER", "Latent")
+DRAFT_DENOISING_STRENGTH = float(os.getenv("DRAFT_DENOISING_STRENGTH", "0.55"))
+
+# img2img / inpainting from user photos. Downloaded sources are cached by
+# Telegram file_unique_id so editing the same photo again skips the download.
+SOURCE_CACHE_BYTES = int(os.getenv("SOURCE_CACHE_BYTES", str(64 * 1024 * 1024)))
+SOURCE_DOWNLOAD_TIMEOUT = float(os.getenv("SOURCE_DOWNLOAD_TIMEOUT", "30"))
+SOURCE_MAX_BYTES = int(os.getenv("SOURCE_MAX_BYTES", str(20 * 1024 * 1024)))
+IMG2IMG_DEFAULT_DENOISING = float(os.getenv("IMG2IMG_DEFAULT_DENOISING", "0.6"))
+IMG2IMG_MASK_BLUR = int(os.getenv("IMG2IMG_MASK_BLUR", "4"))
+
+# Journal of generation jobs, so a restarted instance can finish or close out
+# what the previous one left. The path must be on a local disk that outlives
+# the process: SQLite's WAL mode does not work on network filesystems, so
+# instances on different machines cannot share one journal. Processes on one
+# host may share it; each holds a lease of JOB_JOURNAL_LEASE seconds on its
+# open jobs and only expired leases are recovered. Writes are batched every
+# JOB_JOURNAL_FLUSH_INTERVAL seconds (0 writes through); JOB_JOURNAL_SYNC is
+# SQLite's synchronous level: off, normal or full (fsync every batch).
+JOB_JOURNAL_PATH = os.getenv("JOB_JOURNAL_PATH", "jobs.db")
+JOB_JOURNAL_FLUSH_INTERVAL = float(os.getenv("JOB_JOURNAL_FLUSH_INTERVAL", "0.5"))
+JOB_JOURNAL_SYNC = os.getenv("JOB_JOURNAL_SYNC", "normal").lower()
+JOB_JOURNAL_LEASE = float(os.getenv("JOB_JOURNAL_LEASE", "60"))
+# Rendered images are written next to the journal, alongside delivery, until delivered
+JOB_JOURNAL_SPOOL_RESULTS = os.getenv("JOB_JOURNAL_SPOOL_RESULTS", "true").lower() == "true"
+# Older unfinished jobs are abandoned instead of resumed
+JOB_JOURNAL_RESUME_MAX_AGE = float(os.getenv("JOB_JOURNAL_RESUME_MAX_AGE", "900"))
+JOB_JOURNAL_RETENTION = float(os.getenv("JOB_JOURNAL_RETENTION", str(24 * 3600)))
+
+RESULT_CACHE_MEMORY_BYTES = int(os.getenv("RESULT_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR")
+RESULT_CACHE_DISK_BYTES = int(os.getenv("RESULT_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))
+RESULT_CACHE_MAX_FILE_IDS = int(os.getenv("RESULT_CACHE_MAX_FILE_IDS", "10000"))
+
+# Recently delivered images by normalized prompt and settings, offered for
+# reuse. Entries lose weight with a half-life and are dropped after max age.
+# The index is saved to Redis when SESSION_STORE=redis, else to
+# RECENT_RESULTS_PATH ("" keeps it in memory only).
+RECENT_RESULTS_MAX_ENTRIES = int(os.getenv("RECENT_RESULTS_MAX_ENTRIES", "5000"))
+RECENT_RESULTS_MAX_AGE = float(os.getenv("RECENT_RESULTS_MAX_AGE", str(24 * 3600)))
+RECENT_RESULTS_HALF_LIFE = float(os.getenv("RECENT_RESULTS_HALF_LIFE", "3600"))
+RECENT_RESULTS_PATH = os.getenv("RECENT_RESULTS_PATH", "recent_results.json")
+RECENT_RESULTS_FLUSH_INTERVAL = float(os.getenv("RECENT_RESULTS_FLUSH_INTERVAL", "60"))
 
 SD_DEFAULTS = {
     "steps": 20,
@@ -21,6 +186,16 @@ SAMPLERS = [
     "UniPC", "DPM fast", "DPM adaptive"
 ]
 
+# Second-order and adaptive samplers evaluate the model more than once per step
+SAMPLER_COST = {
+    "Heun": 2.0,
+    "DPM2": 2.0, "DPM2 Karras": 2.0, "DPM2 a": 2.0, "DPM2 a Karras": 2.0,
+    "DPM++ SDE": 2.0, "DPM++ SDE Karras": 2.0,
+    "DPM adaptive": 3.0,
+}
+
+SCHEDULERS = ["Automatic", "Karras", "Exponential", "Polyexponential", "SGM Uniform", "Simple", "Normal", "DDIM", "Beta"]
+
 PRESET_SIZES = {
     "Square 512x512": (512, 512),
     "Square 768x768": (768, 768),
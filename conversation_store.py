@@ -0,0 +1,265 @@
+import asyncio
+import time
+import uuid
+import logging
+from collections import OrderedDict
+from telegram.ext import ConversationHandler
+from config import CONVERSATION_STATE_TTL, CONVERSATION_CACHE_TTL, CONVERSATION_CACHE_MAX
+
+logger = logging.getLogger(__name__)
+
+# Which custom-input prompt (WAITING_STEPS, ...) a user is answering. With one
+# instance the ConversationHandler's own dict is enough; with several, the
+# reply may reach an instance that never saw the button press, so the state
+# has to live in a store all instances share.
+
+def _store_key(key):
+    return ":".join(str(part) for part in key)
+
+def _parse_key(text):
+    return tuple(int(part) for part in text.split(":"))
+
+class ConversationStore:
+    # Backends map "chat:user" to a state int. Every write is announced to the
+    # other instances so they can drop their cached copy.
+
+    async def load(self, key):
+        return None
+
+    async def save_many(self, items, origin=None):
+        # items: key -> state, or None to end the conversation; origin is
+        # the writing instance, passed on to subscribers
+        pass
+
+    async def subscribe(self, on_change):
+        # on_change(key, origin) is called for every write, including our own
+        pass
+
+    async def close(self):
+        pass
+
+class LocalConversationStore(ConversationStore):
+    # In-process stand-in for a shared store. Several SharedConversations on
+    # one instance of it behave like several bot instances on Redis; latency
+    # simulates the network hop.
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self._states = {}
+        self._subscribers = []
+
+    async def load(self, key):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._states.get(key)
+
+    async def save_many(self, items, origin=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        for key, state in items.items():
+            if state is None:
+                self._states.pop(key, None)
+            else:
+                self._states[key] = state
+        loop = asyncio.get_running_loop()
+        for on_change in self._subscribers:
+            for key in items:
+                loop.call_soon(on_change, key, origin)
+
+    async def subscribe(self, on_change):
+        self._subscribers.append(on_change)
+
+class RedisConversationStore(ConversationStore):
+    def __init__(self, url, ttl=CONVERSATION_STATE_TTL, prefix="conversation:", channel="conversation-changes"):
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url)
+        self.ttl = int(ttl)
+        self.prefix = prefix
+        self.channel = channel
+        self._listener = None
+
+    async def load(self, key):
+        state = await self._redis.get(f"{self.prefix}{key}")
+        return int(state) if state is not None else None
+
+    async def save_many(self, items, origin=None):
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for key, state in items.items():
+                if state is None:
+                    pipe.delete(f"{self.prefix}{key}")
+                else:
+                    # Abandoned prompts expire instead of trapping the user's next message
+                    pipe.set(f"{self.prefix}{key}", state, ex=self.ttl)
+                pipe.publish(self.channel, f"{origin} {key}")
+            await pipe.execute()
+
+    async def subscribe(self, on_change):
+        pubsub = self._redis.pubsub()
+        await pubsub.subscribe(self.channel)
+
+        async def listen():
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                origin, _, key = message["data"].decode().partition(" ")
+                on_change(key, origin)
+
+        self._listener = asyncio.create_task(listen())
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+        await self._redis.aclose()
+
+class SharedConversations(dict):
+    # Stands in for ConversationHandler's state dict, which it reads
+    # synchronously. prefetch() runs before each update and fills the dict from
+    # the store unless the local copy is fresh, so the handler's lookups never
+    # wait on the network. Writes land locally at once and go to the store in
+    # order from one writer task. Copies are fresh for cache_ttl seconds or
+    # until another instance announces a change.
+
+    def __init__(self, store, cache_ttl=CONVERSATION_CACHE_TTL, max_entries=CONVERSATION_CACHE_MAX):
+        super().__init__()
+        self.store = store
+        self.cache_ttl = cache_ttl
+        self.max_entries = max_entries
+        self.instance_id = uuid.uuid4().hex[:12]
+        # key -> time the local copy was known to match the store; keys without
+        # a state are cached too, as "no conversation"
+        self._fresh = OrderedDict()
+        self._pending = {}
+        self._wakeup = None
+        self._writer = None
+        self.metrics = {"hits": 0, "loads": 0, "writes": 0, "invalidations": 0, "errors": 0}
+
+    def __setitem__(self, key, state):
+        super().__setitem__(key, state)
+        self._changed(key, state)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed(key, None)
+
+    def pop(self, key, *default):
+        had_key = key in self
+        value = super().pop(key, *default)
+        if had_key:
+            self._changed(key, None)
+        return value
+
+    def _changed(self, key, state):
+        self._pending[key] = state
+        self._touch(key, time.monotonic())
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _touch(self, key, now):
+        self._fresh[key] = now
+        self._fresh.move_to_end(key)
+        while len(self._fresh) > self.max_entries:
+            old_key, _ = self._fresh.popitem(last=False)
+            if old_key not in self._pending:
+                super().pop(old_key, None)
+
+    async def prefetch(self, key):
+        now = time.monotonic()
+        loaded_at = self._fresh.get(key)
+        if key in self._pending or (loaded_at is not None and now - loaded_at < self.cache_ttl):
+            self.metrics["hits"] += 1
+            return
+        try:
+            state = await self.store.load(_store_key(key))
+        except Exception as e:
+            # The local copy, if any, is the best guess left
+            self.metrics["errors"] += 1
+            logger.error(f"Conversation state load for {key} failed: {e}")
+            return
+        self.metrics["loads"] += 1
+        if key in self._pending:
+            # Written locally while the load was in flight; ours is newer
+            return
+        if state is None:
+            super().pop(key, None)
+        else:
+            super().__setitem__(key, state)
+        self._touch(key, now)
+
+    def _on_change(self, key, origin):
+        if origin == self.instance_id:
+            return
+        key = _parse_key(key)
+        if key in self._pending:
+            return
+        self.metrics["invalidations"] += 1
+        self._fresh.pop(key, None)
+        super().pop(key, None)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        items = {_store_key(key): state for key, state in pending.items()}
+        try:
+            await self.store.save_many(items, origin=self.instance_id)
+            self.metrics["writes"] += len(items)
+        except Exception as e:
+            self.metrics["errors"] += 1
+            logger.error(f"Conversation state write of {len(items)} key(s) failed: {e}")
+            for key, state in pending.items():
+                self._pending.setdefault(key, state)
+
+    async def _write_loop(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            await self.flush()
+
+    async def start(self):
+        if self._writer is None:
+            await self.store.subscribe(self._on_change)
+            self._wakeup = asyncio.Event()
+            self._writer = asyncio.create_task(self._write_loop())
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.cancel()
+            await asyncio.gather(self._writer, return_exceptions=True)
+            self._writer = None
+            self._wakeup = None
+        await self.flush()
+        await self.store.close()
+
+    def stats(self):
+        return {
+            "store": type(self.store).__name__,
+            "cached": len(self._fresh),
+            "waiting": len(self),
+            "pending_writes": len(self._pending),
+            **self.metrics,
+        }
+
+class SharedConversationHandler(ConversationHandler):
+    # ConversationHandler keeps its states in self._conversations; this swaps
+    # in a SharedConversations so they are shared between instances
+    def __init__(self, *args, conversations=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if conversations is not None:
+            self._conversations = conversations
+
+def create_conversations(kind, redis_url):
+    if kind == "redis":
+        return SharedConversations(RedisConversationStore(redis_url))
+    if kind == "local":
+        return SharedConversations(LocalConversationStore())
+    if kind != "memory":
+        logger.warning(f"Unknown CONVERSATION_STORE '{kind}', falling back to memory")
+    return None
+
+def conversation_key(update):
+    # Matches ConversationHandler's key with per_chat and per_user on
+    chat, user = update.effective_chat, update.effective_user
+    if chat is None or user is None:
+        return None
+    return (chat.id, user.id)
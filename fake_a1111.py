@@ -0,0 +1,255 @@
+import asyncio
+import base64
+import json
+import random
+import struct
+import time
+import zlib
+from functools import lru_cache
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+import uvicorn
+
+# Stand-in for the Automatic1111 API used by benchmark.py. One asyncio.Lock
+# models the single GPU: calls are served one at a time. A call costs
+#   call_overhead + images * (per_image + per_megapixel_step * steps * megapixels)
+# seconds (a hires pass adds its own share), optionally scaled by a lognormal
+# factor with sigma `jitter`. failure_rate answers a share of calls with a 500
+# and hang_rate holds the GPU for hang_seconds, as a stuck node would; both
+# can be changed at runtime through POST /fake/config.
+
+SAMPLERS = [
+    "DPM++ 2M", "DPM++ SDE", "DPM++ 2M SDE", "Euler a", "Euler", "LMS", "Heun", "DPM2", "DDIM", "UniPC"
+]
+SCHEDULERS = ["Automatic", "Uniform", "Karras", "Exponential", "Polyexponential", "SGM Uniform"]
+MODELS = ["v1-5-pruned-emaonly.safetensors", "sd_xl_base_1.0.safetensors"]
+
+def _png_chunk(tag, data):
+    chunk = tag + data
+    return struct.pack(">I", len(data)) + chunk + struct.pack(">I", zlib.crc32(chunk) & 0xffffffff)
+
+@lru_cache(maxsize=16)
+def canned_png(width, height):
+    # Noise compresses poorly, so the PNG is roughly as large as a real render
+    rng = random.Random(width * 10007 + height)
+    raw = b"".join(b"\x00" + rng.randbytes(width * 3) for _ in range(height))
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + _png_chunk(b"IHDR", header)
+        + _png_chunk(b"IDAT", zlib.compress(raw, 1))
+        + _png_chunk(b"IEND", b"")
+    )
+
+@lru_cache(maxsize=16)
+def canned_png_b64(width, height):
+    return base64.b64encode(canned_png(width, height)).decode("ascii")
+
+def job_seconds(payload, config, rng):
+    images = int(payload.get("batch_size", 1)) * int(payload.get("n_iter", 1))
+    steps = int(payload.get("steps", 20))
+    megapixels = int(payload.get("width", 512)) * int(payload.get("height", 512)) / 1e6
+    per_image = config["per_image"] + config["per_megapixel_step"] * steps * megapixels
+    if payload.get("enable_hr"):
+        hr_megapixels = int(payload.get("hr_resize_x") or 0) * int(payload.get("hr_resize_y") or 0) / 1e6
+        hr_steps = int(payload.get("hr_second_pass_steps") or steps) * float(payload.get("denoising_strength", 0.7))
+        per_image += config["per_megapixel_step"] * hr_steps * hr_megapixels
+    if "init_images" in payload:
+        # img2img skips the first part of the schedule
+        per_image *= float(payload.get("denoising_strength", 0.75))
+    seconds = config["call_overhead"] + images * per_image
+    if config["jitter"]:
+        seconds *= rng.lognormvariate(0, config["jitter"])
+    return seconds
+
+def create_app(call_overhead=0.5, per_image=0.25, per_megapixel_step=0.0, jitter=0.0,
+               failure_rate=0.0, hang_rate=0.0, hang_seconds=600.0, seed=None):
+    app = FastAPI()
+    gpu = asyncio.Lock()
+    rng = random.Random(seed)
+    app.state.config = {
+        "call_overhead": call_overhead,
+        "per_image": per_image,
+        "per_megapixel_step": per_megapixel_step,
+        "jitter": jitter,
+        "failure_rate": failure_rate,
+        "hang_rate": hang_rate,
+        "hang_seconds": hang_seconds,
+    }
+    app.state.calls = 0
+    app.state.img2img_calls = 0
+    app.state.images = 0
+    app.state.failures = 0
+    app.state.interrupts = 0
+    app.state.job_started = None
+    app.state.job_duration = 0.0
+    app.state.interrupted = asyncio.Event()
+    app.state.model = MODELS[0]
+
+    @app.post("/sdapi/v1/txt2img")
+    async def txt2img(payload: dict):
+        return await render(payload)
+
+    @app.post("/sdapi/v1/img2img")
+    async def img2img(payload: dict):
+        # The source is only checked for being valid base64; the output is canned like txt2img
+        for image in payload.get("init_images") or []:
+            base64.b64decode(image, validate=True)
+        if payload.get("mask"):
+            base64.b64decode(payload["mask"], validate=True)
+        app.state.img2img_calls += 1
+        return await render(payload)
+
+    async def render(payload):
+        config = app.state.config
+        if rng.random() < config["failure_rate"]:
+            app.state.failures += 1
+            return JSONResponse({"error": "RuntimeError", "detail": "Injected failure"}, status_code=500)
+        sampler = payload.get("sampler_name") or "Euler"
+        if sampler not in SAMPLERS and sampler.rsplit(" ", 1)[0] not in SAMPLERS:
+            # A1111 answers unknown samplers only after the request is queued
+            async with gpu:
+                await asyncio.sleep(app.state.config["call_overhead"])
+            return JSONResponse({"detail": f"Sampler not found: {sampler}"}, status_code=404)
+        batch_size = int(payload.get("batch_size", 1)) * int(payload.get("n_iter", 1))
+        width = int(payload.get("width", 512))
+        height = int(payload.get("height", 512))
+        if payload.get("enable_hr"):
+            width = int(payload.get("hr_resize_x") or width)
+            height = int(payload.get("hr_resize_y") or height)
+        async with gpu:
+            duration = job_seconds(payload, config, rng)
+            if rng.random() < config["hang_rate"]:
+                duration = config["hang_seconds"]
+            app.state.job_started = time.monotonic()
+            app.state.job_duration = duration
+            app.state.interrupted.clear()
+            try:
+                # /interrupt ends the job early; A1111 still answers with what it has
+                await asyncio.wait_for(app.state.interrupted.wait(), duration)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                app.state.job_started = None
+        app.state.calls += 1
+        app.state.images += batch_size
+        seed = int(payload.get("seed", -1))
+        if seed == -1:
+            seed = rng.randrange(2 ** 32)
+        info = {"seed": seed, "all_seeds": [seed + i for i in range(batch_size)]}
+        return {
+            "images": [canned_png_b64(width, height)] * batch_size,
+            "parameters": payload,
+            "info": json.dumps(info),
+        }
+
+    @app.post("/sdapi/v1/interrupt")
+    async def interrupt():
+        if app.state.job_started is not None:
+            app.state.interrupts += 1
+            app.state.interrupted.set()
+        return {}
+
+    @app.get("/sdapi/v1/progress")
+    async def progress(skip_current_image: bool = False):
+        if app.state.job_started is None:
+            return {"progress": 0.0, "eta_relative": 0.0, "state": {"job_count": 0}, "current_image": None}
+        elapsed = time.monotonic() - app.state.job_started
+        fraction = min(elapsed / app.state.job_duration, 1.0) if app.state.job_duration else 1.0
+        return {
+            "progress": fraction,
+            "eta_relative": max(app.state.job_duration - elapsed, 0.0),
+            "state": {"job_count": 1},
+            "current_image": None if skip_current_image else canned_png_b64(64, 64),
+        }
+
+    @app.get("/sdapi/v1/samplers")
+    async def samplers():
+        return [{"name": name, "aliases": [], "options": {}} for name in SAMPLERS]
+
+    @app.get("/sdapi/v1/schedulers")
+    async def schedulers():
+        return [
+            {"name": name.lower().replace(" ", "_"), "label": name, "aliases": None,
+             "default_rho": -1, "need_inner_model": False}
+            for name in SCHEDULERS
+        ]
+
+    @app.get("/sdapi/v1/sd-models")
+    async def sd_models():
+        return [
+            {"title": name, "model_name": name.rsplit(".", 1)[0], "hash": None, "sha256": None,
+             "filename": f"/models/Stable-diffusion/{name}", "config": None}
+            for name in MODELS
+        ]
+
+    @app.get("/sdapi/v1/options")
+    async def options():
+        return {"sd_model_checkpoint": app.state.model, "samples_format": "png"}
+
+    @app.post("/sdapi/v1/options")
+    async def set_options(payload: dict):
+        if payload.get("sd_model_checkpoint") in MODELS:
+            app.state.model = payload["sd_model_checkpoint"]
+        return None
+
+    @app.get("/fake/config")
+    async def get_config():
+        return {**app.state.config, "calls": app.state.calls, "failures": app.state.failures,
+                "interrupts": app.state.interrupts}
+
+    @app.post("/fake/config")
+    async def set_config(payload: dict):
+        app.state.config.update({key: float(value) for key, value in payload.items() if key in app.state.config})
+        return app.state.config
+
+    return app
+
+async def serve(app, port=0):
+    config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="off")
+    server = uvicorn.Server(config)
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, task, f"http://127.0.0.1:{port}"
+
+async def spawn(call_overhead=0.5, per_image=0.25, **options):
+    # Runs the fake backend in a child process so its allocations do not
+    # show up in the caller's memory measurements. options are create_app
+    # keyword arguments, passed on as FAKE_<NAME> variables.
+    import os
+    import socket
+    import sys
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    env = dict(os.environ, PORT=str(port), FAKE_CALL_OVERHEAD=str(call_overhead), FAKE_PER_IMAGE=str(per_image))
+    env.update({f"FAKE_{name.upper()}": str(value) for name, value in options.items()})
+    process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+    for _ in range(200):
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            break
+        except OSError:
+            await asyncio.sleep(0.05)
+    return process, f"http://127.0.0.1:{port}"
+
+if __name__ == "__main__":
+    import os
+    uvicorn.run(
+        create_app(
+            call_overhead=float(os.getenv("FAKE_CALL_OVERHEAD", "0.5")),
+            per_image=float(os.getenv("FAKE_PER_IMAGE", "0.25")),
+            per_megapixel_step=float(os.getenv("FAKE_PER_MEGAPIXEL_STEP", "0")),
+            jitter=float(os.getenv("FAKE_JITTER", "0")),
+            failure_rate=float(os.getenv("FAKE_FAILURE_RATE", "0")),
+            hang_rate=float(os.getenv("FAKE_HANG_RATE", "0")),
+            hang_seconds=float(os.getenv("FAKE_HANG_SECONDS", "600")),
+            seed=int(os.environ["FAKE_SEED"]) if os.getenv("FAKE_SEED") else None
+        ),
+        host="127.0.0.1",
+        port=int(os.getenv("PORT", "7860")),
+        log_level="warning"
+    )
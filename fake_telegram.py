@@ -0,0 +1,153 @@
+import asyncio
+import itertools
+import json
+import time
+from collections import deque
+from urllib.parse import parse_qsl
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+import uvicorn
+
+# Stand-in for the Telegram Bot API used by benchmark.py. Point the bot at it
+# with TELEGRAM_BASE_URL=<url>/bot. Every call is answered with a plausible
+# result and recorded with its wall-clock time, so a benchmark in another
+# process can match deliveries to the updates it sent. With chat_limit set it
+# enforces Telegram's flood control: more than chat_limit calls to one chat
+# within a second are refused with 429 and retry_after.
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+def form_fields(body, content_type):
+    # Text fields of a urlencoded or multipart body; uploaded files are skipped
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    if not content_type.startswith("multipart/form-data"):
+        return dict(parse_qsl(body.decode()))
+    boundary = content_type.split("boundary=", 1)[1].strip('"').encode()
+    fields = {}
+    for part in body.split(b"--" + boundary):
+        head, _, value = part.partition(b"\r\n\r\n")
+        if b"filename=" in head or b'name="' not in head:
+            continue
+        name = head.split(b'name="', 1)[1].split(b'"', 1)[0].decode()
+        fields[name] = value[:-2].decode(errors="replace") if value.endswith(b"\r\n") else value.decode(errors="replace")
+    return fields
+
+def create_app(latency=0.0, chat_limit=0, retry_after=1):
+    app = FastAPI()
+    message_ids = itertools.count(1000)
+    app.state.events = []
+    app.state.calls = {}
+    app.state.flooded = 0
+    app.state.webhook_url = ""
+    recent_calls = {}
+
+    def flooded(chat_id, now):
+        if not chat_limit or not chat_id:
+            return False
+        calls = recent_calls.setdefault(chat_id, deque())
+        while calls and now - calls[0] > 1:
+            calls.popleft()
+        if len(calls) >= chat_limit:
+            return True
+        calls.append(now)
+        return False
+
+    def message(fields, **extra):
+        chat_id = int(fields.get("chat_id") or 0)
+        return {
+            "message_id": int(fields.get("message_id") or next(message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": "Bench"},
+            "from": BOT_USER,
+            **extra,
+        }
+
+    def photo(file_id):
+        return [{"file_id": file_id, "file_unique_id": file_id, "width": 512, "height": 512}]
+
+    @app.post("/bot{token}/{method}")
+    async def call(token: str, method: str, request: Request):
+        body = await request.body()
+        fields = form_fields(body, request.headers.get("content-type", ""))
+        if latency:
+            await asyncio.sleep(latency)
+        if flooded(int(fields.get("chat_id") or 0), time.monotonic()):
+            app.state.flooded += 1
+            return JSONResponse({
+                "ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {retry_after}",
+                "parameters": {"retry_after": retry_after},
+            }, status_code=429)
+        app.state.calls[method] = app.state.calls.get(method, 0) + 1
+        app.state.events.append({
+            "t": time.time(),
+            "method": method,
+            "chat_id": int(fields.get("chat_id") or 0),
+            "bytes": len(body),
+            "text": (fields.get("text") or fields.get("caption") or "")[:80],
+        })
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method in ("sendPhoto", "editMessageMedia"):
+            result = message(fields, photo=photo(f"photo{next(message_ids)}"), caption=fields.get("caption"))
+        elif method == "sendDocument":
+            result = message(fields, document={"file_id": f"doc{next(message_ids)}", "file_unique_id": "doc"})
+        elif method == "sendMediaGroup":
+            media = json.loads(fields.get("media") or "[]")
+            result = [message(fields, photo=photo(f"photo{next(message_ids)}")) for _ in media]
+        elif method in ("sendMessage", "editMessageText"):
+            result = message(fields, text=fields.get("text", ""))
+        elif method == "getWebhookInfo":
+            result = {"url": app.state.webhook_url, "has_custom_certificate": False, "pending_update_count": 0}
+        elif method == "setWebhook":
+            app.state.webhook_url = fields.get("url", "")
+            result = True
+        elif method == "getFile":
+            result = {"file_id": fields.get("file_id"), "file_unique_id": fields.get("file_id"), "file_size": 0}
+        else:
+            # answerCallbackQuery, deleteMessage, setWebhook, ...
+            result = True
+        return {"ok": True, "result": result}
+
+    @app.get("/fake/events")
+    async def events(since: float = 0.0):
+        return {
+            "events": [event for event in app.state.events if event["t"] > since],
+            "calls": app.state.calls,
+            "flooded": app.state.flooded,
+        }
+
+    return app
+
+async def spawn(latency=0.0, chat_limit=0):
+    # Same as fake_a1111.spawn: a child process keeps the fake's allocations
+    # and CPU out of the bot's measurements
+    import os
+    import socket
+    import sys
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    env = dict(os.environ, PORT=str(port), FAKE_TELEGRAM_LATENCY=str(latency), FAKE_TELEGRAM_CHAT_LIMIT=str(chat_limit))
+    process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+    for _ in range(200):
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            break
+        except OSError:
+            await asyncio.sleep(0.05)
+    return process, f"http://127.0.0.1:{port}"
+
+if __name__ == "__main__":
+    import os
+    uvicorn.run(
+        create_app(
+            latency=float(os.getenv("FAKE_TELEGRAM_LATENCY", "0")),
+            chat_limit=int(os.getenv("FAKE_TELEGRAM_CHAT_LIMIT", "0"))
+        ),
+        host="127.0.0.1",
+        port=int(os.getenv("PORT", "8081")),
+        log_level="warning"
+    )
@@ -1,69 +1,195 @@
-import requests
+import asyncio
+import random
+import time
+import httpx
 import base64
-from io import BytesIO
-from config import GRADIO_API_URL
+import json
+from config import (
+    GRADIO_API_URLS, GRADIO_CONNECT_TIMEOUT, GRADIO_READ_TIMEOUT,
+    GRADIO_MAX_CONNECTIONS, GRADIO_KEEPALIVE_CONNECTIONS,
+    BACKEND_HEALTH_TIMEOUT, PROGRESS_POLL_INTERVAL, PROGRESS_PREVIEWS, PAYLOAD_LOG_SAMPLE_RATE,
+    RETRY_MAX_ATTEMPTS, RETRY_BACKOFF_BASE, RETRY_BACKOFF_MAX, HEDGE_AFTER, IMG2IMG_MASK_BLUR
+)
+from backends import BackendPool, parse_backend_urls
+from capabilities import CapabilityRegistry
+from image_stream import Txt2ImgStreamParser, Base64JsonBody
+from metrics import TXT2IMG_SECONDS, IMG2IMG_SECONDS, DECODE_SECONDS, ERRORS, RETRIES, HEDGES, generation_labels
 import logging
 
 logger = logging.getLogger(__name__)
 
+class BackendUnavailableError(RuntimeError):
+    # may_be_running: the backend may still be rendering the request (e.g. a read
+    # timeout), so repeating it elsewhere could double the GPU work
+    def __init__(self, message, may_be_running=False):
+        super().__init__(message)
+        self.may_be_running = may_be_running
+
 class GradioConnector:
-    def __init__(self):
-        self.api_url = GRADIO_API_URL
+    def __init__(self, api_urls=None):
+        self.api_urls = api_urls or GRADIO_API_URLS
+        self.pool = None
         self.is_available = False
+        self._client = None
+        # Fire-and-forget interrupts of abandoned hedge calls, kept so they are not collected mid-flight
+        self._interrupts = set()
         self.connect()
+        self.capabilities = CapabilityRegistry(self.pool)
     
     def connect(self):
         try:
-            if not self.api_url:
+            backends = parse_backend_urls(self.api_urls)
+            if not backends:
                 logger.warning("GRADIO_API_URL not set - image generation will be unavailable")
                 self.is_available = False
                 return
             
+            self.pool = BackendPool(backends)
             self.is_available = True
-            logger.info(f"Connected to Automatic1111 API: {self.api_url}")
+            for url, weight in backends:
+                logger.info(f"Connected to Automatic1111 API: {url} (weight {weight})")
         except Exception as e:
             logger.error(f"Failed to connect to API: {e}")
             self.is_available = False
     
-    def generate_image(self, prompt, negative_prompt, steps, cfg_scale, width, height, sampler, scheduler="Automatic",
-                       seed=-1, subseed=-1, subseed_strength=0, restore_faces=False, tiling=False, batch_size=1):
+    def start(self):
+        if self.pool is not None:
+            self.pool.start(self.client)
+            self.capabilities.start(self.client)
+    
+    @property
+    def client(self):
+        # Created lazily so the pool binds to the running event loop
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(
+                    connect=GRADIO_CONNECT_TIMEOUT,
+                    read=GRADIO_READ_TIMEOUT,
+                    write=GRADIO_CONNECT_TIMEOUT,
+                    pool=GRADIO_CONNECT_TIMEOUT
+                ),
+                limits=httpx.Limits(
+                    max_connections=GRADIO_MAX_CONNECTIONS,
+                    max_keepalive_connections=GRADIO_KEEPALIVE_CONNECTIONS
+                )
+            )
+        return self._client
+    
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.stop()
+        await self.capabilities.stop()
+        await asyncio.gather(*self._interrupts, return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    def build_payload(self, prompt, negative_prompt, steps, cfg_scale, width, height, sampler, scheduler="Automatic",
+                      seed=-1, subseed=-1, subseed_strength=0, restore_faces=False, tiling=False, batch_size=1, n_iter=1, hires=None):
+        payload = {
+            "prompt": prompt,
+            "negative_prompt": negative_prompt,
+            "steps": int(steps),
+            "cfg_scale": float(cfg_scale),
+            "width": int(width),
+            "height": int(height),
+            "sampler_name": sampler,
+            "sampler_index": sampler,
+            "scheduler": scheduler,
+            "seed": int(seed),
+            "subseed": int(subseed),
+            "subseed_strength": float(subseed_strength),
+            "seed_resize_from_h": -1,
+            "seed_resize_from_w": -1,
+            "batch_size": int(batch_size),
+            "n_iter": int(n_iter),
+            "restore_faces": restore_faces,
+            "tiling": tiling,
+            "do_not_save_samples": True,
+            "do_not_save_grid": True,
+            "save_images": False
+        }
+        if hires:
+            # Upscale the first pass to an exact size; the first pass stays identical
+            # to a plain render of the same params, so a draft keeps its composition
+            payload.update({
+                "enable_hr": True,
+                "hr_resize_x": int(hires["width"]),
+                "hr_resize_y": int(hires["height"]),
+                "hr_second_pass_steps": int(hires["steps"]),
+                "hr_upscaler": hires["upscaler"],
+                "denoising_strength": float(hires["denoising_strength"]),
+            })
+        return payload
+    
+    def build_img2img_payload(self, params):
+        # The images themselves are streamed into the body by img2img()
+        source = params["img2img"]
+        txt2img_params = {key: value for key, value in params.items() if key != "img2img"}
+        payload = self.build_payload(**txt2img_params)
+        payload.update({
+            "denoising_strength": float(source["denoising_strength"]),
+            "resize_mode": 0,
+            "include_init_images": False,
+        })
+        if source.get("mask") is not None:
+            # Repaint the white area of the mask, starting from the original pixels there
+            payload.update({
+                "mask_blur": IMG2IMG_MASK_BLUR,
+                "inpainting_fill": 1,
+                "inpaint_full_res": False,
+                "inpainting_mask_invert": 0,
+            })
+        return payload
+    
+    @staticmethod
+    def batch_key(params, prompt_lists=False):
+        # Jobs with equal keys can share one txt2img call; fixed seeds cannot,
+        # because A1111 assigns seed, seed+1, ... across a batch
+        if (params["seed"] != -1 or params["batch_size"] != 1 or params.get("n_iter", 1) != 1
+                or params.get("hires") or params.get("img2img")):
+            return None
+        key = (
+            params["steps"], params["cfg_scale"], params["width"], params["height"],
+            params["sampler"], params["scheduler"], params["restore_faces"], params["tiling"]
+        )
+        if not prompt_lists:
+            key += (params["prompt"], params["negative_prompt"])
+        return key
+    
+    async def _post(self, backend, endpoint, payload, images=None):
+        api_endpoint = f"{backend.url}/sdapi/v1/{endpoint}"
+        # Payloads are large and this runs for every job, so only a sample is logged
+        if logger.isEnabledFor(logging.DEBUG) and random.random() < PAYLOAD_LOG_SAMPLE_RATE:
+            logger.debug(f"Calling API endpoint: {api_endpoint} with payload: {payload}")
+        
+        labels = generation_labels(payload["steps"], payload["width"], payload["height"], payload["sampler_name"])
+        histogram = IMG2IMG_SECONDS if images else TXT2IMG_SECONDS
         try:
-            if not self.is_available:
-                raise RuntimeError("Image generation is not available. Please configure GRADIO_API_URL in Cloud Run environment variables.")
-            
-            logger.info(f"Generating image with prompt: {prompt[:50]}...")
-            
-            payload = {
-                "prompt": prompt,
-                "negative_prompt": negative_prompt,
-                "steps": int(steps),
-                "cfg_scale": float(cfg_scale),
-                "width": int(width),
-                "height": int(height),
-                "sampler_name": sampler,
-                "sampler_index": sampler,
-                "scheduler": scheduler,
-                "seed": int(seed),
-                "subseed": int(subseed),
-                "subseed_strength": float(subseed_strength),
-                "seed_resize_from_h": -1,
-                "seed_resize_from_w": -1,
-                "batch_size": int(batch_size),
-                "n_iter": 1,
-                "restore_faces": restore_faces,
-                "tiling": tiling,
-                "do_not_save_samples": True,
-                "do_not_save_grid": True,
-                "save_images": False
+            with histogram.time(*labels):
+                return await self._stream_images(api_endpoint, payload, backend, images)
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+            raise BackendUnavailableError(f"Could not reach backend: {type(e).__name__}")
+        except httpx.TimeoutException as e:
+            raise BackendUnavailableError(f"Backend timed out: {type(e).__name__}", may_be_running=True)
+        except httpx.HTTPError as e:
+            raise BackendUnavailableError(f"Network error: {str(e)}", may_be_running=True)
+        except ValueError as e:
+            raise RuntimeError(f"Malformed response from API: {e}")
+    
+    async def _stream_images(self, api_endpoint, payload, backend, images=None):
+        if images:
+            # Source images are base64-encoded chunk by chunk while the body is sent
+            body = Base64JsonBody(payload, images)
+            request = {
+                "content": body,
+                "headers": {"Content-Type": "application/json", "Content-Length": str(len(body))},
             }
-            
-            api_endpoint = f"{self.api_url}/sdapi/v1/txt2img"
-            logger.info(f"Calling API endpoint: {api_endpoint}")
-            logger.info(f"Payload: {payload}")
-            
-            response = requests.post(api_endpoint, json=payload, timeout=300)
-            
+        else:
+            request = {"json": payload}
+        async with self.client.stream("POST", api_endpoint, **request) as response:
             if response.status_code != 200:
+                await response.aread()
                 error_msg = f"API returned status {response.status_code}"
                 try:
                     error_detail = response.json()
@@ -71,24 +197,234 @@ class GradioConnector:
                     error_msg = f"{error_msg}: {error_detail.get('detail', 'Unknown error')}"
                 except:
                     error_msg = f"{error_msg}: {response.text[:200]}"
+                # 5xx, timeouts and throttling mean the node is sick or busy; any other
+                # 4xx (e.g. 404 "Sampler not found") means the request is bad everywhere
+                # and must neither be retried nor count against the node's breaker
+                if response.status_code >= 500 or response.status_code in (408, 429):
+                    raise BackendUnavailableError(error_msg)
                 raise RuntimeError(error_msg)
             
-            result = response.json()
-            
-            if 'images' in result and len(result['images']) > 0:
-                image_data = base64.b64decode(result['images'][0])
-                image_io = BytesIO(image_data)
-                image_io.name = 'generated_image.png'
-                image_io.seek(0)
-                logger.info("Image generated successfully")
-                return image_io
-            else:
-                raise RuntimeError("No images returned from API")
-                
-        except requests.exceptions.RequestException as e:
-            error_msg = f"Network error: {str(e)}"
-            logger.error(error_msg)
-            raise RuntimeError(error_msg)
-        except Exception as e:
-            logger.error(f"Image generation failed: {e}")
+            # Decode images as they stream in instead of holding the JSON body,
+            # its parsed copy and the decoded bytes at the same time
+            parser = Txt2ImgStreamParser()
+            decode_time = 0.0
+            async for chunk in response.aiter_bytes():
+                started = time.perf_counter()
+                parser.feed(chunk)
+                decode_time += time.perf_counter() - started
+            rest = parser.close()
+            DECODE_SECONDS.observe(decode_time)
+        
+        self._assign_seeds(parser.images, rest)
+        if parser.images:
+            logger.info(f"Generated {len(parser.images)} image(s) successfully on {backend.url}")
+            return parser.images
+        else:
+            raise RuntimeError("No images returned from API")
+    
+    @staticmethod
+    def _assign_seeds(images, rest):
+        # info is a JSON string; all_seeds lines up with the last images, after any grid
+        try:
+            seeds = json.loads(rest.get("info") or "{}").get("all_seeds") or []
+        except (AttributeError, TypeError, ValueError):
+            return
+        for image, seed in zip(reversed(images), reversed(seeds)):
+            image.seed = seed
+    
+    async def _poll_progress(self, backend, on_progress):
+        # The progress endpoint reports whatever the node is rendering, which is
+        # this call as long as each node runs one job at a time
+        params = {"skip_current_image": "false" if PROGRESS_PREVIEWS else "true"}
+        while True:
+            await asyncio.sleep(PROGRESS_POLL_INTERVAL)
+            try:
+                response = await self.client.get(
+                    f"{backend.url}/sdapi/v1/progress", params=params, timeout=BACKEND_HEALTH_TIMEOUT
+                )
+                if response.status_code != 200:
+                    continue
+                data = response.json()
+                preview = data.get("current_image")
+                await on_progress(
+                    float(data.get("progress") or 0.0),
+                    float(data.get("eta_relative") or 0.0),
+                    base64.b64decode(preview) if preview else None
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.debug(f"Progress poll on {backend.url} failed: {e}")
+    
+    async def _attempt(self, backend, endpoint, payload, images, on_progress):
+        # One call on an already acquired backend; releases it with the outcome
+        ok = None
+        poller = asyncio.create_task(self._poll_progress(backend, on_progress)) if on_progress else None
+        try:
+            result = await self._post(backend, endpoint, payload, images)
+            ok = True
+            return result
+        except BackendUnavailableError as e:
+            ok = False
+            ERRORS.inc("backend", type(e).__name__)
+            raise
+        except asyncio.CancelledError:
             raise
+        except Exception:
+            # The request itself was rejected; that says nothing bad about the node
+            ok = True
+            raise
+        finally:
+            if poller is not None:
+                poller.cancel()
+            self.pool.release(backend, ok=ok)
+    
+    async def _interrupt(self, backend):
+        try:
+            await self.client.post(f"{backend.url}/sdapi/v1/interrupt", timeout=BACKEND_HEALTH_TIMEOUT)
+        except Exception as e:
+            logger.debug(f"Interrupting {backend.url} failed: {e}")
+    
+    async def _hedged(self, backend, endpoint, payload, images, on_progress, tried):
+        primary = asyncio.create_task(self._attempt(backend, endpoint, payload, images, on_progress))
+        tasks = {primary: backend}
+        try:
+            if HEDGE_AFTER > 0 and len(self.pool) > 1:
+                await asyncio.wait([primary], timeout=HEDGE_AFTER)
+                # Only idle nodes take a hedge, so it never queues behind other work
+                second = None if primary.done() else self.pool.acquire(exclude=tried, idle_only=True)
+                if second is not None:
+                    tried.append(second)
+                    logger.info(f"Hedging slow call on {backend.url} to {second.url}")
+                    tasks[asyncio.create_task(self._attempt(second, endpoint, payload, images, None))] = second
+            
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if len(tasks) > 1:
+                            HEDGES.inc("primary" if task is primary else "hedge")
+                        return task.result()
+                    if not isinstance(task.exception(), BackendUnavailableError):
+                        raise task.exception()
+                    error = error or task.exception()
+            raise error
+        finally:
+            losers = [task for task in tasks if not task.done()]
+            for task in losers:
+                task.cancel()
+            await asyncio.gather(*losers, return_exceptions=True)
+            for task in losers:
+                # Stop the abandoned render unless the node is busy with other calls
+                if tasks[task].outstanding == 0:
+                    interrupt = asyncio.create_task(self._interrupt(tasks[task]))
+                    self._interrupts.add(interrupt)
+                    interrupt.add_done_callback(self._interrupts.discard)
+    
+    async def txt2img(self, payload, on_progress=None):
+        return await self._call("txt2img", payload, on_progress)
+    
+    async def img2img(self, payload, images, on_progress=None):
+        # images maps body fields to ImageBuffers: {"init_images": [buffer], "mask": buffer}
+        return await self._call("img2img", payload, on_progress, images)
+    
+    async def _call(self, endpoint, payload, on_progress=None, images=None):
+        if not self.is_available:
+            raise RuntimeError("Image generation is not available. Please configure GRADIO_API_URL in Cloud Run environment variables.")
+        
+        # A fixed seed makes a repeated call produce the same image, so it is safe
+        # to retry even when the first attempt may still be rendering
+        idempotent = payload.get("seed", -1) != -1
+        budget = self.pool.retry_budget
+        budget.deposit()
+        tried = []
+        attempt = 0
+        while True:
+            attempt += 1
+            backend = self.pool.acquire(exclude=tried) or (self.pool.acquire() if tried else None)
+            if backend is None:
+                error_msg = (
+                    "All image backends are unavailable, please try again in "
+                    f"~{int(self.pool.retry_in()) + 1}s."
+                )
+                logger.error(error_msg)
+                raise BackendUnavailableError(error_msg)
+            reused = backend in tried
+            if not reused:
+                tried.append(backend)
+            if reused:
+                # Full jitter keeps retries from many jobs from arriving in lockstep
+                await asyncio.sleep(random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt)))
+            
+            try:
+                return await self._hedged(backend, endpoint, payload, images, on_progress, tried)
+            except BackendUnavailableError as e:
+                logger.warning(f"Backend {backend.url} failed (attempt {attempt}): {e}")
+                if attempt >= RETRY_MAX_ATTEMPTS:
+                    RETRIES.inc("exhausted")
+                    raise
+                if e.may_be_running and not idempotent:
+                    RETRIES.inc("not_idempotent")
+                    raise
+                if not budget.withdraw():
+                    RETRIES.inc("budget_exhausted")
+                    raise
+                RETRIES.inc("retried")
+            except Exception as e:
+                logger.error(f"Image generation failed: {e}")
+                raise
+    
+    async def generate_image(self, prompt, negative_prompt, steps, cfg_scale, width, height, sampler, scheduler="Automatic",
+                             seed=-1, subseed=-1, subseed_strength=0, restore_faces=False, tiling=False, batch_size=1,
+                             n_iter=1, hires=None, on_progress=None):
+        logger.info(f"Generating image with prompt: {prompt[:50]}...")
+        payload = self.build_payload(
+            prompt, negative_prompt, steps, cfg_scale, width, height, sampler, scheduler,
+            seed, subseed, subseed_strength, restore_faces, tiling, batch_size, n_iter, hires
+        )
+        images = await self.txt2img(payload, on_progress=on_progress)
+        return images[0]
+    
+    async def generate_variations(self, params, on_progress=None):
+        # One call for every image; each returned buffer carries its seed
+        count = params["batch_size"] * params.get("n_iter", 1)
+        logger.info(f"Generating {count} variations with prompt: {params['prompt'][:50]}...")
+        images = await self.txt2img(self.build_payload(**params), on_progress=on_progress)
+        if len(images) < count:
+            raise RuntimeError(f"Backend returned {len(images)} images for {count} variations")
+        return images[-count:]
+    
+    async def generate_img2img(self, params, on_progress=None):
+        source = params["img2img"]
+        logger.info(
+            f"Editing photo ({'inpaint' if source.get('mask') is not None else 'img2img'}, "
+            f"denoise {source['denoising_strength']}) with prompt: {params['prompt'][:50]}..."
+        )
+        images = {"init_images": [source["image"]]}
+        if source.get("mask") is not None:
+            images["mask"] = source["mask"]
+        result = await self.img2img(self.build_img2img_payload(params), images, on_progress=on_progress)
+        return result[-1]
+    
+    async def generate_batch(self, params_list, prompt_lists=False, on_progress=None):
+        # Variations jobs are never merged, and their single result is a list of images
+        if len(params_list) == 1:
+            params = params_list[0]
+            if params.get("img2img"):
+                return [await self.generate_img2img(params, on_progress=on_progress)]
+            if params["batch_size"] * params.get("n_iter", 1) > 1:
+                return [await self.generate_variations(params, on_progress=on_progress)]
+            return [await self.generate_image(**params, on_progress=on_progress)]
+        
+        logger.info(f"Generating batch of {len(params_list)} images")
+        payload = self.build_payload(**{**params_list[0], "batch_size": len(params_list)})
+        if prompt_lists:
+            payload["prompt"] = [params["prompt"] for params in params_list]
+            payload["negative_prompt"] = [params["negative_prompt"] for params in params_list]
+        images = await self.txt2img(payload, on_progress=on_progress)
+        if len(images) < len(params_list):
+            raise RuntimeError(f"Backend returned {len(images)} images for a batch of {len(params_list)}")
+        # A returned grid, if any, comes first
+        return images[-len(params_list):]
@@ -0,0 +1,222 @@
+import base64
+import binascii
+import json
+import os
+import tempfile
+from config import IMAGE_SPOOL_BYTES
+
+class ImageBuffer:
+    # Single owner of a decoded image. Kept in a bytearray until it grows past
+    # spool_bytes, then moved to an anonymous temp file. Readers returned by
+    # open() share the storage, so delivering one image to several chats or
+    # uploads never copies it as a whole.
+
+    def __init__(self, data=None, spool_bytes=IMAGE_SPOOL_BYTES, name='generated_image.png'):
+        self.name = name
+        # Seed the backend reported for this image, when known
+        self.seed = None
+        self.spool_bytes = spool_bytes
+        self._data = data if data is not None else bytearray()
+        self._file = None
+        self._size = len(self._data)
+
+    def __len__(self):
+        return self._size
+
+    def write(self, chunk):
+        if self._file is None and self._size + len(chunk) > self.spool_bytes:
+            self._file = tempfile.TemporaryFile()
+            self._file.write(self._data)
+            self._data = None
+        if self._file is not None:
+            self._file.write(chunk)
+        else:
+            self._data += chunk
+        self._size += len(chunk)
+
+    def read_at(self, offset, size):
+        if self._file is not None:
+            self._file.flush()
+            return os.pread(self._file.fileno(), size, offset)
+        return bytes(memoryview(self._data)[offset:offset + size])
+
+    def getvalue(self):
+        return self.read_at(0, self._size)
+
+    def open(self):
+        return ImageReader(self)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._data = bytearray()
+        self._size = 0
+
+class ImageReader:
+    # Minimal read-only file object over an ImageBuffer. There is deliberately
+    # no fileno(): httpx then sizes the upload with seek/tell and reads it in
+    # chunks instead of loading it into memory.
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self._pos = 0
+        self.name = buffer.name
+
+    def read(self, size=-1):
+        remaining = len(self._buffer) - self._pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        chunk = self._buffer.read_at(self._pos, size)
+        self._pos += len(chunk)
+        return chunk
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self._pos = offset
+        elif whence == os.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = len(self._buffer) + offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        pass
+
+class Base64JsonBody:
+    # Request body for endpoints that take base64 images (img2img). The JSON is
+    # produced piece by piece, encoding each ImageBuffer in chunks as it is
+    # sent, so the body never exists as one string. `images` maps a field name
+    # to an ImageBuffer, or a list of them for array fields like init_images.
+    # The body can be iterated again, e.g. when a call is retried.
+
+    def __init__(self, payload, images, chunk_size=3 * 16384):
+        self.chunk_size = chunk_size - chunk_size % 3
+        head = json.dumps(payload)
+        self._parts = [head[:-1].encode()]
+        separator = b", " if payload else b""
+        for field, value in images.items():
+            buffers = value if isinstance(value, list) else [value]
+            self._parts.append(separator + json.dumps(field).encode() + (b': ["' if isinstance(value, list) else b': "'))
+            for i, buffer in enumerate(buffers):
+                if i:
+                    self._parts.append(b'", "')
+                self._parts.append(buffer)
+            self._parts.append(b'"]' if isinstance(value, list) else b'"')
+            separator = b", "
+        self._parts.append(b"}")
+
+    def __len__(self):
+        return sum(4 * -(-len(part) // 3) if isinstance(part, ImageBuffer) else len(part) for part in self._parts)
+
+    async def __aiter__(self):
+        for part in self._parts:
+            if not isinstance(part, ImageBuffer):
+                yield part
+                continue
+            # Chunks are multiples of 3 bytes, so they encode without padding in between
+            for offset in range(0, len(part), self.chunk_size):
+                yield base64.b64encode(part.read_at(offset, self.chunk_size))
+
+class Txt2ImgStreamParser:
+    # Incremental parser for the txt2img JSON response. Base64 strings inside
+    # the top-level "images" array are decoded straight into ImageBuffers as
+    # chunks arrive; everything else is kept and parsed with json at the end.
+
+    def __init__(self, spool_bytes=IMAGE_SPOOL_BYTES):
+        self.spool_bytes = spool_bytes
+        self.images = []
+        self._rest = bytearray()
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string = bytearray()
+        self._last_string = None
+        self._await_images = False
+        self._in_images = False
+        self._current = None
+        self._pending = b""
+
+    def _decode(self, data):
+        data = self._pending + data
+        # Keep an escape sequence split across chunks for the next call
+        cut = len(data) - 1 if data.endswith(b"\\") else len(data)
+        text, keep = data[:cut], data[cut:]
+        if b"\\" in text:
+            text = text.replace(b"\\/", b"/").replace(b"\\n", b"")
+        usable = len(text) - len(text) % 4
+        self._pending = text[usable:] + keep
+        if usable:
+            self._current.write(binascii.a2b_base64(text[:usable]))
+
+    def _finish_image(self):
+        if self._pending:
+            self._current.write(binascii.a2b_base64(self._pending + b"=" * (-len(self._pending) % 4)))
+            self._pending = b""
+        self.images.append(self._current)
+        self._current = None
+
+    def feed(self, chunk):
+        pos = 0
+        size = len(chunk)
+        while pos < size:
+            if self._current is not None:
+                end = chunk.find(b'"', pos)
+                if end == -1:
+                    self._decode(chunk[pos:])
+                    return
+                self._decode(chunk[pos:end])
+                self._finish_image()
+                pos = end + 1
+                continue
+
+            c = chunk[pos]
+            pos += 1
+
+            if self._in_images:
+                if c == 0x22:
+                    self._current = ImageBuffer(spool_bytes=self.spool_bytes)
+                elif c == 0x5d:
+                    self._in_images = False
+                    self._rest += b"[]"
+                continue
+
+            if self._in_string:
+                self._rest.append(c)
+                if self._escape:
+                    self._escape = False
+                elif c == 0x5c:
+                    self._escape = True
+                elif c == 0x22:
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_string = bytes(self._string)
+                else:
+                    if self._depth == 1:
+                        self._string.append(c)
+                continue
+
+            if self._await_images and c not in b" \t\r\n":
+                self._await_images = False
+                if c == 0x5b:
+                    self._in_images = True
+                    continue
+
+            self._rest.append(c)
+            if c == 0x22:
+                self._in_string = True
+                self._string.clear()
+            elif c in b"{[":
+                self._depth += 1
+            elif c in b"}]":
+                self._depth -= 1
+            elif c == 0x3a and self._depth == 1 and self._last_string == b"images":
+                self._await_images = True
+
+    def close(self):
+        if self._current is not None:
+            raise ValueError("Response ended inside an image")
+        return json.loads(bytes(self._rest))
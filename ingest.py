@@ -0,0 +1,110 @@
+import asyncio
+import time
+import logging
+from collections import OrderedDict
+from config import WEBHOOK_WORKERS, WEBHOOK_QUEUE_MAX, WEBHOOK_DEDUP_SIZE
+from metrics import UPDATE_SECONDS, ERRORS
+
+logger = logging.getLogger(__name__)
+
+UPDATE_KINDS = (
+    "message", "edited_message", "callback_query", "inline_query",
+    "chosen_inline_result", "my_chat_member", "chat_member"
+)
+
+def update_key(data):
+    # Updates from one user always land on the same shard, which keeps them in
+    # order for ConversationHandler; anything without a sender is spread by id
+    for kind in UPDATE_KINDS:
+        payload = data.get(kind)
+        if payload:
+            sender = payload.get("from") or payload.get("chat") or {}
+            if "id" in sender:
+                return sender["id"]
+    return data.get("update_id", 0)
+
+class UpdateIngestor:
+    def __init__(self, process, workers=WEBHOOK_WORKERS, max_queue=WEBHOOK_QUEUE_MAX,
+                 dedup_size=WEBHOOK_DEDUP_SIZE):
+        self.process = process
+        self.workers = workers
+        self.dedup_size = dedup_size
+        per_shard = max(1, max_queue // workers)
+        self._queues = [asyncio.Queue(maxsize=per_shard) for _ in range(workers)]
+        self._seen = OrderedDict()
+        self._tasks = []
+        self.metrics = {
+            "accepted": 0,
+            "duplicates": 0,
+            "rejected": 0,
+            "processed": 0,
+            "errors": 0,
+            "queue_time_total": 0.0,
+        }
+
+    def submit(self, data):
+        # Returns "accepted", "duplicate" or "full"; never waits
+        update_id = data.get("update_id")
+        if update_id is not None and update_id in self._seen:
+            self.metrics["duplicates"] += 1
+            return "duplicate"
+
+        queue = self._queues[hash(update_key(data)) % self.workers]
+        try:
+            queue.put_nowait((time.monotonic(), data))
+        except asyncio.QueueFull:
+            self.metrics["rejected"] += 1
+            return "full"
+
+        if update_id is not None:
+            self._seen[update_id] = None
+            if len(self._seen) > self.dedup_size:
+                self._seen.popitem(last=False)
+        self.metrics["accepted"] += 1
+        return "accepted"
+
+    async def _worker(self, queue):
+        while True:
+            queued_at, data = await queue.get()
+            self.metrics["queue_time_total"] += time.monotonic() - queued_at
+            try:
+                with UPDATE_SECONDS.time():
+                    await self.process(data)
+                self.metrics["processed"] += 1
+            except Exception as e:
+                self.metrics["errors"] += 1
+                ERRORS.inc("update", type(e).__name__)
+                logger.error(f"Update {data.get('update_id')} failed: {e}")
+            finally:
+                queue.task_done()
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+
+    async def stop(self, timeout=10):
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Shutting down with unprocessed updates in the queue")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @property
+    def depth(self):
+        return sum(queue.qsize() for queue in self._queues)
+
+    def stats(self):
+        processed = self.metrics["processed"] + self.metrics["errors"]
+        return {
+            "depth": self.depth,
+            "workers": self.workers,
+            "accepted": self.metrics["accepted"],
+            "duplicates": self.metrics["duplicates"],
+            "rejected": self.metrics["rejected"],
+            "processed": self.metrics["processed"],
+            "errors": self.metrics["errors"],
+            "avg_queue_seconds": self.metrics["queue_time_total"] / processed if processed else 0.0,
+        }
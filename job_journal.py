@@ -0,0 +1,298 @@
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+import logging
+from image_stream import ImageBuffer
+from sqlite_db import SQLiteDatabase
+from config import (
+    JOB_JOURNAL_PATH, JOB_JOURNAL_FLUSH_INTERVAL, JOB_JOURNAL_SYNC, JOB_JOURNAL_SPOOL_RESULTS,
+    JOB_JOURNAL_RESUME_MAX_AGE, JOB_JOURNAL_RETENTION, JOB_JOURNAL_LEASE
+)
+
+logger = logging.getLogger(__name__)
+
+# pending -> rendered -> delivered; failed and abandoned are also final.
+# A job cut off by a restart is left pending or rendered for recover().
+# Every open job is leased by the process running it, which renews the lease
+# while it lives; only jobs whose lease ran out are recovered, so processes
+# sharing the journal never take over each other's live jobs.
+PENDING, RENDERED, DELIVERED, FAILED, ABANDONED, RESUMED = (
+    "pending", "rendered", "delivered", "failed", "abandoned", "resumed"
+)
+FINAL_STATES = (DELIVERED, FAILED, ABANDONED, RESUMED)
+COLUMNS = ("job_id", "user_id", "chat_id", "message_id", "mode", "params", "state", "seeds", "results",
+           "owner", "lease_until", "created_at", "updated_at")
+
+class JobJournal:
+    def __init__(self, path=JOB_JOURNAL_PATH, flush_interval=JOB_JOURNAL_FLUSH_INTERVAL,
+                 sync=JOB_JOURNAL_SYNC, spool_results=JOB_JOURNAL_SPOOL_RESULTS, lease=JOB_JOURNAL_LEASE):
+        self.path = path or None
+        self.lease = lease
+        self.owner = uuid.uuid4().hex[:12]
+        self.flush_interval = flush_interval
+        self.sync = sync if sync in ("off", "normal", "full") else "normal"
+        self.spool_dir = f"{path}.results" if path and spool_results else None
+        self._db = SQLiteDatabase(self.path, schema=(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, user_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, "
+            "message_id INTEGER, mode TEXT NOT NULL, params TEXT NOT NULL, state TEXT NOT NULL, "
+            "seeds TEXT, results TEXT, owner TEXT NOT NULL, lease_until REAL NOT NULL, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_until)",
+        ), synchronous=self.sync, thread_name="job-journal") if self.path else None
+        # job_id -> row; several transitions inside one flush interval become one write
+        self._rows = {}
+        self._dirty = set()
+        self._flush_task = None
+        self._lease_task = None
+        self._wakeup = None
+        self._writes_in_flight = set()
+        self._spools = set()
+        self.writes = 0
+        self.flushes = 0
+        self.recovered = {"resumed": 0, "redelivered": 0, "abandoned": 0}
+
+    @staticmethod
+    def _write(conn, rows):
+        conn.executemany(
+            f"INSERT OR REPLACE INTO jobs ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+            [tuple(row[column] for column in COLUMNS) for row in rows]
+        )
+        conn.execute(
+            f"DELETE FROM jobs WHERE state IN ({', '.join('?' * len(FINAL_STATES))}) AND updated_at < ?",
+            FINAL_STATES + (time.time() - JOB_JOURNAL_RETENTION,)
+        )
+        conn.commit()
+
+    @staticmethod
+    def _claim(conn, owner, now, lease_until):
+        # Takes over open jobs whose owner stopped renewing, in one transaction
+        # so two processes cannot claim the same job
+        conn.execute(
+            "UPDATE jobs SET owner = ?, lease_until = ? WHERE state IN (?, ?) AND lease_until < ? AND owner != ?",
+            (owner, lease_until, PENDING, RENDERED, now, owner)
+        )
+        conn.commit()
+        conn.row_factory = sqlite3.Row
+        try:
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE state IN (?, ?) AND owner = ? ORDER BY created_at", (PENDING, RENDERED, owner)
+            )
+            return [dict(row) for row in rows]
+        finally:
+            conn.row_factory = None
+
+    def _update(self, job_id, **changes):
+        row = self._rows.get(job_id)
+        if row is None:
+            return
+        row.update(changes, updated_at=time.time())
+        self._mark(job_id)
+
+    def _mark(self, job_id):
+        self._dirty.add(job_id)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        elif self.flush_interval <= 0:
+            # Write-through: each change is its own transaction
+            task = asyncio.get_running_loop().create_task(self.flush())
+            self._writes_in_flight.add(task)
+            task.add_done_callback(self._writes_in_flight.discard)
+
+    def begin(self, user_id, chat_id, message_id, mode, params):
+        # params must be JSON-safe: the settings snapshot, not image buffers
+        if not self.path:
+            return None
+        now = time.time()
+        job_id = uuid.uuid4().hex[:16]
+        self._rows[job_id] = {
+            "job_id": job_id, "user_id": user_id, "chat_id": chat_id, "message_id": message_id,
+            "mode": mode, "params": json.dumps(params), "state": PENDING, "seeds": None, "results": None,
+            "owner": self.owner, "lease_until": now + self.lease, "created_at": now, "updated_at": now,
+        }
+        self._mark(job_id)
+        return job_id
+
+    def _spool(self, job_id, images):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        paths = []
+        for index, image in enumerate(images):
+            path = os.path.join(self.spool_dir, f"{job_id}-{index}.png")
+            with open(f"{path}.tmp", "wb") as f:
+                shutil.copyfileobj(image.open(), f)
+            os.replace(f"{path}.tmp", path)
+            paths.append(path)
+        return paths
+
+    def _unspool(self, paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    async def rendered(self, job_id, images):
+        # Seeds let a lost result be rendered again identically; spooled files
+        # let it be sent without rendering at all. Spooling runs alongside
+        # delivery instead of in front of it.
+        if job_id is None or job_id not in self._rows:
+            return
+        self._update(job_id, state=RENDERED, seeds=json.dumps([image.seed for image in images]))
+        if self.spool_dir:
+            task = asyncio.create_task(self._spool_results(job_id, images))
+            self._spools.add(task)
+            task.add_done_callback(self._spools.discard)
+
+    async def _spool_results(self, job_id, images):
+        try:
+            paths = await asyncio.to_thread(self._spool, job_id, images)
+        except OSError as e:
+            logger.warning(f"Spooling results of job {job_id} failed: {e}")
+            return
+        row = self._rows.get(job_id)
+        if row is None or row["state"] != RENDERED:
+            # Delivered (or failed) before the files were written
+            await asyncio.to_thread(self._unspool, paths)
+            return
+        self._update(job_id, results=json.dumps(paths))
+
+    def finish(self, job_id, state):
+        row = self._rows.get(job_id) if job_id is not None else None
+        if row is None:
+            return
+        if row["results"]:
+            paths = json.loads(row["results"])
+            asyncio.get_running_loop().run_in_executor(None, self._unspool, paths)
+        self._update(job_id, state=state, results=None)
+
+    async def flush(self):
+        if not self._dirty or not self.path:
+            return
+        dirty, self._dirty = self._dirty, set()
+        rows = [self._rows[job_id] for job_id in dirty if job_id in self._rows]
+        # Final rows only need to reach disk once
+        for row in rows:
+            if row["state"] in FINAL_STATES:
+                self._rows.pop(row["job_id"], None)
+        try:
+            await self._db.run(self._write, [dict(row) for row in rows])
+            self.writes += len(rows)
+            self.flushes += 1
+        except Exception as e:
+            logger.error(f"Job journal write of {len(rows)} row(s) failed: {e}")
+            for row in rows:
+                self._rows.setdefault(row["job_id"], row)
+                self._dirty.add(row["job_id"])
+
+    async def _flush_loop(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def _renew(self):
+        lease_until = time.time() + self.lease
+        for job_id, row in self._rows.items():
+            if row["state"] not in FINAL_STATES:
+                row["lease_until"] = lease_until
+                self._mark(job_id)
+
+    async def _lease_loop(self, resume, redeliver, abandon):
+        # Renewing well inside the lease leaves room for a slow flush
+        while True:
+            self._renew()
+            try:
+                await self.recover(resume, redeliver, abandon)
+            except Exception as e:
+                logger.error(f"Job recovery failed: {e}")
+            await asyncio.sleep(self.lease / 3)
+
+    def start(self, resume=None, redeliver=None, abandon=None):
+        # With callbacks, jobs left by stopped processes are recovered now and
+        # whenever another lease runs out
+        if not self.path:
+            return
+        if self._flush_task is None and self.flush_interval > 0:
+            self._wakeup = asyncio.Event()
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        if self._lease_task is None and resume is not None:
+            self._lease_task = asyncio.create_task(self._lease_loop(resume, redeliver, abandon))
+
+    async def recover(self, resume, redeliver, abandon):
+        # Hands every unfinished job whose lease ran out to one of the
+        # callbacks, each called with the row and the job's params
+        if not self.path:
+            return
+        now = time.time()
+        rows = await self._db.run(self._claim, self.owner, now, now + self.lease)
+        rows = [row for row in rows if row["job_id"] not in self._rows]
+        counts = {"resumed": 0, "redelivered": 0, "abandoned": 0}
+        for row in rows:
+            self._rows[row["job_id"]] = row
+            params = json.loads(row["params"])
+            results = json.loads(row["results"]) if row["results"] else None
+            try:
+                if now - row["created_at"] > JOB_JOURNAL_RESUME_MAX_AGE:
+                    await abandon(row, params)
+                    self.finish(row["job_id"], ABANDONED)
+                    counts["abandoned"] += 1
+                elif results and all(os.path.exists(path) for path in results):
+                    images = [ImageBuffer(await asyncio.to_thread(self._read, path)) for path in results]
+                    seeds = json.loads(row["seeds"] or "[]")
+                    for image, seed in zip(images, seeds):
+                        image.seed = seed
+                    await redeliver(row, params, images)
+                    self.finish(row["job_id"], DELIVERED)
+                    counts["redelivered"] += 1
+                else:
+                    seeds = json.loads(row["seeds"] or "[]")
+                    await resume(row, params, seeds)
+                    self.finish(row["job_id"], RESUMED)
+                    counts["resumed"] += 1
+            except Exception as e:
+                logger.error(f"Recovering job {row['job_id']} failed: {e}")
+                self.finish(row["job_id"], ABANDONED)
+                counts["abandoned"] += 1
+        for outcome, count in counts.items():
+            self.recovered[outcome] += count
+        if rows:
+            logger.info(f"Recovered {len(rows)} unfinished job(s): {counts}")
+        await self.flush()
+
+    @staticmethod
+    def _read(path):
+        with open(path, "rb") as f:
+            return bytearray(f.read())
+
+    async def close(self):
+        for task in (self._lease_task, self._flush_task):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._lease_task = self._flush_task = None
+        self._wakeup = None
+        await asyncio.gather(*self._spools, *self._writes_in_flight, return_exceptions=True)
+        # Jobs still open were cut off by the shutdown; giving up their leases
+        # lets the next process resume them right away
+        for job_id, row in self._rows.items():
+            if row["state"] not in FINAL_STATES:
+                row["lease_until"] = 0.0
+                self._dirty.add(job_id)
+        await self.flush()
+        if self._db is not None:
+            await self._db.close()
+
+    def stats(self):
+        return {
+            "open_jobs": len(self._rows),
+            "unflushed": len(self._dirty),
+            "writes": self.writes,
+            "flushes": self.flushes,
+            "sync": self.sync,
+            "recovered": self.recovered,
+        }
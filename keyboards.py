@@ -1,65 +1,184 @@
+from functools import lru_cache
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from config import QUALITY_PRESETS, PRESET_SIZES, SAMPLERS
+from config import QUALITY_PRESETS, PRESET_SIZES, SAMPLERS, SCHEDULERS, VARIATIONS_COUNT
+from transcode import DELIVERY_FORMATS
 
-def get_main_menu_keyboard():
-    keyboard = [
-        [InlineKeyboardButton("🎨 Generate Image", callback_data="generate")],
-        [
-            InlineKeyboardButton("⚡ Quality Preset", callback_data="menu:quality"),
-            InlineKeyboardButton("📐 Size", callback_data="menu:size")
-        ],
-        [
-            InlineKeyboardButton("🎛️ Advanced", callback_data="menu:advanced"),
-            InlineKeyboardButton("📊 View Settings", callback_data="view_settings")
-        ]
+# callback_data is "<code>" or "<code>:<arg>". Codes are short aliases for the
+# action names bot.py routes on, and arguments drawn from a fixed list
+# (presets, sizes, samplers, schedulers) are sent as their index, so the data
+# stays far below Telegram's 64-byte limit whatever the names are. Samplers and
+# schedulers a backend reports beyond the static lists are sent by name; their
+# order differs between backends and instances, so an index would not be stable.
+ACTION_CODES = {
+    "generate": "g",
+    "variations": "v",
+    "variation": "vp",
+    "draft": "d",
+    "menu": "m",
+    "back": "b",
+    "view_settings": "vs",
+    "quality": "q",
+    "size": "z",
+    "sampler": "s",
+    "scheduler": "sc",
+    "delivery": "dl",
+    "steps": "st",
+    "cfg": "c",
+    "custom": "cu",
+    "toggle": "t",
+    "img2img": "i",
+    "recent": "r",
+}
+CODE_ACTIONS = {code: action for action, code in ACTION_CODES.items()}
+INDEXED_ARGS = {
+    "quality": list(QUALITY_PRESETS),
+    "size": list(PRESET_SIZES),
+    "sampler": SAMPLERS,
+    "scheduler": SCHEDULERS,
+}
+
+def callback(action, arg=None):
+    code = ACTION_CODES[action]
+    if arg is None:
+        return code
+    if action in INDEXED_ARGS and arg in INDEXED_ARGS[action]:
+        arg = INDEXED_ARGS[action].index(arg)
+    data = f"{code}:{arg}"
+    if len(data.encode()) > 64:
+        raise ValueError(f"callback_data too long: {data}")
+    return data
+
+def decode_callback(data):
+    # Returns (action, arg). Buttons on messages sent before the compact
+    # encoding carry "<action>:<name>" and still decode to the same route.
+    code, _, arg = data.partition(":")
+    action = CODE_ACTIONS.get(code)
+    if action is None:
+        return code, arg or None
+    if arg and action in INDEXED_ARGS:
+        values = INDEXED_ARGS[action]
+        if not arg.isdigit():
+            return action, arg
+        index = int(arg)
+        return action, values[index] if index < len(values) else None
+    return action, arg or None
+
+def _button(text, action, arg=None):
+    return InlineKeyboardButton(text, callback_data=callback(action, arg))
+
+def _pairs(buttons):
+    return [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+
+MAIN_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [
+        _button("🎨 Generate Image", "generate"),
+        _button(f"🎲 {VARIATIONS_COUNT} Variations", "variations")
+    ],
+    [
+        _button("⚡ Quality Preset", "menu", "quality"),
+        _button("📐 Size", "menu", "size")
+    ],
+    [
+        _button("🎛️ Advanced", "menu", "advanced"),
+        _button("📊 View Settings", "view_settings")
+    ],
+    [_button("📦 Delivery Format", "menu", "delivery")]
+])
+
+QUALITY_KEYBOARD = InlineKeyboardMarkup(
+    [[_button(preset_name, "quality", preset_name)] for preset_name in QUALITY_PRESETS]
+    + [[_button("« Back", "back", "main")]]
+)
+
+SIZE_KEYBOARD = InlineKeyboardMarkup(
+    [[_button(size_name, "size", size_name)] for size_name in PRESET_SIZES]
+    + [
+        [_button("✏️ Custom Width", "custom", "width"), _button("✏️ Custom Height", "custom", "height")],
+        [_button("« Back", "back", "main")]
     ]
-    return InlineKeyboardMarkup(keyboard)
+)
 
-def get_quality_keyboard():
+ADVANCED_KEYBOARD = InlineKeyboardMarkup([
+    [_button("🔄 Sampler", "menu", "sampler"), _button("⏱️ Scheduler", "menu", "scheduler")],
+    [_button("Steps: -5", "steps", "dec"), _button("Steps: +5", "steps", "inc"), _button("✏️ Custom", "custom", "steps")],
+    [_button("CFG: -0.5", "cfg", "dec"), _button("CFG: +0.5", "cfg", "inc"), _button("✏️ Custom", "custom", "cfg")],
+    [_button("🎲 Seed", "custom", "seed"), _button("💬 Negative Prompt", "custom", "negative")],
+    [_button("🔧 Restore Faces", "toggle", "restore_faces"), _button("🔁 Tiling", "toggle", "tiling")],
+    [_button("📝 Draft First", "toggle", "draft_mode")],
+    [_button("« Back", "back", "main")]
+])
+
+DRAFT_KEYBOARD = InlineKeyboardMarkup([[
+    _button("✨ Refine", "draft", "refine"),
+    _button("🗑 Discard", "draft", "discard")
+]])
+
+@lru_cache(maxsize=None)
+def get_img2img_keyboard(has_mask):
+    return InlineKeyboardMarkup([
+        [_button("🖌 Edit Photo", "img2img", "run")],
+        [_button("🧽 Remove Mask", "img2img", "nomask") if has_mask else _button("🎭 Set Inpaint Mask", "img2img", "mask")],
+        [_button("Denoise: -0.1", "img2img", "dn-"), _button("Denoise: +0.1", "img2img", "dn+")],
+        [_button("🗑 Forget Photo", "img2img", "clear"), _button("« Back", "back", "main")]
+    ])
+
+RECENT_KEYBOARD = InlineKeyboardMarkup([[
+    _button("♻️ Use It", "recent", "use"),
+    _button("🎨 Regenerate", "recent", "new")
+]])
+
+def _choice_keyboard(action, values, current):
+    # A reported name too long for callback_data cannot be offered
+    values = [value for value in values
+              if value in INDEXED_ARGS[action] or len(f"{ACTION_CODES[action]}:{value}".encode()) <= 64]
+    buttons = [_button(f"✓ {value}" if value == current else value, action, value) for value in values]
+    return InlineKeyboardMarkup(_pairs(buttons) + [[_button("« Back", "back", "advanced")]])
+
+# Markups are immutable, so one instance per distinct state is built on first
+# use and shared by every later request. The available samplers and schedulers
+# are part of the key, so a backend change simply builds new markups.
+@lru_cache(maxsize=256)
+def get_sampler_keyboard(current=None, samplers=tuple(SAMPLERS)):
+    return _choice_keyboard("sampler", samplers, current)
+
+@lru_cache(maxsize=256)
+def get_scheduler_keyboard(current=None, schedulers=tuple(SCHEDULERS)):
+    return _choice_keyboard("scheduler", schedulers, current)
+
+@lru_cache(maxsize=None)
+def get_delivery_keyboard(current_format, attach_original):
     keyboard = []
-    for preset_name in QUALITY_PRESETS.keys():
-        keyboard.append([InlineKeyboardButton(preset_name, callback_data=f"quality:{preset_name}")])
-    keyboard.append([InlineKeyboardButton("« Back", callback_data="back:main")])
+    for key, (label, _, _) in DELIVERY_FORMATS.items():
+        mark = "✓ " if key == current_format else ""
+        keyboard.append([_button(f"{mark}{label}", "delivery", key)])
+    keyboard.append([_button(
+        f"📎 Attach lossless original: {'ON' if attach_original else 'OFF'}",
+        "delivery", "original"
+    )])
+    keyboard.append([_button("« Back", "back", "main")])
     return InlineKeyboardMarkup(keyboard)
 
-def get_size_keyboard():
-    keyboard = []
-    for size_name in PRESET_SIZES.keys():
-        keyboard.append([InlineKeyboardButton(size_name, callback_data=f"size:{size_name}")])
-    keyboard.append([InlineKeyboardButton("✏️ Custom Width", callback_data="custom:width"), InlineKeyboardButton("✏️ Custom Height", callback_data="custom:height")])
-    keyboard.append([InlineKeyboardButton("« Back", callback_data="back:main")])
+@lru_cache(maxsize=None)
+def get_variations_keyboard(count):
+    buttons = [_button(f"🔍 #{i + 1}", "variation", i) for i in range(count)]
+    keyboard = [buttons[i:i + 4] for i in range(0, len(buttons), 4)]
+    keyboard.append([_button("🎲 More Variations", "variations")])
     return InlineKeyboardMarkup(keyboard)
 
+def get_main_menu_keyboard():
+    return MAIN_MENU_KEYBOARD
+
+def get_quality_keyboard():
+    return QUALITY_KEYBOARD
+
+def get_size_keyboard():
+    return SIZE_KEYBOARD
+
 def get_advanced_keyboard():
-    keyboard = [
-        [InlineKeyboardButton("🔄 Sampler", callback_data="menu:sampler"), InlineKeyboardButton("⏱️ Scheduler", callback_data="menu:scheduler")],
-        [InlineKeyboardButton("Steps: -5", callback_data="steps:dec"), InlineKeyboardButton("Steps: +5", callback_data="steps:inc"), InlineKeyboardButton("✏️ Custom", callback_data="custom:steps")],
-        [InlineKeyboardButton("CFG: -0.5", callback_data="cfg:dec"), InlineKeyboardButton("CFG: +0.5", callback_data="cfg:inc"), InlineKeyboardButton("✏️ Custom", callback_data="custom:cfg")],
-        [InlineKeyboardButton("🎲 Seed", callback_data="custom:seed"), InlineKeyboardButton("💬 Negative Prompt", callback_data="custom:negative")],
-        [InlineKeyboardButton("🔧 Restore Faces", callback_data="toggle:restore_faces"), InlineKeyboardButton("🔁 Tiling", callback_data="toggle:tiling")],
-        [InlineKeyboardButton("« Back", callback_data="back:main")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return ADVANCED_KEYBOARD
 
-def get_sampler_keyboard():
-    keyboard = []
-    for i in range(0, len(SAMPLERS), 2):
-        row = []
-        row.append(InlineKeyboardButton(SAMPLERS[i], callback_data=f"sampler:{SAMPLERS[i]}"))
-        if i + 1 < len(SAMPLERS):
-            row.append(InlineKeyboardButton(SAMPLERS[i+1], callback_data=f"sampler:{SAMPLERS[i+1]}"))
-        keyboard.append(row)
-    keyboard.append([InlineKeyboardButton("« Back", callback_data="back:advanced")])
-    return InlineKeyboardMarkup(keyboard)
+def get_draft_keyboard():
+    return DRAFT_KEYBOARD
 
-def get_scheduler_keyboard():
-    schedulers = ["Automatic", "Karras", "Exponential", "Polyexponential", "SGM Uniform", "Simple", "Normal", "DDIM", "Beta"]
-    keyboard = []
-    for i in range(0, len(schedulers), 2):
-        row = []
-        row.append(InlineKeyboardButton(schedulers[i], callback_data=f"scheduler:{schedulers[i]}"))
-        if i + 1 < len(schedulers):
-            row.append(InlineKeyboardButton(schedulers[i+1], callback_data=f"scheduler:{schedulers[i+1]}"))
-        keyboard.append(row)
-    keyboard.append([InlineKeyboardButton("« Back", callback_data="back:advanced")])
-    return InlineKeyboardMarkup(keyboard)
+def get_recent_keyboard():
+    return RECENT_KEYBOARD
@@ -0,0 +1,150 @@
+import time
+from bisect import bisect_left
+from config import SAMPLERS
+
+# Minimal Prometheus text-format metrics. Observations are a dict lookup and a
+# bisect, so they are cheap enough to sit on the hot path.
+
+REGISTRY = []
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+GENERATION_BUCKETS = (1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300)
+# Steps, sizes and samplers come from user input, so generation latency is
+# labelled with a few fixed ranges and the known sampler names only
+STEP_RANGES = ((10, "1-10"), (20, "11-20"), (30, "21-30"), (50, "31-50"), (100, "51-100"))
+SIZE_RANGES = ((0.3, "<=0.3mp"), (0.6, "<=0.6mp"), (1.1, "<=1.1mp"), (2.2, "<=2.2mp"))
+KNOWN_SAMPLERS = frozenset(SAMPLERS)
+
+def _format_labels(names, values, extra=""):
+    parts = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+        return False
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = labels
+        self.buckets = tuple(buckets)
+        # label values -> [bucket counts..., +Inf count, sum]
+        self._series = {}
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        bounds = [f'le="{bound}"' for bound in self.buckets] + ['le="+Inf"']
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(bounds, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, bound)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = labels
+        self._values = {}
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {value}")
+        return lines
+
+class Gauge:
+    # Read at scrape time from a callback, so nothing is updated on the hot path
+    # kind="counter" exposes a monotonic total that is already kept elsewhere
+    def __init__(self, name, help_text, read=None, kind="gauge"):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+        self.kind = kind
+        REGISTRY.append(self)
+
+    def render(self):
+        if self.read is None:
+            return []
+        try:
+            value = self.read()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}", f"{self.name} {value}"]
+
+def _range_label(value, ranges, overflow):
+    for bound, label in ranges:
+        if value <= bound:
+            return label
+    return overflow
+
+def generation_labels(steps, width, height, sampler):
+    return (
+        _range_label(steps, STEP_RANGES, "101+"),
+        _range_label(width * height / 1e6, SIZE_RANGES, ">2.2mp"),
+        sampler if sampler in KNOWN_SAMPLERS else "other",
+    )
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+WEBHOOK_SECONDS = Histogram("bot_webhook_seconds", "Time to acknowledge a webhook request")
+UPDATE_SECONDS = Histogram("bot_update_processing_seconds", "Time spent processing one Telegram update")
+QUEUE_WAIT_SECONDS = Histogram(
+    "bot_generation_queue_wait_seconds", "Time a generation job waited for a worker", buckets=GENERATION_BUCKETS
+)
+TXT2IMG_SECONDS = Histogram(
+    "bot_backend_txt2img_seconds", "Backend txt2img call latency",
+    labels=("steps", "size", "sampler"), buckets=GENERATION_BUCKETS
+)
+IMG2IMG_SECONDS = Histogram(
+    "bot_backend_img2img_seconds", "Backend img2img call latency",
+    labels=("steps", "size", "sampler"), buckets=GENERATION_BUCKETS
+)
+DECODE_SECONDS = Histogram("bot_image_decode_seconds", "Time spent decoding base64 images from a response")
+SEND_PHOTO_SECONDS = Histogram("bot_telegram_send_photo_seconds", "Telegram send_photo upload time")
+TELEGRAM_QUEUE_SECONDS = Histogram(
+    "bot_telegram_queue_seconds", "Time a Bot API call waited in the outbound scheduler", labels=("method",)
+)
+TELEGRAM_FLOOD_WAITS = Counter(
+    "bot_telegram_flood_waits_total", "Bot API calls answered with 429 Too Many Requests", labels=("method",)
+)
+RETRIES = Counter("bot_backend_retries_total", "Backend call retries by outcome", labels=("outcome",))
+HEDGES = Counter("bot_backend_hedges_total", "Hedged backend calls by which copy won", labels=("winner",))
+ADMISSIONS = Counter("bot_admission_total", "Generation admission decisions", labels=("decision",))
+ERRORS = Counter("bot_errors_total", "Errors by where they happened and their type", labels=("stage", "type"))
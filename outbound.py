@@ -0,0 +1,266 @@
+import asyncio
+import heapq
+import itertools
+import time
+import logging
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+from config import (
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_GROUP_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_FLOOD_RETRIES
+)
+from metrics import TELEGRAM_QUEUE_SECONDS, TELEGRAM_FLOOD_WAITS
+from token_bucket import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Lower goes first: finished images and callback answers, then plain
+# messages, then status edits that a later edit would overwrite anyway
+PRIORITIES = {
+    "sendPhoto": 0, "sendMediaGroup": 0, "sendDocument": 0, "editMessageMedia": 0, "answerCallbackQuery": 0,
+    "editMessageText": 2, "editMessageCaption": 2, "editMessageReplyMarkup": 2,
+}
+DEFAULT_PRIORITY = 1
+# Each of these replaces what the message shows, so only the newest queued one matters
+COALESCED = ("editMessageText", "editMessageCaption", "editMessageReplyMarkup")
+# Not sends; Telegram's flood limits do not apply
+UNLIMITED = ("getMe", "getFile", "getWebhookInfo", "setWebhook", "deleteWebhook", "getUpdates")
+
+class _Send:
+    __slots__ = ("priority", "seq", "endpoint", "message_id", "callback", "args", "kwargs", "futures",
+                 "queued_at", "attempts", "sent")
+
+class _Chat:
+    __slots__ = ("bucket", "queue", "busy", "paused_until", "last_for_message")
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        # heap of (priority, seq, send)
+        self.queue = []
+        self.busy = False
+        self.paused_until = 0.0
+        # message_id -> newest queued call touching that message
+        self.last_for_message = {}
+
+class SendScheduler(BaseRateLimiter):
+    # Every Bot API call made through application.bot passes through here, so
+    # handlers keep calling edit_message_text/send_photo as before. Calls wait
+    # in per-chat queues; one dispatcher hands out the global and per-chat
+    # tokens, picking the best (priority, arrival) head across chats. Each chat
+    # has at most one call in flight, which keeps its messages in order.
+
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE,
+                 group_rate=TELEGRAM_GROUP_RATE, chat_burst=TELEGRAM_CHAT_BURST,
+                 flood_retries=TELEGRAM_FLOOD_RETRIES):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.flood_retries = flood_retries
+        self._global = TokenBucket(max(1, int(global_rate)), global_rate)
+        self._chats = {}
+        # chats with queued calls
+        self._active = set()
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self._in_flight = set()
+        self._paused_until = 0.0
+        self._prune_at = 1000
+        self.metrics = {
+            "sent": 0,
+            "coalesced": 0,
+            "flood_waits": 0,
+            "flood_failures": 0,
+            "queue_time_total": 0.0,
+        }
+
+    async def initialize(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await asyncio.gather(*self._in_flight, return_exceptions=True)
+        for chat in self._chats.values():
+            for _, _, send in chat.queue:
+                for future in send.futures:
+                    future.cancel()
+        self._chats.clear()
+        self._active.clear()
+
+    def _chat(self, key):
+        chat = self._chats.get(key)
+        if chat is None:
+            if len(self._chats) >= self._prune_at:
+                self._prune()
+            if key is None:
+                # Callback answers and inline edits are only bound by the global rate
+                bucket = None
+            elif isinstance(key, int) and key < 0:
+                bucket = TokenBucket(self.chat_burst, self.group_rate)
+            else:
+                bucket = TokenBucket(self.chat_burst, self.chat_rate)
+            chat = self._chats[key] = _Chat(bucket)
+        return chat
+
+    def _prune(self):
+        # A chat whose bucket has refilled has no state worth keeping
+        now = time.monotonic()
+        for key in [key for key, chat in self._chats.items() if not chat.queue and not chat.busy]:
+            bucket = self._chats[key].bucket
+            if bucket is None or (bucket.available(now) >= bucket.capacity):
+                del self._chats[key]
+        self._prune_at = max(1000, 2 * len(self._chats))
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in UNLIMITED or self._task is None:
+            return await callback(*args, **kwargs)
+        key = data.get("chat_id")
+        message_id = data.get("message_id")
+        chat = self._chat(key)
+        future = asyncio.get_running_loop().create_future()
+
+        if endpoint in COALESCED and message_id is not None:
+            queued = chat.last_for_message.get(message_id)
+            if queued is not None and not queued.sent and queued.endpoint == endpoint:
+                # The queued edit goes out with the newest content, keeping its place
+                queued.callback, queued.args, queued.kwargs = callback, args, kwargs
+                queued.futures.append(future)
+                self.metrics["coalesced"] += 1
+                return await future
+
+        send = _Send()
+        send.priority = PRIORITIES.get(endpoint, DEFAULT_PRIORITY)
+        send.seq = next(self._seq)
+        send.endpoint = endpoint
+        send.message_id = message_id
+        send.callback, send.args, send.kwargs = callback, args, kwargs
+        send.futures = [future]
+        send.queued_at = time.monotonic()
+        send.attempts = 0
+        send.sent = False
+        heapq.heappush(chat.queue, (send.priority, send.seq, send))
+        self._active.add(key)
+        if message_id is not None:
+            chat.last_for_message[message_id] = send
+        self._wakeup.set()
+        return await future
+
+    def _next(self, now):
+        # Returns (key, chat) of the best sendable head, or the seconds until one may be
+        best = None
+        wake_in = None
+        for key in self._active:
+            chat = self._chats[key]
+            if chat.busy:
+                continue
+            wait = chat.paused_until - now
+            if chat.bucket is not None:
+                wait = max(wait, chat.bucket.wait_time(1, now))
+            if wait > 0:
+                wake_in = wait if wake_in is None else min(wake_in, wait)
+                continue
+            if best is None or chat.queue[0][:2] < best[1].queue[0][:2]:
+                best = (key, chat)
+        if best is not None:
+            wait = max(self._paused_until - now, self._global.wait_time(1, now))
+            if wait > 0:
+                return None, wait
+        return best, wake_in
+
+    async def _dispatch(self):
+        while True:
+            best, wake_in = self._next(time.monotonic())
+            if best is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wake_in)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            key, chat = best
+            _, _, send = heapq.heappop(chat.queue)
+            if not chat.queue:
+                self._active.discard(key)
+            if all(future.done() for future in send.futures):
+                # Every caller gave up (cancelled) while it waited
+                self._forget(chat, send)
+                continue
+            now = time.monotonic()
+            self._global.take(1, now)
+            if chat.bucket is not None:
+                chat.bucket.take(1, now)
+                chat.busy = True
+            send.sent = True
+            task = asyncio.create_task(self._send(key, chat, send))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    def _forget(self, chat, send):
+        if send.message_id is not None and chat.last_for_message.get(send.message_id) is send:
+            del chat.last_for_message[send.message_id]
+
+    async def _send(self, key, chat, send):
+        waited = time.monotonic() - send.queued_at
+        try:
+            result = await send.callback(*send.args, **send.kwargs)
+        except RetryAfter as e:
+            self.metrics["flood_waits"] += 1
+            TELEGRAM_FLOOD_WAITS.inc(send.endpoint)
+            delay = e.retry_after
+            delay = delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+            if send.attempts >= self.flood_retries:
+                self.metrics["flood_failures"] += 1
+                self._forget(chat, send)
+                self._resolve(send, error=e)
+            else:
+                logger.warning(f"Telegram flood limit on {send.endpoint} for chat {key}, retrying in {delay:.0f}s")
+                send.attempts += 1
+                send.sent = False
+                # Hit for one chat, the pause is that chat's; otherwise it is the bot's
+                paused_until = time.monotonic() + delay
+                if key is None:
+                    self._paused_until = paused_until
+                else:
+                    chat.paused_until = paused_until
+                heapq.heappush(chat.queue, (send.priority, send.seq, send))
+                self._active.add(key)
+        except Exception as e:
+            self._forget(chat, send)
+            self._resolve(send, error=e)
+        else:
+            self.metrics["sent"] += 1
+            self.metrics["queue_time_total"] += waited
+            TELEGRAM_QUEUE_SECONDS.observe(waited, send.endpoint)
+            self._forget(chat, send)
+            self._resolve(send, result=result)
+        finally:
+            chat.busy = False
+            self._wakeup.set()
+
+    @staticmethod
+    def _resolve(send, result=None, error=None):
+        for future in send.futures:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    @property
+    def depth(self):
+        return sum(len(self._chats[key].queue) for key in self._active)
+
+    def stats(self):
+        sent = self.metrics["sent"]
+        return {
+            **self.metrics,
+            "queued": self.depth,
+            "chats": len(self._chats),
+            "avg_queue_time": self.metrics["queue_time_total"] / sent if sent else 0.0,
+        }
@@ -0,0 +1,226 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+import logging
+from config import (
+    RECENT_RESULTS_MAX_ENTRIES, RECENT_RESULTS_MAX_AGE, RECENT_RESULTS_HALF_LIFE, RECENT_RESULTS_PATH,
+    RECENT_RESULTS_FLUSH_INTERVAL, SESSION_STORE, SESSION_REDIS_URL
+)
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r"\s+")
+_COMMAS = re.compile(r"\s*,\s*")
+_TAGS = re.compile(r"(<[^<>]*>)")
+
+def prompt_key(text):
+    # Only for matching: prompts that differ in whitespace, case or trailing
+    # commas share a key, while the backend still gets the user's own text.
+    # <lora:Name:1> tags are file names and keep their case.
+    text = _COMMAS.sub(", ", _WHITESPACE.sub(" ", text)).strip(" ,")
+    parts = _TAGS.split(text)
+    return "".join(part if part.startswith("<") else part.casefold() for part in parts)
+
+# Settings that change the image; delivery options do not
+KEY_FIELDS = (
+    "negative_prompt", "steps", "cfg_scale", "width", "height", "sampler", "scheduler",
+    "seed", "subseed", "subseed_strength", "restore_faces", "tiling"
+)
+
+def result_key(params, model):
+    key = {field: params.get(field) for field in KEY_FIELDS}
+    key["prompt"] = prompt_key(params["prompt"])
+    key["negative_prompt"] = prompt_key(key["negative_prompt"] or "")
+    key["model"] = model
+    canonical = json.dumps(key, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
+
+class RecentResults:
+    # key -> [file_id, created_at, seed, score, scored_at]. created_at is wall
+    # time so ages survive a restart. score counts deliveries and reuses and
+    # halves every half_life seconds; the lowest scores go first when full.
+    # model() names the checkpoint the backends have loaded; while it is
+    # unknown nothing is offered or recorded.
+
+    def __init__(self, model=lambda: None, max_entries=RECENT_RESULTS_MAX_ENTRIES, max_age=RECENT_RESULTS_MAX_AGE,
+                 half_life=RECENT_RESULTS_HALF_LIFE, path=RECENT_RESULTS_PATH,
+                 redis_url=SESSION_REDIS_URL if SESSION_STORE == "redis" else None,
+                 flush_interval=RECENT_RESULTS_FLUSH_INTERVAL, prefix="recent_result:"):
+        self.model = model
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.half_life = half_life
+        self.path = path or None
+        self.redis_url = redis_url
+        self.flush_interval = flush_interval
+        self.prefix = prefix
+        self._entries = {}
+        # Keys changed or forgotten since the last flush
+        self._dirty = set()
+        self._redis = None
+        self._flush_task = None
+        self.hits = 0
+        self.misses = 0
+        self.reused = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _score(self, entry, now):
+        return entry[3] * 0.5 ** ((now - entry[4]) / self.half_life)
+
+    def _trim(self, now):
+        expired = [key for key, entry in self._entries.items() if now - entry[1] > self.max_age]
+        for key in expired:
+            del self._entries[key]
+        if len(self._entries) > self.max_entries:
+            # Trimming a tenth at a time keeps the sort off the per-record path
+            keep = int(self.max_entries * 0.9)
+            ranked = sorted(self._entries, key=lambda key: self._score(self._entries[key], now), reverse=True)
+            for key in ranked[keep:]:
+                del self._entries[key]
+
+    def _key(self, params):
+        model = self.model()
+        return result_key(params, model) if model else None
+
+    def lookup(self, params):
+        # Returns (file_id, age_seconds, seed) or None
+        key = self._key(params)
+        entry = self._entries.get(key) if key else None
+        now = time.time()
+        if entry is None or now - entry[1] > self.max_age:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0], now - entry[1], entry[2]
+
+    def record(self, params, file_id, seed=None):
+        key = self._key(params)
+        if key is None:
+            return
+        now = time.time()
+        previous = self._entries.get(key)
+        score = self._score(previous, now) + 1 if previous else 1.0
+        self._entries[key] = [file_id, now, seed, score, now]
+        self._dirty.add(key)
+        if len(self._entries) > self.max_entries:
+            self._trim(now)
+
+    def reuse(self, params):
+        key = self._key(params)
+        entry = self._entries.get(key) if key else None
+        if entry is not None:
+            now = time.time()
+            entry[3] = self._score(entry, now) + 1
+            entry[4] = now
+            self._dirty.add(key)
+        self.reused += 1
+
+    def forget(self, params):
+        key = self._key(params)
+        if key and self._entries.pop(key, None) is not None:
+            self._dirty.add(key)
+
+    def _read_file(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_file(self, data):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    def _client(self):
+        if self._redis is None:
+            import redis.asyncio as redis
+            self._redis = redis.from_url(self.redis_url)
+        return self._redis
+
+    async def _load_redis(self):
+        client = self._client()
+        keys = [key async for key in client.scan_iter(match=f"{self.prefix}*", count=1000)]
+        entries = {}
+        for start in range(0, len(keys), 1000):
+            batch = keys[start:start + 1000]
+            for key, data in zip(batch, await client.mget(batch)):
+                if data:
+                    entries[key.decode()[len(self.prefix):]] = json.loads(data)
+        return entries
+
+    async def load(self):
+        try:
+            if self.redis_url:
+                self._entries = await self._load_redis()
+            elif self.path:
+                data = await asyncio.to_thread(self._read_file)
+                if data:
+                    self._entries = {key: list(entry) for key, entry in json.loads(data).items()}
+            else:
+                return
+            self._trim(time.time())
+            logger.info(f"Loaded {len(self._entries)} recent results")
+        except Exception as e:
+            logger.error(f"Loading recent results failed: {e}")
+
+    async def _flush_redis(self, keys):
+        # One key per entry, expiring with the entry, so instances sharing
+        # Redis add to the index instead of overwriting each other's
+        now = time.time()
+        async with self._client().pipeline(transaction=False) as pipe:
+            for key in keys:
+                entry = self._entries.get(key)
+                ttl = int(self.max_age - (now - entry[1])) if entry is not None else 0
+                if ttl > 0:
+                    pipe.set(f"{self.prefix}{key}", json.dumps(entry, separators=(",", ":")), ex=ttl)
+                else:
+                    pipe.delete(f"{self.prefix}{key}")
+            await pipe.execute()
+
+    async def flush(self):
+        if not self._dirty or not (self.redis_url or self.path):
+            return
+        dirty, self._dirty = self._dirty, set()
+        try:
+            if self.redis_url:
+                await self._flush_redis(dirty)
+            else:
+                await asyncio.to_thread(self._write_file, json.dumps(self._entries, separators=(",", ":")))
+        except Exception as e:
+            self._dirty |= dirty
+            logger.error(f"Saving recent results failed: {e}")
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self._trim(time.time())
+            await self.flush()
+
+    def start(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self.flush()
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "reused": self.reused,
+        }
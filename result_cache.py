@@ -0,0 +1,173 @@
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import logging
+from collections import OrderedDict
+from image_stream import ImageBuffer
+from config import (
+    RESULT_CACHE_MEMORY_BYTES, RESULT_CACHE_DIR, RESULT_CACHE_DISK_BYTES,
+    RESULT_CACHE_MAX_FILE_IDS
+)
+
+logger = logging.getLogger(__name__)
+
+class ResultCache:
+    def __init__(self, max_memory_bytes=RESULT_CACHE_MEMORY_BYTES, disk_dir=RESULT_CACHE_DIR,
+                 max_disk_bytes=RESULT_CACHE_DISK_BYTES, max_file_ids=RESULT_CACHE_MAX_FILE_IDS):
+        self.max_memory_bytes = max_memory_bytes
+        self.disk_dir = disk_dir or None
+        self.max_disk_bytes = max_disk_bytes
+        self.max_file_ids = max_file_ids
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        # key -> (telegram file_id, image size in bytes)
+        self._file_ids = OrderedDict()
+        # key -> size on disk, oldest access first
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        if self.disk_dir:
+            self._load_disk_index()
+
+    @staticmethod
+    def key_for(payload):
+        canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _load_disk_index(self):
+        os.makedirs(self.disk_dir, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith(".png"):
+                continue
+            path = os.path.join(self.disk_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+        logger.info(f"Result cache disk tier: {len(self._disk)} entries, {self._disk_bytes} bytes in {self.disk_dir}")
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.png")
+
+    def _read_disk(self, key):
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+            return ImageBuffer(data)
+        except OSError:
+            return None
+
+    def _write_disk(self, key, image):
+        path = self._disk_path(key)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            shutil.copyfileobj(image.open(), f)
+        os.replace(tmp_path, path)
+
+    def _remove_disk(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def _remember(self, key, image):
+        if len(image) > self.max_memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        self._memory[key] = image
+        self._memory_bytes += len(image)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    async def peek(self, key):
+        # Fetches stored bytes without touching hit/miss statistics
+        image = self._memory.get(key)
+        if image is not None:
+            self._memory.move_to_end(key)
+        elif key in self._disk:
+            image = await asyncio.to_thread(self._read_disk, key)
+            if image is None:
+                self._disk_bytes -= self._disk.pop(key)
+            else:
+                self._disk.move_to_end(key)
+                self._remember(key, image)
+        return image
+
+    async def lookup(self, key):
+        # Returns (file_id, ImageBuffer); both are None on a miss
+        entry = self._file_ids.get(key)
+        if entry is not None:
+            self._file_ids.move_to_end(key)
+            self.hits += 1
+            self.bytes_saved += entry[1]
+            return entry[0], None
+
+        image = await self.peek(key)
+
+        if image is None:
+            self.misses += 1
+            return None, None
+        self.hits += 1
+        self.bytes_saved += len(image)
+        return None, image
+
+    async def put(self, key, image):
+        self._remember(key, image)
+        if not self.disk_dir or len(image) > self.max_disk_bytes:
+            return
+
+        evicted = []
+        if key in self._disk:
+            self._disk_bytes -= self._disk.pop(key)
+        self._disk[key] = len(image)
+        self._disk_bytes += len(image)
+        while self._disk_bytes > self.max_disk_bytes:
+            old_key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            evicted.append(old_key)
+
+        try:
+            await asyncio.to_thread(self._write_disk, key, image)
+            if evicted:
+                await asyncio.to_thread(self._remove_disk, evicted)
+        except OSError as e:
+            logger.warning(f"Result cache disk write failed: {e}")
+            if key in self._disk:
+                self._disk_bytes -= self._disk.pop(key)
+
+    def set_file_id(self, key, file_id, size):
+        self._file_ids[key] = (file_id, size)
+        self._file_ids.move_to_end(key)
+        while len(self._file_ids) > self.max_file_ids:
+            self._file_ids.popitem(last=False)
+
+    def forget_file_id(self, key):
+        self._file_ids.pop(key, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "disk_entries": len(self._disk),
+            "disk_bytes": self._disk_bytes,
+            "file_ids": len(self._file_ids),
+        }
@@ -0,0 +1,275 @@
+import asyncio
+import time
+import logging
+from collections import deque, OrderedDict
+from config import (
+    GENERATION_WORKERS, GENERATION_QUEUE_MAX, GENERATION_BATCH_WINDOW, GENERATION_MAX_BATCH,
+    LOW_PRIORITY_MAX_WAIT
+)
+from metrics import QUEUE_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+class QueueFullError(RuntimeError):
+    pass
+
+class GenerationJob:
+    def __init__(self, user_id, params, on_position=None, on_progress=None, low_priority=False):
+        self.user_id = user_id
+        self.params = params
+        self.low_priority = low_priority
+        self.on_position = on_position
+        self.on_progress = on_progress
+        self.future = asyncio.get_running_loop().create_future()
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.last_position = None
+        self.queued = False
+
+class GenerationScheduler:
+    def __init__(self, runner, workers=GENERATION_WORKERS, max_queue=GENERATION_QUEUE_MAX,
+                 batch_key=None, batch_window=GENERATION_BATCH_WINDOW, max_batch=GENERATION_MAX_BATCH,
+                 low_priority_max_wait=LOW_PRIORITY_MAX_WAIT):
+        # runner takes a list of params plus a progress callback and returns
+        # one result per entry
+        self.runner = runner
+        self.workers = workers
+        self.max_queue = max_queue
+        self.batch_key = batch_key
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.low_priority_max_wait = low_priority_max_wait
+        # user_id -> deque of jobs; dict order is the round-robin rotation.
+        # Deferred jobs rotate separately and only run when nothing else waits
+        # or once they have waited low_priority_max_wait seconds.
+        self._queues = OrderedDict()
+        self._low_queues = OrderedDict()
+        self._depth = 0
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        # Position updates in flight; the loop only keeps weak references to tasks
+        self._notifications = set()
+        self._running = 0
+        self.avg_service_time = 30.0
+        self.metrics = {
+            "submitted": 0,
+            "rejected": 0,
+            "completed": 0,
+            "failed": 0,
+            "batches": 0,
+            "batched_jobs": 0,
+            "wait_time_total": 0.0,
+            "service_time_total": 0.0,
+        }
+
+    def start(self):
+        if self._tasks:
+            return
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(i)))
+        logger.info(f"Generation scheduler started with {self.workers} worker(s), max queue {self.max_queue}")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._notifications:
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._notifications, return_exceptions=True)
+        self._tasks = []
+        for ring in (self._queues, self._low_queues):
+            for queue in ring.values():
+                for job in queue:
+                    if not job.future.done():
+                        job.future.cancel()
+            ring.clear()
+        self._depth = 0
+
+    @property
+    def depth(self):
+        return self._depth
+
+    def submit(self, user_id, params, on_position=None, on_progress=None, low_priority=False):
+        if self._depth >= self.max_queue:
+            self.metrics["rejected"] += 1
+            raise QueueFullError("The generation queue is full, please try again in a minute.")
+
+        job = GenerationJob(user_id, params, on_position, on_progress, low_priority)
+        self._ring(job).setdefault(user_id, deque()).append(job)
+        self._depth += 1
+        self.metrics["submitted"] += 1
+        job.last_position = self.position(job)
+        job.queued = job.last_position + self._running > self.workers
+        self._wakeup.set()
+        return job
+
+    def _ring(self, job):
+        return self._low_queues if job.low_priority else self._queues
+
+    def position(self, job):
+        # 1-based position under round-robin service across users
+        ring = self._ring(job)
+        queue = ring.get(job.user_id)
+        if not queue or job not in queue:
+            return 0
+        index = queue.index(job)
+        position = index + 1
+        if job.low_priority:
+            position += sum(len(other) for other in self._queues.values())
+        own_seen = False
+        for user_id, other in ring.items():
+            if user_id == job.user_id:
+                own_seen = True
+                continue
+            position += min(len(other), index + (0 if own_seen else 1))
+        return position
+
+    def eta(self, position):
+        return self.avg_service_time * (position + self._running) / max(self.workers, 1)
+
+    def _pop_next(self):
+        ring = self._queues
+        if self._low_queues:
+            oldest = min(queue[0].submitted_at for queue in self._low_queues.values())
+            if not ring or time.monotonic() - oldest >= self.low_priority_max_wait:
+                ring = self._low_queues
+        user_id, queue = next(iter(ring.items()))
+        job = queue.popleft()
+        del ring[user_id]
+        if queue:
+            ring[user_id] = queue
+        self._depth -= 1
+        return job
+
+    def _take_compatible(self, key, batch):
+        # Walk users in rotation order so batching does not bypass fairness;
+        # deferred jobs may ride along since the batch runs anyway
+        for ring in (self._queues, self._low_queues):
+            for user_id in list(ring):
+                queue = ring[user_id]
+                for job in list(queue):
+                    if len(batch) >= self.max_batch:
+                        return
+                    if job.future.done():
+                        continue
+                    if self.batch_key(job.params) == key:
+                        queue.remove(job)
+                        self._depth -= 1
+                        batch.append(job)
+                if not queue:
+                    del ring[user_id]
+
+    async def _next_batch(self):
+        while True:
+            while self._depth == 0:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            job = self._pop_next()
+            if not job.future.done():
+                break
+
+        batch = [job]
+        key = self.batch_key(job.params) if self.batch_key is not None and self.max_batch > 1 else None
+        if key is None:
+            return batch
+        self._take_compatible(key, batch)
+        if len(batch) < self.max_batch and self.batch_window > 0:
+            await asyncio.sleep(self.batch_window)
+            self._take_compatible(key, batch)
+        return batch
+
+    def _notify_positions(self):
+        for queue in list(self._queues.values()) + list(self._low_queues.values()):
+            for job in queue:
+                if job.on_position is None:
+                    continue
+                position = self.position(job)
+                if position != job.last_position:
+                    job.last_position = position
+                    self._notify(job, position)
+
+    def _notify(self, job, position):
+        task = asyncio.create_task(self._safe_notify(job, position))
+        self._notifications.add(task)
+        task.add_done_callback(self._notifications.discard)
+
+    async def _safe_notify(self, job, position):
+        try:
+            await job.on_position(position, self.eta(position))
+        except Exception as e:
+            logger.debug(f"Queue position update failed: {e}")
+
+    async def _fanout_progress(self, batch, progress, eta, preview):
+        for job in batch:
+            if job.on_progress is None or job.future.done():
+                continue
+            try:
+                await job.on_progress(progress, eta, preview)
+            except Exception as e:
+                logger.debug(f"Progress update failed: {e}")
+
+    async def _worker(self, index):
+        while True:
+            batch = await self._next_batch()
+            self._notify_positions()
+            batch = [job for job in batch if not job.future.done()]
+            if not batch:
+                continue
+
+            started_at = time.monotonic()
+            for job in batch:
+                job.started_at = started_at
+                self.metrics["wait_time_total"] += started_at - job.submitted_at
+                QUEUE_WAIT_SECONDS.observe(started_at - job.submitted_at)
+                if job.queued and job.on_position is not None:
+                    self._notify(job, 0)
+            if len(batch) > 1:
+                self.metrics["batches"] += 1
+                self.metrics["batched_jobs"] += len(batch)
+                logger.info(f"Worker {index} running a batch of {len(batch)} jobs")
+
+            self._running += len(batch)
+            try:
+                async def on_progress(progress, eta, preview):
+                    await self._fanout_progress(batch, progress, eta, preview)
+                has_progress = any(job.on_progress is not None for job in batch)
+                results = await self.runner(
+                    [job.params for job in batch],
+                    on_progress if has_progress else None
+                )
+                for job, result in zip(batch, results):
+                    if not job.future.done():
+                        job.future.set_result(result)
+                self.metrics["completed"] += len(batch)
+            except asyncio.CancelledError:
+                for job in batch:
+                    if not job.future.done():
+                        job.future.cancel()
+                raise
+            except Exception as e:
+                for job in batch:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                self.metrics["failed"] += len(batch)
+            finally:
+                self._running -= len(batch)
+                service_time = time.monotonic() - started_at
+                self.metrics["service_time_total"] += service_time * len(batch)
+                self.avg_service_time = 0.8 * self.avg_service_time + 0.2 * service_time
+
+    def stats(self):
+        done = self.metrics["completed"] + self.metrics["failed"]
+        started = self.metrics["submitted"] - self._depth
+        return {
+            "queue_depth": self._depth,
+            "deferred": sum(len(queue) for queue in self._low_queues.values()),
+            "running": self._running,
+            "workers": self.workers,
+            "submitted": self.metrics["submitted"],
+            "rejected": self.metrics["rejected"],
+            "completed": self.metrics["completed"],
+            "failed": self.metrics["failed"],
+            "batches": self.metrics["batches"],
+            "batched_jobs": self.metrics["batched_jobs"],
+            "avg_wait_seconds": self.metrics["wait_time_total"] / started if started > 0 else 0.0,
+            "avg_service_seconds": self.metrics["service_time_total"] / done if done else 0.0,
+        }
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import time
+import logging
+from sqlite_db import SQLiteDatabase
+
+logger = logging.getLogger(__name__)
+
+class SessionStore:
+    # Backends persist plain dicts; UserSession objects never leave the process.
+    # shared=True means other instances may write the same keys.
+    shared = False
+
+    async def load(self, user_id):
+        return None
+
+    async def save_many(self, items):
+        pass
+
+    async def close(self):
+        pass
+
+class MemorySessionStore(SessionStore):
+    # Sessions only live in SessionManager's bounded local cache
+    pass
+
+class SQLiteSessionStore(SessionStore):
+    def __init__(self, path):
+        self.path = path
+        self._db = SQLiteDatabase(path, schema=(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)",
+        ), thread_name="sessions-sqlite")
+
+    @staticmethod
+    def _load(conn, user_id):
+        row = conn.execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @staticmethod
+    def _save_many(conn, items):
+        now = time.time()
+        conn.executemany(
+            "INSERT INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+            [(user_id, json.dumps(data), now) for user_id, data in items.items()]
+        )
+        conn.commit()
+
+    async def load(self, user_id):
+        return await self._db.run(self._load, user_id)
+
+    async def save_many(self, items):
+        await self._db.run(self._save_many, items)
+
+    async def close(self):
+        await self._db.close()
+
+class LocalSessionStore(SessionStore):
+    # In-process stand-in for a shared store. Several SessionManagers on one
+    # instance of it behave like several bot instances on Redis; data goes
+    # through JSON as it would over the wire, and latency simulates the hop.
+    shared = True
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self._data = {}
+
+    async def load(self, user_id):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        data = self._data.get(user_id)
+        return json.loads(data) if data else None
+
+    async def save_many(self, items):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        for user_id, data in items.items():
+            self._data[user_id] = json.dumps(data)
+
+class RedisSessionStore(SessionStore):
+    shared = True
+
+    def __init__(self, url, ttl, prefix="session:"):
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url)
+        self.ttl = int(ttl)
+        self.prefix = prefix
+
+    async def load(self, user_id):
+        data = await self._redis.get(f"{self.prefix}{user_id}")
+        return json.loads(data) if data else None
+
+    async def save_many(self, items):
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for user_id, data in items.items():
+                pipe.set(f"{self.prefix}{user_id}", json.dumps(data), ex=self.ttl)
+            await pipe.execute()
+
+    async def close(self):
+        await self._redis.aclose()
+
+def create_session_store(kind, sqlite_path, redis_url, ttl):
+    if kind == "sqlite":
+        return SQLiteSessionStore(sqlite_path)
+    if kind == "redis":
+        return RedisSessionStore(redis_url, ttl)
+    if kind == "local":
+        return LocalSessionStore()
+    if kind != "memory":
+        logger.warning(f"Unknown SESSION_STORE '{kind}', falling back to memory")
+    return MemorySessionStore()
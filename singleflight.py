@@ -0,0 +1,34 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class SingleFlight:
+    def __init__(self):
+        self._flights = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def in_flight(self, key):
+        return key in self._flights
+
+    async def do(self, key, fn):
+        # Later callers with the same key share the first caller's task; the
+        # task is shielded so one waiter cancelling does not cancel the others
+        task = self._flights.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.create_task(fn())
+            self._flights[key] = task
+            task.add_done_callback(lambda _: self._flights.pop(key, None))
+        else:
+            self.coalesced += 1
+            logger.info(f"Joined in-flight generation {key[:12]}")
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,121 @@
+import time
+import logging
+from collections import OrderedDict
+import httpx
+from image_stream import ImageBuffer
+from singleflight import SingleFlight
+from config import SOURCE_CACHE_BYTES, SOURCE_DOWNLOAD_TIMEOUT, SOURCE_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+class SourceTooLargeError(RuntimeError):
+    pass
+
+class SourceImageCache:
+    # Photos users send for img2img, keyed by Telegram file_unique_id, which
+    # stays the same however often the photo is forwarded or re-sent. Both the
+    # download and the fitted copy sent to the backend are cached, so a second
+    # edit of the same photo at the same size costs nothing.
+
+    def __init__(self, transcoder, max_bytes=SOURCE_CACHE_BYTES):
+        self.transcoder = transcoder
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._flights = SingleFlight()
+        self._client = None
+        self.hits = 0
+        self.misses = 0
+        self.bytes_downloaded = 0
+
+    def _get(self, key):
+        image = self._entries.get(key)
+        if image is not None:
+            self._entries.move_to_end(key)
+        return image
+
+    def _put(self, key, image):
+        if len(image) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        self._entries[key] = image
+        self._bytes += len(image)
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    def _http(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=SOURCE_DOWNLOAD_TIMEOUT)
+        return self._client
+
+    async def _download(self, bot, ref):
+        started = time.perf_counter()
+        file = await bot.get_file(ref["file_id"])
+        if file.file_size and file.file_size > SOURCE_MAX_BYTES:
+            raise SourceTooLargeError(f"Photo is larger than {SOURCE_MAX_BYTES // (1024 * 1024)}MB")
+        image = ImageBuffer(name="source")
+        if file.file_path and file.file_path.startswith(("http://", "https://")):
+            # Written to the buffer chunk by chunk; large photos spool to disk
+            async with self._http().stream("GET", file.file_path) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes():
+                    image.write(chunk)
+                    if len(image) > SOURCE_MAX_BYTES:
+                        raise SourceTooLargeError(f"Photo is larger than {SOURCE_MAX_BYTES // (1024 * 1024)}MB")
+        else:
+            # Local Bot API servers hand out paths instead of URLs
+            image.write(await file.download_as_bytearray())
+        self.bytes_downloaded += len(image)
+        logger.info(
+            f"Downloaded source {ref['file_unique_id']} ({len(image)} bytes) "
+            f"in {(time.perf_counter() - started) * 1000:.0f}ms"
+        )
+        return image
+
+    async def _source(self, bot, ref):
+        key = ref["file_unique_id"]
+        image = self._get(key)
+        if image is not None:
+            self.hits += 1
+            return image
+        self.misses += 1
+
+        async def download():
+            image = await self._download(bot, ref)
+            self._put(key, image)
+            return image
+
+        return await self._flights.do(key, download)
+
+    async def fitted(self, bot, ref, width, height, mask=False):
+        key = f"{ref['file_unique_id']}:{width}x{height}:{'mask' if mask else 'rgb'}"
+        image = self._get(key)
+        if image is not None:
+            self.hits += 1
+            return image
+
+        async def fit():
+            source = await self._source(bot, ref)
+            image = await self.transcoder.fit(source, width, height, mask=mask)
+            if image is not source:
+                self._put(key, image)
+            return image
+
+        return await self._flights.do(key, fit)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes_downloaded": self.bytes_downloaded,
+        }
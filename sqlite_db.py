@@ -0,0 +1,41 @@
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+class SQLiteDatabase:
+    # One lazily opened WAL connection for async code. sqlite3 connections are
+    # not thread-safe, so all access goes through one thread: run(fn, *args)
+    # calls fn(conn, *args) there.
+
+    def __init__(self, path, schema=(), synchronous=None, thread_name="sqlite"):
+        self.path = path
+        self.schema = schema
+        self.synchronous = synchronous
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=thread_name)
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            if self.synchronous:
+                self._conn.execute(f"PRAGMA synchronous={self.synchronous.upper()}")
+            for statement in self.schema:
+                self._conn.execute(statement)
+            self._conn.commit()
+        return self._conn
+
+    def _call(self, fn, args):
+        return fn(self._connect(), *args)
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, fn, args)
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def close(self):
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close)
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,14 @@
+import os
+import sys
+
+# config.py reads the environment at import time, so test settings go in first;
+# fast retries, and importing bot must not write anything to the working directory
+os.environ.setdefault("RETRY_BACKOFF_BASE", "0.01")
+os.environ.setdefault("RETRY_BACKOFF_MAX", "0.05")
+os.environ.setdefault("SESSION_STORE", "memory")
+os.environ.setdefault("RECENT_RESULTS_PATH", "")
+os.environ.setdefault("JOB_JOURNAL_PATH", "")
+os.environ.setdefault("WEBHOOK_STATE_PATH", "")
+
+# The modules live flat in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,45 @@
+import pytest
+from admission import AdmissionController, BudgetExceededError, job_cost
+
+PARAMS = {"width": 512, "height": 512, "steps": 20, "sampler": "Euler a"}
+
+def test_job_cost_scales_with_work():
+    base = job_cost(PARAMS)
+    assert job_cost({**PARAMS, "steps": 40}) == pytest.approx(2 * base)
+    assert job_cost({**PARAMS, "batch_size": 4}) == pytest.approx(4 * base)
+    hires = {"width": 1024, "height": 1024, "steps": 10, "denoising_strength": 0.5}
+    assert job_cost({**PARAMS, "hires": hires}) == pytest.approx(base * 2)
+    assert job_cost({**PARAMS, "img2img": {"denoising_strength": 0.5}}) == pytest.approx(base / 2)
+
+def test_user_budget_is_spent_and_refunded():
+    controller = AdmissionController(user_capacity=3, user_refill_per_minute=0, gpu_budget=100)
+    tickets = [controller.admit(1, PARAMS) for _ in range(3)]
+    with pytest.raises(BudgetExceededError, match="Not enough credits"):
+        controller.admit(1, PARAMS)
+    # Other users have their own budget
+    controller.admit(2, PARAMS)
+    controller.release(tickets[0], refund=True)
+    controller.release(tickets[0], refund=True)
+    assert controller.remaining(1) == pytest.approx(1)
+    controller.admit(1, PARAMS)
+
+def test_oversized_jobs_are_refused_outright():
+    controller = AdmissionController(user_capacity=3, gpu_budget=100)
+    with pytest.raises(BudgetExceededError, match="at most"):
+        controller.admit(1, {**PARAMS, "steps": 100})
+
+def test_expensive_jobs_wait_for_gpu_budget():
+    controller = AdmissionController(
+        user_capacity=100, user_refill_per_minute=0, gpu_budget=10, saturation=0.4, expensive=4
+    )
+    big = {**PARAMS, "steps": 80}
+    first = controller.admit(1, big)
+    assert not first.deferred
+    # Load is now 4 of 10: a second expensive job fits but is deferred past saturation
+    second = controller.admit(2, big)
+    assert second.deferred
+    with pytest.raises(BudgetExceededError, match="saturated"):
+        controller.admit(3, big)
+    controller.release(first)
+    controller.release(second)
+    assert controller.load == 0
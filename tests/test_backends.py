@@ -0,0 +1,71 @@
+from backends import BackendPool, RetryBudget, CLOSED, OPEN, HALF_OPEN, parse_backend_urls
+
+def make_pool(*urls, max_failures=2):
+    return BackendPool([(url, 1.0) for url in urls], max_failures=max_failures)
+
+def fail(pool, backend):
+    assert pool.acquire(exclude=[b for b in pool.backends if b is not backend]) is backend
+    pool.release(backend, ok=False)
+
+def test_parse_backend_urls():
+    assert parse_backend_urls(" https://a.example/|2, https://b.example ,") == [
+        ("https://a.example", 2.0), ("https://b.example", 1.0)
+    ]
+
+def test_least_loaded_backend_is_picked():
+    pool = make_pool("a", "b")
+    first = pool.acquire()
+    second = pool.acquire()
+    assert {first.url, second.url} == {"a", "b"}
+    pool.release(first, ok=True)
+    assert pool.acquire() is first
+
+def test_breaker_opens_after_consecutive_failures():
+    pool = make_pool("a", "b")
+    a, b = pool.backends
+    fail(pool, a)
+    assert a.state == CLOSED
+    fail(pool, a)
+    assert a.state == OPEN
+    # Traffic moves to the healthy backend; with both open nothing is handed out
+    assert pool.acquire() is b
+    pool.release(b, ok=False)
+    pool.release(pool.acquire(), ok=False)
+    assert pool.acquire() is None
+    assert pool.retry_in() > 0
+
+def test_half_open_trial_closes_or_reopens_with_longer_cooldown():
+    pool = make_pool("a", max_failures=1)
+    backend = pool.backends[0]
+    fail(pool, backend)
+    cooldown = backend.cooldown
+    backend.opened_at -= cooldown
+
+    trial = pool.acquire()
+    assert trial is backend and backend.state == HALF_OPEN
+    # Only one trial at a time
+    assert pool.acquire() is None
+    pool.release(trial, ok=False)
+    assert backend.state == OPEN and backend.cooldown == 2 * cooldown
+
+    backend.opened_at -= backend.cooldown
+    pool.release(pool.acquire(), ok=True)
+    assert backend.state == CLOSED and backend.cooldown == cooldown
+
+def test_abandoned_trial_frees_the_slot():
+    pool = make_pool("a", max_failures=1)
+    backend = pool.backends[0]
+    fail(pool, backend)
+    backend.opened_at -= backend.cooldown
+    pool.release(pool.acquire(), ok=None)
+    assert backend.state == HALF_OPEN
+    assert pool.acquire() is backend
+
+def test_retry_budget_limits_retries_to_a_share_of_calls():
+    budget = RetryBudget(ratio=0.5, min_per_second=0, capacity=1)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    budget.deposit()
+    assert budget.withdraw()
+    assert budget.stats()["retries"] == 2 and budget.stats()["denied"] == 1
@@ -0,0 +1,85 @@
+import asyncio
+import time
+import pytest
+import fake_a1111
+from backends import CLOSED, OPEN
+from config import BACKEND_MAX_FAILURES
+from gradio_connector import GradioConnector, BackendUnavailableError
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def run_with_backend(test, **options):
+    # Runs test(connector, fake_app) against a fake A1111 server on this loop
+    async def main():
+        options.setdefault("call_overhead", 0.2)
+        options.setdefault("per_image", 0.0)
+        fake_app = fake_a1111.create_app(**options)
+        server, task, url = await fake_a1111.serve(fake_app)
+        connector = GradioConnector(url)
+        try:
+            return await test(connector, fake_app)
+        finally:
+            await connector.close()
+            server.should_exit = True
+            await task
+    return asyncio.run(main())
+
+def generate(connector, sampler="Euler a", seed=-1):
+    return connector.generate_image("a cat", "", 20, 7.0, 512, 512, sampler, seed=seed)
+
+def test_concurrent_generations_interleave():
+    async def test(connector, fake_app):
+        ticks = 0
+        stop = asyncio.Event()
+
+        async def ticker():
+            nonlocal ticks
+            while not stop.is_set():
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticking = asyncio.create_task(ticker())
+        started = time.perf_counter()
+        images = await asyncio.gather(*(generate(connector) for _ in range(3)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await ticking
+        return images, elapsed, ticks, fake_app.state.calls
+
+    images, elapsed, ticks, calls = run_with_backend(test)
+    assert calls == 3
+    assert all(image.getvalue().startswith(PNG_SIGNATURE) for image in images)
+    # The fake renders one call at a time, ~0.6s in all; the loop kept running throughout
+    assert elapsed >= 0.55
+    assert ticks >= elapsed / 0.01 * 0.5
+
+def test_rejected_request_is_not_retried_and_spares_the_breaker():
+    async def test(connector, fake_app):
+        with pytest.raises(RuntimeError) as error:
+            await generate(connector, sampler="PLMS")
+        assert not isinstance(error.value, BackendUnavailableError)
+        assert "Sampler not found" in str(error.value)
+        backend = connector.pool.backends[0]
+        assert (backend.state, backend.failures, backend.total_requests) == (CLOSED, 0, 1)
+        # Another user's valid request still goes through
+        image = await generate(connector)
+        return image, fake_app.state.calls
+
+    image, calls = run_with_backend(test)
+    assert image.getvalue().startswith(PNG_SIGNATURE)
+    assert calls == 1
+
+def test_failing_backend_opens_its_breaker():
+    async def test(connector, fake_app):
+        with pytest.raises(BackendUnavailableError):
+            await generate(connector)
+        backend = connector.pool.backends[0]
+        assert backend.state == OPEN
+        assert backend.total_failures == BACKEND_MAX_FAILURES
+        # Fails fast while the circuit is open
+        started = time.perf_counter()
+        with pytest.raises(BackendUnavailableError, match="All image backends are unavailable"):
+            await generate(connector)
+        assert time.perf_counter() - started < 0.1
+
+    run_with_backend(test, call_overhead=0.01, failure_rate=1.0)
@@ -0,0 +1,90 @@
+import asyncio
+import datetime
+import pytest
+from telegram import CallbackQuery, Chat, Message, Update, User
+from telegram.ext import Application, CallbackContext, CallbackQueryHandler, ConversationHandler, MessageHandler, filters
+from conversation_store import LocalConversationStore, SharedConversationHandler, SharedConversations, conversation_key
+
+WAITING = 1
+USER = User(7, "user", False)
+CHAT = Chat(7, "private")
+
+def button_press(update_id):
+    message = Message(1, datetime.datetime.now(), CHAT)
+    return Update(update_id, callback_query=CallbackQuery("query", USER, "instance", data="cu:steps", message=message))
+
+def text_message(update_id, text):
+    return Update(update_id, message=Message(update_id, datetime.datetime.now(), CHAT, from_user=USER, text=text))
+
+class Instance:
+    # One bot instance: its own handler and SharedConversations on the shared store
+    def __init__(self, store, log):
+        async def ask(update, context):
+            log.append("ask")
+            return WAITING
+
+        async def answer(update, context):
+            log.append(update.message.text)
+            return ConversationHandler.END
+
+        self.conversations = SharedConversations(store)
+        self.application = Application.builder().token("123:abc").build()
+        self.handler = SharedConversationHandler(
+            entry_points=[CallbackQueryHandler(ask)],
+            states={WAITING: [MessageHandler(filters.TEXT, answer)]},
+            fallbacks=[],
+            per_message=False,
+            conversations=self.conversations,
+        )
+
+    async def process(self, update):
+        # What bot.process_update and Application.process_update do for this handler
+        await self.conversations.prefetch(conversation_key(update))
+        check = self.handler.check_update(update)
+        if check is not None and check is not False:
+            context = CallbackContext.from_update(update, self.application)
+            await self.handler.handle_update(update, self.application, check, context)
+        await self.conversations.flush()
+        # Let change announcements reach the other instances
+        await asyncio.sleep(0)
+
+@pytest.mark.filterwarnings("ignore:If 'per_message=False'")
+def test_state_set_on_one_instance_is_answered_on_another():
+    async def main():
+        store = LocalConversationStore()
+        log = []
+        first, second = Instance(store, log), Instance(store, log)
+        # The handler must read and write our dict, not a private one of its own
+        assert first.handler._conversations is first.conversations
+        for instance in (first, second):
+            await instance.conversations.start()
+
+        await first.process(button_press(1))
+        waiting = await store.load("7:7")
+        await second.process(text_message(2, "30"))
+        ended = await store.load("7:7")
+        # Ended everywhere: the first instance does not take the next text as an answer
+        await first.process(text_message(3, "40"))
+        for instance in (first, second):
+            await instance.conversations.close()
+        return log, waiting, ended, first.conversations.stats()
+
+    log, waiting, ended, stats = asyncio.run(main())
+    assert log == ["ask", "30"]
+    assert waiting == WAITING and ended is None
+    assert stats["invalidations"] >= 1
+
+def test_prefetch_serves_fresh_local_copies_without_loading():
+    async def main():
+        store = LocalConversationStore()
+        conversations = SharedConversations(store)
+        conversations[(7, 7)] = WAITING
+        await conversations.flush()
+        await conversations.prefetch((7, 7))
+        other = SharedConversations(store)
+        await other.prefetch((7, 7))
+        return conversations.metrics, dict(other)
+
+    metrics, loaded = asyncio.run(main())
+    assert metrics["hits"] == 1 and metrics["loads"] == 0
+    assert loaded == {(7, 7): WAITING}
@@ -0,0 +1,62 @@
+import asyncio
+import base64
+import json
+import pytest
+from image_stream import Base64JsonBody, ImageBuffer, Txt2ImgStreamParser
+
+def feed_in_chunks(parser, body, size):
+    for start in range(0, len(body), size):
+        parser.feed(body[start:start + size])
+    return parser.close()
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 64, 1 << 20])
+def test_images_are_decoded_across_chunk_boundaries(chunk_size):
+    images = [bytes(range(256)) * 5, b"second image"]
+    encoded = [base64.b64encode(image).decode() for image in images]
+    # Python's json escapes "/" as "\/" only on request; A1111 responses can contain either
+    encoded[0] = encoded[0].replace("/", "\\/")
+    body = (
+        '{"images": ["' + '", "'.join(encoded) + '"], '
+        '"parameters": {"prompt": "a [cat]", "images": "not these"}, "info": "{\\"all_seeds\\": [7, 8]}"}'
+    ).encode()
+
+    parser = Txt2ImgStreamParser()
+    rest = feed_in_chunks(parser, body, chunk_size)
+
+    assert [image.getvalue() for image in parser.images] == images
+    assert rest["images"] == []
+    assert rest["parameters"] == {"prompt": "a [cat]", "images": "not these"}
+    assert json.loads(rest["info"]) == {"all_seeds": [7, 8]}
+
+def test_large_images_spool_to_disk():
+    data = bytes(range(256)) * 64
+    body = b'{"images": ["' + base64.b64encode(data) + b'"]}'
+    parser = Txt2ImgStreamParser(spool_bytes=1024)
+    feed_in_chunks(parser, body, 500)
+    image = parser.images[0]
+    assert image._file is not None
+    assert image.getvalue() == data
+    assert image.open().read() == data
+
+def test_truncated_response_is_an_error():
+    parser = Txt2ImgStreamParser()
+    parser.feed(b'{"images": ["aGVsbG8')
+    with pytest.raises(ValueError):
+        parser.close()
+
+def test_base64_json_body_streams_valid_json():
+    source = ImageBuffer(bytearray(bytes(range(256)) * 100))
+    mask = ImageBuffer(bytearray(b"mask bytes"))
+    body = Base64JsonBody({"prompt": "a cat", "steps": 20}, {"init_images": [source], "mask": mask}, chunk_size=1000)
+
+    async def collect():
+        return b"".join([chunk async for chunk in body])
+
+    data = asyncio.run(collect())
+    assert len(data) == len(body)
+    decoded = json.loads(data)
+    assert decoded["prompt"] == "a cat"
+    assert base64.b64decode(decoded["init_images"][0]) == source.getvalue()
+    assert base64.b64decode(decoded["mask"]) == mask.getvalue()
+    # Iterable again for a retry
+    assert asyncio.run(collect()) == data
@@ -0,0 +1,73 @@
+import asyncio
+import httpx
+from ingest import UpdateIngestor, update_key
+
+def message(update_id, user_id, text="hi"):
+    return {"update_id": update_id, "message": {"from": {"id": user_id}, "chat": {"id": user_id}, "text": text}}
+
+def test_updates_are_keyed_by_sender():
+    assert update_key(message(1, 42)) == 42
+    assert update_key({"update_id": 2, "callback_query": {"from": {"id": 42}}}) == 42
+    assert update_key({"update_id": 3}) == 3
+
+def test_redelivered_updates_are_dropped():
+    async def main():
+        processed = []
+
+        async def process(data):
+            processed.append(data["update_id"])
+
+        ingestor = UpdateIngestor(process, workers=2, max_queue=10)
+        ingestor.start()
+        statuses = [ingestor.submit(message(1, 42)), ingestor.submit(message(1, 42)), ingestor.submit(message(2, 42))]
+        await ingestor.stop()
+        return statuses, processed, ingestor.stats()
+
+    statuses, processed, stats = asyncio.run(main())
+    assert statuses == ["accepted", "duplicate", "accepted"]
+    assert processed == [1, 2]
+    assert stats["duplicates"] == 1
+
+def test_one_senders_updates_stay_in_order_while_others_run():
+    async def main():
+        finished = []
+
+        async def process(data):
+            await asyncio.sleep(data["message"]["text"])
+            finished.append(data["update_id"])
+
+        ingestor = UpdateIngestor(process, workers=4, max_queue=40)
+        ingestor.start()
+        # A slow update from user 1 holds back that user's next one, not user 2's
+        ingestor.submit(message(1, 1, 0.05))
+        ingestor.submit(message(2, 1, 0))
+        ingestor.submit(message(3, 2, 0))
+        await ingestor.stop()
+        return finished
+
+    assert asyncio.run(main()) == [3, 1, 2]
+
+def test_full_shard_rejects_without_remembering_the_update():
+    async def main():
+        ingestor = UpdateIngestor(lambda data: asyncio.sleep(0), workers=1, max_queue=1)
+        first = ingestor.submit(message(1, 1))
+        rejected = ingestor.submit(message(2, 1))
+        ingestor.start()
+        await ingestor.stop()
+        # Telegram redelivers the rejected update, which is then accepted
+        return first, rejected, ingestor.submit(message(2, 1))
+
+    assert asyncio.run(main()) == ("accepted", "full", "accepted")
+
+def test_webhook_answers_503_when_the_queue_is_full(monkeypatch):
+    import bot
+
+    async def main():
+        ingestor = UpdateIngestor(lambda data: asyncio.sleep(0), workers=1, max_queue=1)
+        monkeypatch.setattr(bot, "update_ingestor", ingestor)
+        monkeypatch.setattr(bot, "bot_ready", True)
+        transport = httpx.ASGITransport(app=bot.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bot") as client:
+            return [(await client.post("/webhook", json=message(update_id, 1))).status_code for update_id in (1, 2)]
+
+    assert asyncio.run(main()) == [200, 503]
@@ -0,0 +1,131 @@
+import asyncio
+import os
+import sqlite3
+from image_stream import ImageBuffer
+from job_journal import JobJournal, PENDING, DELIVERED, ABANDONED, RESUMED
+
+def image(data, seed):
+    buffer = ImageBuffer(bytearray(data))
+    buffer.seed = seed
+    return buffer
+
+def rows(path):
+    with sqlite3.connect(path) as conn:
+        return {row[0]: row[1:] for row in conn.execute("SELECT job_id, state, owner, results FROM jobs")}
+
+class Recovery:
+    def __init__(self):
+        self.resumed = []
+        self.redelivered = []
+        self.abandoned = []
+
+    async def resume(self, row, params, seeds):
+        self.resumed.append((params, seeds))
+
+    async def redeliver(self, row, params, images):
+        self.redelivered.append([(bytes(image.read_at(0, len(image))), image.seed) for image in images])
+
+    async def abandon(self, row, params):
+        self.abandoned.append(params)
+
+    async def recover(self, journal):
+        await journal.recover(self.resume, self.redeliver, self.abandon)
+
+async def crash(journal):
+    # A process that dies keeps its leases until they run out
+    await journal.flush()
+    await asyncio.gather(*journal._spools)
+    await journal.flush()
+    await journal._db.close()
+
+def test_finished_jobs_are_not_recovered(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    async def main():
+        journal = JobJournal(path, flush_interval=0)
+        job_id = journal.begin(1, 1, 10, "txt2img", {"prompt": "cat"})
+        journal.finish(job_id, DELIVERED)
+        await journal.close()
+        recovery = Recovery()
+        successor = JobJournal(path, lease=0)
+        await recovery.recover(successor)
+        await successor.close()
+        return job_id, recovery
+    job_id, recovery = asyncio.run(main())
+    assert rows(path)[job_id][0] == DELIVERED
+    assert not (recovery.resumed or recovery.redelivered or recovery.abandoned)
+
+def test_cut_off_jobs_are_resumed_or_redelivered(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    async def main():
+        journal = JobJournal(path, flush_interval=0, lease=0)
+        pending = journal.begin(1, 1, 10, "txt2img", {"prompt": "cat"})
+        rendered = journal.begin(2, 2, 20, "txt2img", {"prompt": "dog"})
+        await journal.rendered(rendered, [image(b"png-1", 7), image(b"png-2", 8)])
+        await crash(journal)
+
+        recovery = Recovery()
+        successor = JobJournal(path, flush_interval=0)
+        await recovery.recover(successor)
+        await successor.close()
+        return pending, rendered, recovery, successor
+    pending, rendered, recovery, successor = asyncio.run(main())
+    assert recovery.resumed == [({"prompt": "cat"}, [])]
+    assert recovery.redelivered == [[(b"png-1", 7), (b"png-2", 8)]]
+    assert successor.recovered == {"resumed": 1, "redelivered": 1, "abandoned": 0}
+    states = rows(path)
+    assert states[pending][0] == RESUMED and states[rendered][0] == DELIVERED
+    # Redelivered results are removed from the spool
+    assert os.listdir(f"{path}.results") == []
+
+def test_live_leases_are_not_taken_over(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    async def main():
+        journal = JobJournal(path, flush_interval=0)
+        job_id = journal.begin(1, 1, 10, "txt2img", {"prompt": "cat"})
+        await journal.flush()
+
+        recovery = Recovery()
+        other = JobJournal(path, flush_interval=0)
+        await recovery.recover(other)
+        await other.close()
+        untouched = rows(path)[job_id]
+
+        # A clean shutdown gives the lease up for the next process
+        await journal.close()
+        successor = JobJournal(path, flush_interval=0)
+        await recovery.recover(successor)
+        await successor.close()
+        return journal, untouched, recovery
+    journal, untouched, recovery = asyncio.run(main())
+    assert untouched[:2] == (PENDING, journal.owner)
+    assert recovery.resumed == [({"prompt": "cat"}, [])]
+
+def test_stale_jobs_are_abandoned(tmp_path, monkeypatch):
+    path = str(tmp_path / "jobs.db")
+    monkeypatch.setattr("job_journal.JOB_JOURNAL_RESUME_MAX_AGE", -1)
+    async def main():
+        journal = JobJournal(path, flush_interval=0, lease=0)
+        job_id = journal.begin(1, 1, 10, "txt2img", {"prompt": "cat"})
+        await crash(journal)
+        recovery = Recovery()
+        successor = JobJournal(path, flush_interval=0)
+        await recovery.recover(successor)
+        await successor.close()
+        return job_id, recovery
+    job_id, recovery = asyncio.run(main())
+    assert recovery.abandoned == [{"prompt": "cat"}]
+    assert rows(path)[job_id][0] == ABANDONED
+
+def test_results_delivered_before_spooling_are_not_kept(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    async def main():
+        journal = JobJournal(path, flush_interval=0)
+        job_id = journal.begin(1, 1, 10, "txt2img", {"prompt": "cat"})
+        await journal.rendered(job_id, [image(b"png", 1)])
+        journal.finish(job_id, DELIVERED)
+        await journal.close()
+        return job_id
+    job_id = asyncio.run(main())
+    state, _, results = rows(path)[job_id]
+    assert state == DELIVERED and results is None
+    assert os.listdir(f"{path}.results") == []
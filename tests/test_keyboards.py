@@ -0,0 +1,61 @@
+import pytest
+import keyboards
+from keyboards import ACTION_CODES, INDEXED_ARGS, callback, decode_callback
+
+def buttons(markup):
+    return [button for row in markup.inline_keyboard for button in row]
+
+def test_every_route_has_a_code_that_round_trips():
+    from bot import CALLBACK_ROUTES
+    assert set(ACTION_CODES) == set(CALLBACK_ROUTES)
+    for action in CALLBACK_ROUTES:
+        assert decode_callback(callback(action)) == (action, None)
+        assert decode_callback(callback(action, "arg")) == (action, "arg")
+        for value in INDEXED_ARGS.get(action, ()):
+            data = callback(action, value)
+            assert decode_callback(data) == (action, value)
+            assert len(data) < len(f"{action}:{value}")
+
+@pytest.mark.parametrize("data, decoded", [
+    # Buttons sent before the compact codes
+    ("generate", ("generate", None)),
+    ("view_settings", ("view_settings", None)),
+    ("back:main", ("back", "main")),
+    ("custom:negative", ("custom", "negative")),
+    ("toggle:restore_faces", ("toggle", "restore_faces")),
+    ("quality:Fast (10 steps)", ("quality", "Fast (10 steps)")),
+    ("size:Square 512x512", ("size", "Square 512x512")),
+    ("sampler:DPM++ 2M Karras", ("sampler", "DPM++ 2M Karras")),
+    ("scheduler:Karras", ("scheduler", "Karras")),
+    ("variation:2", ("variation", "2")),
+])
+def test_legacy_callback_data_still_routes(data, decoded):
+    assert decode_callback(data) == decoded
+
+def test_unknown_indexes_and_backend_names():
+    assert decode_callback(f"{ACTION_CODES['sampler']}:999") == ("sampler", None)
+    # Samplers only a backend reports go by name
+    data = callback("sampler", "Restart")
+    assert data == f"{ACTION_CODES['sampler']}:Restart"
+    assert decode_callback(data) == ("sampler", "Restart")
+
+def test_callback_data_stays_within_64_bytes():
+    with pytest.raises(ValueError):
+        callback("sampler", "x" * 64)
+    long_name = "A sampler name some backend plugin reports that is far too long for Telegram"
+    markup = keyboards.get_sampler_keyboard(None, ("Euler a", long_name))
+    assert [button.text for button in buttons(markup)] == ["Euler a", "« Back"]
+
+def test_every_keyboard_button_decodes_to_a_route():
+    from bot import CALLBACK_ROUTES
+    markups = [
+        keyboards.get_main_menu_keyboard(), keyboards.get_quality_keyboard(), keyboards.get_size_keyboard(),
+        keyboards.get_advanced_keyboard(), keyboards.get_draft_keyboard(), keyboards.get_recent_keyboard(),
+        keyboards.get_img2img_keyboard(False), keyboards.get_img2img_keyboard(True),
+        keyboards.get_sampler_keyboard(), keyboards.get_scheduler_keyboard(),
+        keyboards.get_delivery_keyboard("png", False), keyboards.get_variations_keyboard(10),
+    ]
+    for markup in markups:
+        for button in buttons(markup):
+            assert len(button.callback_data.encode()) <= 64
+            assert decode_callback(button.callback_data)[0] in CALLBACK_ROUTES
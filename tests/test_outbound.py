@@ -0,0 +1,74 @@
+import asyncio
+import datetime
+import pytest
+from telegram.error import RetryAfter
+from outbound import SendScheduler
+
+def sender(log, name, flood=0, retry_after=datetime.timedelta(milliseconds=50)):
+    state = {"floods": flood}
+    async def callback():
+        if state["floods"]:
+            state["floods"] -= 1
+            raise RetryAfter(retry_after)
+        log.append(name)
+        return name
+    return callback
+
+async def with_scheduler(test, **options):
+    scheduler = SendScheduler(**{"global_rate": 100, "chat_rate": 20, "chat_burst": 1, "flood_retries": 2, **options})
+    await scheduler.initialize()
+    try:
+        return await test(scheduler)
+    finally:
+        await scheduler.shutdown()
+
+def request(scheduler, callback, endpoint, **data):
+    return scheduler.process_request(callback, (), {}, endpoint, data, None)
+
+def test_queued_calls_go_out_by_priority():
+    async def test(scheduler):
+        log = []
+        # All three are queued before the dispatcher gets to run
+        calls = [
+            request(scheduler, sender(log, "edit"), "editMessageText", chat_id=1, message_id=5),
+            request(scheduler, sender(log, "message"), "sendMessage", chat_id=1),
+            request(scheduler, sender(log, "photo"), "sendPhoto", chat_id=1),
+        ]
+        await asyncio.gather(*calls)
+        return log
+    assert asyncio.run(with_scheduler(test)) == ["photo", "message", "edit"]
+
+def test_queued_edits_of_one_message_coalesce():
+    async def test(scheduler):
+        log = []
+        calls = [request(scheduler, sender(log, "first"), "sendMessage", chat_id=1)]
+        calls += [
+            request(scheduler, sender(log, f"edit{i}"), "editMessageText", chat_id=1, message_id=5)
+            for i in range(3)
+        ]
+        results = await asyncio.gather(*calls)
+        return log, results, scheduler.stats()
+    log, results, stats = asyncio.run(with_scheduler(test))
+    assert log == ["first", "edit2"]
+    # Every caller sees the result of the edit that actually went out
+    assert results == ["first", "edit2", "edit2", "edit2"]
+    assert stats["coalesced"] == 2
+
+def test_flood_wait_is_retried_then_given_up():
+    async def test(scheduler):
+        log = []
+        retried = await request(scheduler, sender(log, "retried", flood=1), "sendMessage", chat_id=1)
+        with pytest.raises(RetryAfter):
+            await request(scheduler, sender(log, "dropped", flood=5), "sendMessage", chat_id=2)
+        return log, retried, scheduler.stats()
+    log, retried, stats = asyncio.run(with_scheduler(test, flood_retries=1))
+    assert retried == "retried" and log == ["retried"]
+    assert stats["flood_waits"] == 3 and stats["flood_failures"] == 1
+
+def test_unlimited_endpoints_bypass_the_queue():
+    async def test(scheduler):
+        log = []
+        await request(scheduler, sender(log, "me"), "getMe")
+        return log, scheduler.stats()
+    log, stats = asyncio.run(with_scheduler(test))
+    assert log == ["me"] and stats["sent"] == 0
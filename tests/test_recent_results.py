@@ -0,0 +1,70 @@
+import asyncio
+from recent_results import RecentResults, prompt_key, result_key
+
+PARAMS = {"prompt": "a cat, sitting", "negative_prompt": "", "steps": 20, "cfg_scale": 7,
+          "width": 512, "height": 512, "sampler": "Euler a", "seed": -1}
+
+def test_prompt_key_ignores_spacing_case_and_trailing_commas():
+    assert prompt_key("  A  Cat ,sitting,\n") == prompt_key("a cat, sitting")
+    assert prompt_key("a cat, sitting") == "a cat, sitting"
+    # LoRA names are file names and keep their case
+    assert prompt_key("A cat <lora:MyStyle:0.8>") == "a cat <lora:MyStyle:0.8>"
+    assert prompt_key("a cat") != prompt_key("a dog")
+
+def test_result_key_depends_on_settings_and_model():
+    key = result_key(PARAMS, "sd15")
+    assert result_key({**PARAMS, "prompt": "A cat,  sitting,"}, "sd15") == key
+    # Delivery options do not change the image
+    assert result_key({**PARAMS, "as_document": True}, "sd15") == key
+    assert result_key({**PARAMS, "steps": 30}, "sd15") != key
+    assert result_key(PARAMS, "sdxl") != key
+
+def test_record_lookup_and_forget():
+    model = {"name": "sd15"}
+    results = RecentResults(model=lambda: model["name"], path="")
+    assert results.lookup(PARAMS) is None
+    results.record(PARAMS, "file-1", seed=42)
+    file_id, age, seed = results.lookup({**PARAMS, "prompt": "a cat , sitting"})
+    assert (file_id, seed) == ("file-1", 42) and age >= 0
+
+    # Another checkpoint renders something else
+    model["name"] = "sdxl"
+    assert results.lookup(PARAMS) is None
+    model["name"] = "sd15"
+
+    results.forget(PARAMS)
+    assert results.lookup(PARAMS) is None
+    assert results.stats()["hits"] == 1 and results.stats()["misses"] == 3
+
+def test_nothing_is_recorded_while_the_model_is_unknown():
+    results = RecentResults(model=lambda: None, path="")
+    results.record(PARAMS, "file-1")
+    assert len(results) == 0 and results.lookup(PARAMS) is None
+
+def test_expired_entries_are_not_offered():
+    results = RecentResults(model=lambda: "sd15", path="", max_age=-1)
+    results.record(PARAMS, "file-1")
+    assert results.lookup(PARAMS) is None
+
+def test_lowest_scores_are_trimmed_first():
+    results = RecentResults(model=lambda: "sd15", path="", max_entries=10)
+    popular = {**PARAMS, "prompt": "popular"}
+    results.record(popular, "popular")
+    for _ in range(3):
+        results.reuse(popular)
+    for i in range(10):
+        results.record({**PARAMS, "seed": i}, f"file-{i}")
+    assert len(results) == 9
+    assert results.lookup(popular)[0] == "popular"
+
+def test_entries_survive_a_restart(tmp_path):
+    path = str(tmp_path / "recent.json")
+    async def main():
+        results = RecentResults(model=lambda: "sd15", path=path, redis_url=None)
+        results.record(PARAMS, "file-1", seed=42)
+        await results.close()
+        restarted = RecentResults(model=lambda: "sd15", path=path, redis_url=None)
+        await restarted.load()
+        return restarted.lookup(PARAMS)
+    file_id, _, seed = asyncio.run(main())
+    assert (file_id, seed) == ("file-1", 42)
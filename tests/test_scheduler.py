@@ -0,0 +1,105 @@
+import asyncio
+import pytest
+from scheduler import GenerationScheduler, QueueFullError
+
+def test_users_are_served_round_robin():
+    async def main():
+        order = []
+
+        async def runner(params_list, on_progress):
+            order.extend(params["name"] for params in params_list)
+            return [params["name"] for params in params_list]
+
+        scheduler = GenerationScheduler(runner, workers=1, max_queue=10, batch_key=None)
+        jobs = [scheduler.submit(user_id, {"name": name}) for user_id, name in
+                [(1, "a1"), (1, "a2"), (1, "a3"), (2, "b1"), (3, "c1"), (2, "b2")]]
+        assert [scheduler.position(job) for job in jobs] == [1, 4, 6, 2, 3, 5]
+        scheduler.start()
+        results = await asyncio.gather(*(job.future for job in jobs))
+        await scheduler.stop()
+        return order, results
+
+    order, results = asyncio.run(main())
+    assert order == ["a1", "b1", "c1", "a2", "b2", "a3"]
+    assert results == ["a1", "a2", "a3", "b1", "c1", "b2"]
+
+def test_full_queue_rejects():
+    async def main():
+        async def runner(params_list, on_progress):
+            return params_list
+
+        scheduler = GenerationScheduler(runner, workers=1, max_queue=2)
+        scheduler.submit(1, {})
+        scheduler.submit(2, {})
+        with pytest.raises(QueueFullError):
+            scheduler.submit(3, {})
+        assert scheduler.stats()["rejected"] == 1
+        await scheduler.stop()
+
+    asyncio.run(main())
+
+def test_compatible_jobs_share_one_call():
+    async def main():
+        calls = []
+
+        async def runner(params_list, on_progress):
+            calls.append([params["name"] for params in params_list])
+            return [params["name"] for params in params_list]
+
+        scheduler = GenerationScheduler(
+            runner, workers=1, max_queue=10, batch_key=lambda params: params["size"], batch_window=0, max_batch=3
+        )
+        jobs = [scheduler.submit(user_id, {"name": f"job{user_id}", "size": size})
+                for user_id, size in [(1, 512), (2, 768), (3, 512), (4, 512), (5, 512)]]
+        scheduler.start()
+        results = await asyncio.gather(*(job.future for job in jobs))
+        await scheduler.stop()
+        return calls, results
+
+    calls, results = asyncio.run(main())
+    assert calls == [["job1", "job3", "job4"], ["job2"], ["job5"]]
+    assert results == ["job1", "job2", "job3", "job4", "job5"]
+
+def test_runner_failure_fails_every_job_in_the_batch():
+    async def main():
+        async def runner(params_list, on_progress):
+            raise RuntimeError("backend down")
+
+        scheduler = GenerationScheduler(runner, workers=1, max_queue=10, batch_key=lambda params: 1, batch_window=0)
+        jobs = [scheduler.submit(user_id, {}) for user_id in (1, 2)]
+        scheduler.start()
+        results = await asyncio.gather(*(job.future for job in jobs), return_exceptions=True)
+        await scheduler.stop()
+        return results, scheduler.stats()
+
+    results, stats = asyncio.run(main())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert stats["failed"] == 2
+
+def test_waiting_jobs_hear_their_new_position():
+    async def main():
+        updates = []
+        release = asyncio.Event()
+
+        async def runner(params_list, on_progress):
+            await release.wait()
+            return params_list
+
+        def on_position(user_id):
+            async def notify(position, eta):
+                updates.append((user_id, position))
+            return notify
+
+        scheduler = GenerationScheduler(runner, workers=1, max_queue=10)
+        jobs = [scheduler.submit(user_id, {}, on_position=on_position(user_id)) for user_id in (1, 2, 3)]
+        scheduler.start()
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(*(job.future for job in jobs))
+        await scheduler.stop()
+        return updates
+
+    updates = asyncio.run(main())
+    assert (2, 1) in updates and (3, 1) in updates
+    # Queued jobs are told when they start
+    assert (3, 0) in updates
@@ -0,0 +1,97 @@
+import asyncio
+from session_store import LocalSessionStore, SQLiteSessionStore
+from user_sessions import SessionManager
+
+def test_dirty_sessions_are_written_behind_in_one_batch():
+    store = LocalSessionStore()
+    saves = []
+    save_many = store.save_many
+
+    async def counting_save_many(items):
+        saves.append(sorted(items))
+        await save_many(items)
+
+    store.save_many = counting_save_many
+
+    async def main():
+        manager = SessionManager(store, flush_interval=0.01)
+        manager.start()
+        first = await manager.get(1)
+        second = await manager.get(2)
+        first.prompt = "a cat"
+        first.steps = 30
+        second.prompt = "a dog"
+        assert saves == []
+        await asyncio.sleep(0.05)
+        await manager.close()
+        return manager.stats()
+
+    stats = asyncio.run(main())
+    assert saves == [[1, 2]]
+    assert stats["dirty"] == 0 and stats["flushes"] == 1
+
+def test_evicted_sessions_reload_intact():
+    async def main():
+        store = LocalSessionStore()
+        manager = SessionManager(store, max_entries=2)
+        session = await manager.get(1)
+        session.update_params(prompt="a cat", steps=30, sampler="DPM++ 2M Karras")
+        session.init_image = {"file_id": "abc", "file_unique_id": "u1"}
+        await manager.get(2)
+        await manager.get(3)
+        # Evicted while still dirty: the unflushed session is served, not a blank one
+        assert 1 not in manager._cache
+        assert (await manager.get(1)) is session
+        await manager.flush()
+        await manager.get(2)
+        await manager.get(3)
+        assert 1 not in manager._cache
+        reloaded = await manager.get(1)
+        return session, reloaded
+
+    session, reloaded = asyncio.run(main())
+    assert reloaded is not session
+    assert reloaded.to_dict() == session.to_dict()
+
+def test_idle_sessions_expire_from_the_cache():
+    async def main():
+        manager = SessionManager(LocalSessionStore(), ttl=0.01)
+        (await manager.get(1)).prompt = "a cat"
+        await manager.flush()
+        await asyncio.sleep(0.02)
+        reloaded = await manager.get(1)
+        return reloaded, manager.loads
+
+    reloaded, loads = asyncio.run(main())
+    assert reloaded.prompt == "a cat"
+    assert loads == 2
+
+def test_shared_store_picks_up_other_instances_changes():
+    async def main():
+        store = LocalSessionStore()
+        first = SessionManager(store, refresh_interval=0)
+        second = SessionManager(store, refresh_interval=0)
+        (await first.get(1)).prompt = "a cat"
+        await first.flush()
+        seen = (await second.get(1)).prompt
+        (await second.get(1)).prompt = "a dog"
+        await second.flush()
+        return seen, (await first.get(1)).prompt
+
+    assert asyncio.run(main()) == ("a cat", "a dog")
+
+def test_sqlite_round_trip(tmp_path):
+    path = str(tmp_path / "sessions.db")
+
+    async def main():
+        manager = SessionManager(SQLiteSessionStore(path))
+        session = await manager.get(1)
+        session.update_params(prompt="a cat", seed=42, cfg_scale=6.5, tiling=True)
+        await manager.close()
+        restarted = SessionManager(SQLiteSessionStore(path))
+        reloaded = await restarted.get(1)
+        await restarted.close()
+        return session.to_dict(), reloaded.to_dict()
+
+    saved, reloaded = asyncio.run(main())
+    assert reloaded == saved
@@ -0,0 +1,17 @@
+import pytest
+from token_bucket import TokenBucket
+
+def test_token_bucket_refills_up_to_capacity():
+    bucket = TokenBucket(capacity=2, rate=1.0, now=0.0)
+    assert bucket.take(2, 0.0)
+    assert not bucket.take(1, 0.5)
+    assert bucket.wait_time(1, 0.5) == pytest.approx(0.5)
+    assert bucket.take(1, 1.0)
+    assert bucket.available(100.0) == 2
+
+def test_refunds_are_capped_and_empty_buckets_without_refill_never_come_back():
+    bucket = TokenBucket(capacity=3, rate=0, now=0.0)
+    assert bucket.take(3, 0.0)
+    assert bucket.wait_time(1, 10.0) == float("inf")
+    bucket.give(5, 10.0)
+    assert bucket.available(10.0) == 3
@@ -0,0 +1,39 @@
+import asyncio
+import fake_a1111
+from gradio_connector import GradioConnector
+from user_sessions import UserSession
+
+def test_variations_carry_their_seeds():
+    async def main():
+        server, task, url = await fake_a1111.serve(fake_a1111.create_app(call_overhead=0.01, per_image=0.0))
+        connector = GradioConnector(url)
+        params = {
+            "prompt": "a cat", "negative_prompt": "", "steps": 20, "cfg_scale": 7.0, "width": 512, "height": 512,
+            "sampler": "Euler a", "seed": 1000, "batch_size": 3,
+        }
+        try:
+            return await connector.generate_variations(params)
+        finally:
+            await connector.close()
+            server.should_exit = True
+            await task
+
+    images = asyncio.run(main())
+    assert [image.seed for image in images] == [1000, 1001, 1002]
+
+def test_picking_a_variation_leaves_the_session_alone(monkeypatch):
+    import bot
+
+    started = []
+    monkeypatch.setattr(bot, "start_generation", lambda *args, **kwargs: started.append(kwargs["params"]))
+    session = UserSession(7)
+    session.prompt = "a dog"
+    before = session.to_dict()
+    run_params = {**session.get_params(), "prompt": "a cat", "batch_size": 2, "n_iter": 2}
+    bot.remember_run(bot.variation_runs, 7, (run_params, [11, 12, 13, 14]))
+
+    asyncio.run(bot.on_variation(None, None, 7, session, "2"))
+
+    assert started == [{**run_params, "seed": 13, "batch_size": 1, "n_iter": 1}]
+    # Later generations still use the user's own settings and a random seed
+    assert session.to_dict() == before
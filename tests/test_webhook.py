@@ -0,0 +1,58 @@
+import asyncio
+from types import SimpleNamespace
+import httpx
+import bot
+
+class FakeBot:
+    def __init__(self, url=""):
+        self.url = url
+        self.calls = []
+
+    async def get_webhook_info(self):
+        self.calls.append("getWebhookInfo")
+        return SimpleNamespace(url=self.url)
+
+    async def set_webhook(self, url):
+        self.calls.append("setWebhook")
+        self.url = url
+
+def boot(monkeypatch, fake_bot, token="123:abc"):
+    monkeypatch.setattr(bot, "application", SimpleNamespace(bot=fake_bot))
+    monkeypatch.setattr(bot, "TELEGRAM_BOT_TOKEN", token)
+    asyncio.run(bot.ensure_webhook("https://bot.example/webhook"))
+
+def test_webhook_is_only_checked_until_it_is_known_to_be_set(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_STATE_PATH", str(tmp_path / "webhook_state.json"))
+    fake_bot = FakeBot()
+    boot(monkeypatch, fake_bot)
+    assert fake_bot.calls == ["getWebhookInfo", "setWebhook"]
+    boot(monkeypatch, fake_bot)
+    assert fake_bot.calls == ["getWebhookInfo", "setWebhook"]
+    # Another bot token, or a stale record, is checked again
+    boot(monkeypatch, fake_bot, token="456:def")
+    assert fake_bot.calls[2:] == ["getWebhookInfo"]
+    monkeypatch.setattr(bot, "WEBHOOK_RECHECK_INTERVAL", 0)
+    boot(monkeypatch, fake_bot, token="456:def")
+    assert fake_bot.calls[3:] == ["getWebhookInfo"]
+
+def test_webhook_is_checked_every_boot_without_a_state_path(monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_STATE_PATH", "")
+    fake_bot = FakeBot("https://bot.example/webhook")
+    boot(monkeypatch, fake_bot)
+    boot(monkeypatch, fake_bot)
+    assert fake_bot.calls == ["getWebhookInfo", "getWebhookInfo"]
+
+def test_updates_are_refused_when_setup_failed(monkeypatch):
+    async def main():
+        setup_done = asyncio.Event()
+        setup_done.set()
+        monkeypatch.setattr(bot, "setup_done", setup_done)
+        monkeypatch.setattr(bot, "setup_error", ValueError("TELEGRAM_BOT_TOKEN not set"))
+        monkeypatch.setattr(bot, "bot_ready", False)
+        transport = httpx.ASGITransport(app=bot.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bot") as client:
+            update = await client.post("/webhook", json={"update_id": 1})
+            health = await client.get("/")
+        return update.status_code, health.status_code
+
+    assert asyncio.run(main()) == (503, 503)
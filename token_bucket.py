@@ -0,0 +1,31 @@
+import time
+
+class TokenBucket:
+    # Holds up to capacity tokens and refills at rate tokens per second. Callers
+    # pass the current time.monotonic() so one reading can serve several buckets.
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity, rate, now=None):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def available(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        return self.tokens
+
+    def take(self, amount, now):
+        if self.available(now) < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def give(self, amount, now):
+        self.tokens = min(self.capacity, self.available(now) + amount)
+
+    def wait_time(self, amount, now):
+        missing = amount - self.available(now)
+        return max(0.0, missing / self.rate) if self.rate > 0 else float("inf")
@@ -0,0 +1,167 @@
+import asyncio
+import math
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from image_stream import ImageBuffer
+from config import DELIVERY_QUALITY, TRANSCODE_WORKERS, VARIATIONS_GRID_MAX_SIDE
+
+logger = logging.getLogger(__name__)
+
+try:
+    from PIL import Image, ImageDraw, ImageOps
+except ImportError:
+    Image = None
+
+DELIVERY_FORMATS = {
+    "png": ("PNG (original)", None, "png"),
+    "jpeg": ("JPEG", "JPEG", "jpg"),
+    "webp": ("WebP", "WEBP", "webp"),
+}
+
+def _encode(image, pil_format, quality):
+    with Image.open(image.open()) as source:
+        if pil_format == "JPEG" and source.mode not in ("RGB", "L"):
+            source = source.convert("RGB")
+        output = BytesIO()
+        source.save(output, format=pil_format, quality=quality, optimize=pil_format == "JPEG")
+    return output.getvalue()
+
+def _compose(images, columns, max_side, quality):
+    tiles = [Image.open(image.open()) for image in images]
+    try:
+        tile_width = max(tile.width for tile in tiles)
+        tile_height = max(tile.height for tile in tiles)
+        rows = math.ceil(len(tiles) / columns)
+        scale = min(1.0, max_side / max(tile_width * columns, tile_height * rows))
+        tile_width, tile_height = int(tile_width * scale), int(tile_height * scale)
+        sheet = Image.new("RGB", (tile_width * columns, tile_height * rows), "white")
+        draw = ImageDraw.Draw(sheet)
+        for index, tile in enumerate(tiles):
+            x, y = (index % columns) * tile_width, (index // columns) * tile_height
+            tile.draft("RGB", (tile_width, tile_height))
+            sheet.paste(tile.convert("RGB").resize((tile_width, tile_height), Image.BILINEAR), (x, y))
+            # Numbers match the re-render buttons under the sheet
+            draw.rectangle((x, y, x + 28, y + 20), fill="black")
+            draw.text((x + 8, y + 4), str(index + 1), fill="white")
+    finally:
+        for tile in tiles:
+            tile.close()
+    output = BytesIO()
+    sheet.save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+def _fit(image, width, height, mask):
+    # Crops to the target aspect ratio and scales to the exact size the backend
+    # renders at. Masks become hard black/white so JPEG noise is not painted.
+    with Image.open(image.open()) as source:
+        source.draft("L" if mask else "RGB", (width, height))
+        source = ImageOps.exif_transpose(source)
+        source = source.convert("L") if mask else source.convert("RGB")
+        fitted = ImageOps.fit(source, (width, height), Image.LANCZOS)
+        if mask:
+            fitted = fitted.point(lambda value: 255 if value >= 128 else 0)
+    output = BytesIO()
+    fitted.save(output, format="PNG")
+    return output.getvalue()
+
+class Transcoder:
+    def __init__(self, quality=DELIVERY_QUALITY, workers=TRANSCODE_WORKERS):
+        self.quality = quality
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="transcode")
+        self.count = 0
+        self.failures = 0
+        self.encode_seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        if Image is None:
+            logger.warning("Pillow is not installed - images will always be delivered as PNG")
+
+    async def transcode(self, image, delivery_format):
+        # Returns the image to upload; the original is returned unchanged when
+        # no re-encoding is requested or it would not make the upload smaller
+        if delivery_format not in DELIVERY_FORMATS or DELIVERY_FORMATS[delivery_format][1] is None or Image is None:
+            return image
+
+        _, pil_format, extension = DELIVERY_FORMATS[delivery_format]
+        started = time.perf_counter()
+        try:
+            # Pillow releases the GIL while encoding, so a thread pool keeps the event loop free
+            data = await asyncio.get_running_loop().run_in_executor(
+                self._executor, _encode, image, pil_format, self.quality
+            )
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"Transcoding to {pil_format} failed, sending original: {e}")
+            return image
+        elapsed = time.perf_counter() - started
+
+        self.count += 1
+        self.encode_seconds += elapsed
+        self.bytes_in += len(image)
+        self.bytes_out += min(len(data), len(image))
+        logger.info(
+            f"Transcoded {len(image)} -> {len(data)} bytes as {pil_format} "
+            f"(q={self.quality}) in {elapsed * 1000:.0f}ms"
+        )
+        if len(data) >= len(image):
+            return image
+        return ImageBuffer(data, name=f"generated_image.{extension}")
+
+    async def contact_sheet(self, images, columns=2):
+        # Returns None when Pillow is missing so the caller can send the images separately
+        if Image is None:
+            return None
+        started = time.perf_counter()
+        try:
+            data = await asyncio.get_running_loop().run_in_executor(
+                self._executor, _compose, images, columns, VARIATIONS_GRID_MAX_SIDE, self.quality
+            )
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"Building contact sheet failed: {e}")
+            return None
+        logger.info(f"Built a {len(images)} image contact sheet in {(time.perf_counter() - started) * 1000:.0f}ms")
+        return ImageBuffer(data, name="variations.jpg")
+
+    async def fit(self, image, width, height, mask=False):
+        # Without Pillow the backend gets the photo as is and resizes it itself
+        if Image is None:
+            return image
+        started = time.perf_counter()
+        data = await asyncio.get_running_loop().run_in_executor(
+            self._executor, _fit, image, width, height, mask
+        )
+        logger.info(
+            f"Fitted {'mask' if mask else 'source'} {len(image)} bytes to {width}x{height} "
+            f"in {(time.perf_counter() - started) * 1000:.0f}ms"
+        )
+        return ImageBuffer(data, name="mask.png" if mask else "source.png")
+
+    async def warm_up(self):
+        # Pillow loads its format plugins on first use; doing that now keeps
+        # it off the first user's delivery
+        if Image is None:
+            return
+        sample = BytesIO()
+        Image.new("RGB", (8, 8)).save(sample, format="PNG")
+        image = ImageBuffer(sample.getvalue())
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(
+            loop.run_in_executor(self._executor, _encode, image, pil_format, self.quality)
+            for _, pil_format, _ in DELIVERY_FORMATS.values() if pil_format
+        ))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            "transcoded": self.count,
+            "failures": self.failures,
+            "avg_encode_ms": self.encode_seconds * 1000 / self.count if self.count else 0.0,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "bytes_saved": self.bytes_in - self.bytes_out,
+        }
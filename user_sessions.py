@@ -1,8 +1,28 @@
-from config import SD_DEFAULTS
+import asyncio
+import time
+import logging
+from collections import OrderedDict
+from config import (
+    SD_DEFAULTS, DELIVERY_DEFAULT_FORMAT, IMG2IMG_DEFAULT_DENOISING, SESSION_STORE, SESSION_SQLITE_PATH, SESSION_REDIS_URL,
+    SESSION_MAX_ENTRIES, SESSION_TTL, SESSION_FLUSH_INTERVAL, SESSION_REFRESH_INTERVAL
+)
+from session_store import create_session_store
 from typing import Dict
 
+logger = logging.getLogger(__name__)
+
+FIELDS = (
+    "prompt", "negative_prompt", "steps", "cfg_scale", "width", "height", "sampler", "scheduler",
+    "seed", "subseed", "subseed_strength", "restore_faces", "tiling", "batch_size",
+    "delivery_format", "attach_original", "draft_mode",
+    "init_image", "mask_image", "denoising_strength"
+)
+
 class UserSession:
-    def __init__(self, user_id: int):
+    __slots__ = ("user_id", "_manager") + FIELDS
+
+    def __init__(self, user_id: int, data: Dict = None, manager=None):
+        object.__setattr__(self, "_manager", None)
         self.user_id = user_id
         self.prompt = ""
         self.negative_prompt = SD_DEFAULTS["negative_prompt"]
@@ -18,12 +38,32 @@ class UserSession:
         self.restore_faces = False
         self.tiling = False
         self.batch_size = 1
-    
+        self.delivery_format = DELIVERY_DEFAULT_FORMAT
+        self.attach_original = False
+        self.draft_mode = False
+        # {"file_id", "file_unique_id"} of the photo to edit and its optional mask
+        self.init_image = None
+        self.mask_image = None
+        self.denoising_strength = IMG2IMG_DEFAULT_DENOISING
+        if data:
+            for key in FIELDS:
+                if key in data:
+                    object.__setattr__(self, key, data[key])
+        object.__setattr__(self, "_manager", manager)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if self._manager is not None:
+            self._manager.mark_dirty(self)
+
     def update_params(self, **kwargs):
         for key, value in kwargs.items():
-            if hasattr(self, key):
+            if key in FIELDS:
                 setattr(self, key, value)
-    
+
+    def to_dict(self) -> Dict:
+        return {key: getattr(self, key) for key in FIELDS}
+
     def get_params(self) -> Dict:
         return {
             "prompt": self.prompt,
@@ -42,9 +82,109 @@ class UserSession:
             "batch_size": self.batch_size
         }
 
-sessions: Dict[int, UserSession] = {}
+class SessionManager:
+    # Bounded LRU of live sessions in front of a SessionStore. Changes are
+    # written behind in batches every flush_interval seconds.
+
+    def __init__(self, store, max_entries=SESSION_MAX_ENTRIES, ttl=SESSION_TTL,
+                 flush_interval=SESSION_FLUSH_INTERVAL, refresh_interval=SESSION_REFRESH_INTERVAL):
+        self.store = store
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+        # user_id -> (session, loaded_at, last_access)
+        self._cache = OrderedDict()
+        self._dirty = {}
+        self._flush_task = None
+        self.loads = 0
+        self.flushes = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def mark_dirty(self, session):
+        self._dirty[session.user_id] = session
+
+    def _evict(self, now):
+        while self._cache:
+            user_id, (_, _, last_access) = next(iter(self._cache.items()))
+            if len(self._cache) <= self.max_entries and now - last_access < self.ttl:
+                break
+            # Dirty sessions stay referenced from _dirty until the next flush
+            self._cache.popitem(last=False)
+
+    async def get(self, user_id):
+        now = time.monotonic()
+        entry = self._cache.get(user_id)
+        if entry is not None:
+            session, loaded_at, _ = entry
+            stale = (
+                self.store.shared and user_id not in self._dirty
+                and now - loaded_at > self.refresh_interval
+            )
+            if now - entry[2] < self.ttl and not stale:
+                self._cache[user_id] = (session, loaded_at, now)
+                self._cache.move_to_end(user_id)
+                return session
+
+        session = self._dirty.get(user_id)
+        if session is None:
+            try:
+                data = await self.store.load(user_id)
+                self.loads += 1
+            except Exception as e:
+                logger.error(f"Session load for {user_id} failed: {e}")
+                data = None
+            session = UserSession(user_id, data, manager=self)
+        self._cache[user_id] = (session, now, now)
+        self._cache.move_to_end(user_id)
+        self._evict(now)
+        return session
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        items = {user_id: session.to_dict() for user_id, session in dirty.items()}
+        try:
+            await self.store.save_many(items)
+            self.flushes += 1
+        except Exception as e:
+            logger.error(f"Session flush of {len(items)} session(s) failed: {e}")
+            for user_id, session in dirty.items():
+                self._dirty.setdefault(user_id, session)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            self._evict(time.monotonic())
+
+    def start(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self.flush()
+        await self.store.close()
+
+    def stats(self):
+        return {
+            "store": type(self.store).__name__,
+            "cached": len(self._cache),
+            "dirty": len(self._dirty),
+            "loads": self.loads,
+            "flushes": self.flushes,
+        }
+
+session_manager = SessionManager(
+    create_session_store(SESSION_STORE, SESSION_SQLITE_PATH, SESSION_REDIS_URL, SESSION_TTL)
+)
 
-def get_or_create_session(user_id: int) -> UserSession:
-    if user_id not in sessions:
-        sessions[user_id] = UserSession(user_id)
-    return sessions[user_id]
+async def get_or_create_session(user_id: int) -> UserSession:
+    return await session_manager.get(user_id)